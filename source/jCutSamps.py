@@ -16,18 +16,31 @@ import time
 import profile
 import warnings
 import glob
+import os
 import os.path
+import tempfile
+import types
+import csv
+import sqlite3
+
+import numpy as np
 
 import jwave
+import jnoise
 import jtime
 import jmidi
 import jtrans
+import jlib
+import jdither
+import jresample
+import jdenoise
 
 # user configurable parameters
 
 _trig_db        = -36.0         # dB, trigger level
 _measure_noise  = True
 _default_noise  = -60.0         # dB, default noise level when can't measure it.
+_noise_segment  = 0             # seconds per noise floor segment, when room noise drifts (0 = whole file)
 _noise_delta    = 2.0           # dB, level above initial noise level to find sample end
 _dwell_time     = 0.1           # seconds of sample to keep after level reaches noise level
 _lead_time      = 0.0           # seconds to keep before start of note
@@ -38,6 +51,16 @@ _folder         = ""
 _fn_prefix      = ""
 _fn_suffix      = ""
 
+_library       = None          # jlib.Library to record each note in, from -d
+_mono           = False         # -1: write layers whose channels match as mono
+_mono_tolerance = -72.0         # dB, largest difference between channels for mono
+_denoise        = False         # -n: reduce the noise of each layer file before cutting it
+_dither         = "tpdf"        # dither for _bits: "none", "tpdf" or "shaped" (-16s)
+_bits           = None          # -16: bits per sample to write, None = as recorded
+_rate           = None          # -r: sample rate to write, None = as recorded
+_container      = None          # None, "layer" or "instrument": write notes into one wave file
+_align_bytes    = 4096          # align each note in a container to this many bytes
+
 
 # constants
 
@@ -56,29 +79,49 @@ _log_pitch      = False
 _dry_run        = False         # if True, don't actually create any files.
 _find_note      = True          # whether to add note number to file names
 
+_notes          = None          # [(mnote, onset seconds or None)] from -m, for MIDI-recorded layers
+_note_window    = 0.5           # seconds either side of expected onset to look for a note
+_verify_pitch   = False         # with _notes, quickly check each note's pitch
+
 _debug          = False
 _verbose        = True
 
+_follow         = False         # keep cutting while the layer file is being recorded
+_follow_poll    = 0.5           # seconds between checks for new audio
+_follow_idle    = 30.0          # seconds without new audio before the recording is done
+
+_scan_block     = 1 << 16       # samples per block when scanning for a trigger
+
+_following      = False         # True while waiting for more of the current file
+_layer_mono     = False         # True if the current layer file is written as mono
+_readfile       = None          # the file cut from: _infile, or its denoised copy
+
+# Raised when a note runs past the audio recorded so far
+
+class NeedMore(Exception):
+    pass
+
 # Find the next sample
-def find_trigger(wave, start_sn, trig_dB):
+# If limit_sn is given, return None if there's no trigger before it.
+def find_trigger(wave, start_sn, trig_dB, limit_sn=None):
     trigger = wave.dB2v(trig_dB)
     samp_num = start_sn
-    wave.seekSample(samp_num)
-    while True:
-        try:
-            samp = wave.readSample()
-        except EOFError:
-            print("indexError")
-            return 0
-        except Exception as e:
-            print(e)
-            sys.exit(1)
-        if abs(samp[0]) > trigger:
-            break;
-        samp_num += 1
-
-    # we've found a trigger.
-    return samp_num
+    stop_sn = wave.numSamples
+    if limit_sn != None:
+        stop_sn = min(stop_sn, limit_sn)
+    while samp_num < stop_sn:
+        samps = wave.readMono(samp_num, min(samp_num + _scan_block, stop_sn))
+        hits = np.flatnonzero(np.abs(samps) > trigger)
+        if len(hits):
+            # we've found a trigger.
+            return samp_num + int(hits[0])
+        samp_num += len(samps)
+
+    if _following and samp_num >= wave.numSamples:
+        raise NeedMore()
+    if limit_sn != None and samp_num >= limit_sn:
+        return None
+    return 0
 
 #
 # Measure the RMS level starting at the given sample, for the given duration.
@@ -206,47 +249,85 @@ def find_pitch(wave, start):
     return wave.fmt.sampleRate / float(mint), guess
 
 
+# Quick check that a note starting at start has the expected pitch,
+# for when the note is known in advance.  Compares the average
+# magnitude difference at the expected period with that at a semitone
+# either side, half the period, and twice the period.
+
+def verify_pitch(wave, start, mnote):
+    rate = wave.fmt.sampleRate
+    start += rate // 4
+    period = rate / jmidi.freq_for_note(mnote)
+    length = max(rate // 5, int(4 * period))
+    samps = wave.readMono(start, start + length + int(2.2 * period) + 4).astype(np.float64)
+    if len(samps) < length + 2 * int(period) + 4:
+        return False
+
+    # n samples of sig, later by a fractional lag (interpolating)
+    def shift(sig, delta, n):
+        whole = int(delta)
+        frac = delta - whole
+        return (1 - frac) * sig[whole:whole + n] + frac * sig[whole + 1:whole + 1 + n]
+
+    def amdf(later):
+        return np.abs(samps[:length] - later).sum()
+
+    # twice the period is shifted by the period twice, so it's no more
+    # exact than the period itself
+    semitone = pow(2.0, 1 / 12.0)
+    once = shift(samps, period, length + int(period) + 2)
+    here = amdf(once[:length])
+    others = min(amdf(shift(samps, period * semitone, length)),
+        amdf(shift(samps, period / semitone, length)),
+        amdf(shift(samps, period / 2, length)))
+    return here < others and here <= 2 * amdf(shift(once, period, length))
+
+
+# A clean tone of mnote, standing in for a wave (only what
+# verify_pitch() reads)
+
+class _ToneWave:
+    def __init__(self, mnote, rate, seconds=1.0):
+        self.fmt = types.SimpleNamespace(sampleRate=rate)
+        t = np.arange(int(seconds * rate)) / float(rate)
+        self.samps = np.rint(16000 * np.sin(2 * np.pi * jmidi.freq_for_note(mnote) * t))
+
+    def readMono(self, start, end):
+        return self.samps[start:end]
+
+
+# Check that verify_pitch() accepts clean tones at every MIDI note, and
+# rejects each a semitone off.  Returns the notes it gets wrong.
+
+def check_verify_pitch(rate=44100):
+    wrong = []
+    for mnote in range(jmidi.max_mnote + 1):
+        if not verify_pitch(_ToneWave(mnote, rate), 0, mnote):
+            wrong.append(mnote)
+        elif 0 < mnote < jmidi.max_mnote and (verify_pitch(_ToneWave(mnote - 1, rate), 0, mnote)
+                or verify_pitch(_ToneWave(mnote + 1, rate), 0, mnote)):
+            wrong.append(mnote)
+    return wrong
+
+
 # find nth zero crossing (looking forward or backward)
 #
 # Note: only backwards has been used yet
+#
+# Looking backward, returns the last sample before the crossing;
+# looking forward, the first sample after it.
 
 def find_nth_zero(wave, start_sn, end_sn, slope=1, count=_lead_crossings):
 
+    xing = wave.crossings()
     if start_sn < end_sn:
-        first_sn = start_sn
-        last_sn = end_sn + 1
-        start_ix = 0
-        stop_ix = last_sn - first_sn
-        incr = 1
+        sn = xing.nth_next(start_sn, end_sn, slope, count)
+        if sn is not None:
+            return sn
     else:
-        first_sn = end_sn
-        last_sn = start_sn + 1
-        start_ix = last_sn - first_sn - 1
-        stop_ix = 0
-        slope = -slope
-        incr = -1
-
-    # read samples into buffer
-    samps = []
-    wave.seekSample(first_sn)
-    for sn in range(first_sn, last_sn):
-        samps.append(wave.readSample()[0])
-
-    last = samps[start_ix]
-    best = 0
-    for ix in range(start_ix + incr, stop_ix, incr):
-        this = samps[ix]
-        # print(first_sn + ix, this)    ##################################
-        if last * slope < 0 and this * slope >= 0:
-            # print(first_sn + ix, last, this, slope)
-            count -= 1
-            best = first_sn + ix
-            if count == 0:
-                return(first_sn + ix)
-        last = this
-
-    if best != 0:
-        return best
+        sn = xing.nth_prev(start_sn, end_sn, slope, count)
+        if sn is not None:
+            return sn - 1
 
     if True:
         print("  start_sn ", start_sn)
@@ -278,26 +359,29 @@ def find_end(wave, start_sn, noise, dwell_t, max_t):
     limit_sn = None
 
     while True:
-        try:
-            buf.add(buf, wave.readSample()[0])
-        except IndexError:
+        if start_sn + sn >= wave.numSamples:
+            if _following:
+                raise NeedMore()
             print("  Sample file ends before silence")
-            return (start_sn + sn, start_sn + sn, buf.getPeak())
+            return (start_sn + sn - 1, start_sn + sn - 1, buf.getPeak())
+        buf.add(buf, wave.readSample()[0])
         if sn % calc_interval == 0:
             rms = buf.getRms()
             if rms < noise:
                 end_sn = start_sn + sn
                 if limit_sn == None:
+                    if _following and end_sn + dwell_t >= wave.numSamples:
+                        raise NeedMore()
                     limit_sn = min(end_sn + dwell_t, wave.numSamples - 1)
                 return (end_sn, limit_sn, buf.getPeak())
         if not limit_sn and sn > max_t:
-            limit_sn = buf.findPrevCrossing() + start_sn
+            limit_sn = wave.prevCrossing(start_sn + sn)
             # print("### found limit at", jtime.sm(limit_sn, wave.fmt.sampleRate))
         sn += 1
 
     raise Exception("Can't find sample end")
 
-def wavename(folder, fn_prefix, mnote, notename, guess, suffix):
+def wavename(folder, fn_prefix, mnote, notename, guess, suffix, taken=()):
     fname = (
         folder
         + fn_prefix
@@ -306,14 +390,153 @@ def wavename(folder, fn_prefix, mnote, notename, guess, suffix):
         + suffix
         + ("_maybe" if guess else ""))
 
-    if os.path.exists(fname + ".wav"):
+    def exists(name):
+        return name in taken or os.path.exists(name)
+
+    rr = ""
+    if exists(fname + ".wav"):
         index = 1
-        while os.path.exists("%s-%d.wav" % (fname, index)):
+        while exists("%s-%d.wav" % (fname, index)):
             index += 1
         fname = "%s-%d" % (fname, index)
+        rr = str(index)
 
     fname = fname + ".wav"
-    return fname
+    return (fname, rr)
+
+
+# Output format for notes cut from iwave: (bits, channels, rate)
+
+def output_format(iwave):
+    bits = iwave.fmt.bitsPerSample
+    if _bits:
+        bits = min(bits, _bits)
+    return (bits, 1 if _layer_mono else iwave.fmt.numChan, _rate or iwave.fmt.sampleRate)
+
+def setup_output(owave, iwave):
+    owave.copyHeader(iwave)
+    (bits, nchan, rate) = output_format(iwave)
+    if nchan != iwave.fmt.numChan:
+        owave.setChannels(nchan)
+    if bits != iwave.fmt.bitsPerSample:
+        owave.setBits(bits)
+    if rate != iwave.fmt.sampleRate:
+        owave.setRate(rate)
+
+# Number of frames a note of n frames from iwave takes in the output
+
+def output_length(iwave, n):
+    return jresample.out_length(n, iwave.fmt.sampleRate, output_format(iwave)[2])
+
+# Write samples start_sn to end_sn (inclusive) of iwave to owave, in
+# the output format, and return the number of frames written.  Dither
+# for fewer bits is seeded by name.
+
+def copy_note(owave, iwave, start_sn, end_sn, name):
+    (bits, nchan, rate) = output_format(iwave)
+    if (bits, nchan, rate) == (iwave.fmt.bitsPerSample, iwave.fmt.numChan, iwave.fmt.sampleRate):
+        owave.copySamples(iwave, start_sn, end_sn)
+        return end_sn + 1 - start_sn
+
+    resampler = requant = None
+    if rate != iwave.fmt.sampleRate:
+        resampler = jresample.Resampler(iwave.fmt.sampleRate, rate, nchan)
+    if bits != iwave.fmt.bitsPerSample:
+        requant = jdither.Requantizer(iwave.fmt.bitsPerSample, bits,
+            _dither, jdither.seed_for(name))
+
+    def write(frames):
+        if requant:
+            frames = requant.process(frames)
+        elif resampler:
+            frames = np.rint(frames)
+        owave.writeFrames(frames)
+        return len(frames)
+
+    count = 0
+    for sn in range(start_sn, end_sn + 1, _scan_block):
+        frames = iwave.readFrames(sn, min(sn + _scan_block, end_sn + 1))
+        if _layer_mono:
+            frames = np.rint(frames.mean(axis=1, keepdims=True)).astype(np.int32)
+        if resampler:
+            frames = resampler.process(frames)
+        count += write(frames)
+    if resampler:
+        count += write(resampler.flush())
+    return count
+
+
+# A single wave file holding many notes, one after another, with a
+# manifest (<name>.sfm, CSV) giving the sample range and byte range
+# of each note.  jMap reads the manifest and emits offset= and end=.
+#
+# Each note starts on an _align_bytes boundary within the data chunk
+# (or the nearest multiple of the frame size), padded with silence.
+
+class Container:
+    def __init__(self, fname, iwave):
+        self.fname = fname
+        self.outf = open(fname, "wb")
+        self.wave = jwave.WaveChunk(outf=self.outf)
+        setup_output(self.wave, iwave)
+        self.wave.writeHeader(0)
+        self.nsamples = 0
+        self.names = set()
+
+        blockAlign = self.wave.fmt.blockAlign
+        self.align = _align_bytes // math.gcd(_align_bytes, blockAlign)
+        self.zeros = bytes(blockAlign * self.align)
+
+        self.mfile = open(fname[:-len(".wav")] + ".sfm", "w", newline="")
+        self.manifest = csv.writer(self.mfile)
+        self.manifest.writerow(("name", "container", "offset", "end",
+            "byte_start", "byte_end", "mnote"))
+
+    def add(self, iwave, start_sn, end_sn, name, mnote):
+        fmt = self.wave.fmt
+        if output_format(iwave) != (fmt.bitsPerSample, fmt.numChan, fmt.sampleRate):
+            print("%s: all layer files in a container must have the same format" % self.fname,
+                file=sys.stderr)
+            sys.exit(1)
+
+        pad = -self.nsamples % self.align
+        self.outf.write(self.zeros[:pad * self.wave.fmt.blockAlign])
+        self.nsamples += pad
+
+        offset = self.nsamples
+        self.nsamples += copy_note(self.wave, iwave, start_sn, end_sn, name)
+        self.wave.finishHeader(self.nsamples)
+
+        blockAlign = self.wave.fmt.blockAlign
+        self.manifest.writerow((os.path.basename(name), os.path.basename(self.fname),
+            offset, self.nsamples - 1,
+            self.wave.start + offset * blockAlign,
+            self.wave.start + self.nsamples * blockAlign,
+            mnote))
+        self.mfile.flush()
+        self.names.add(name)
+        return (offset, self.nsamples - 1)
+
+    def close(self):
+        self.outf.close()
+        self.mfile.close()
+
+_containers = {}
+
+def container_for(iwave):
+    if _container == "instrument":
+        fname = _folder + _fn_prefix + "notes.wav"
+    else:
+        fname = _folder + _fn_prefix + _fn_suffix[1:] + "_notes.wav"
+    if fname not in _containers:
+        print("Container:", fname)
+        _containers[fname] = Container(fname, iwave)
+    return _containers[fname]
+
+def close_containers():
+    for cont in _containers.values():
+        cont.close()
+    _containers.clear()
 
 
 def copy_wave(iwave, start_sn, end_sn, file_num, freq, guess, sn_ratio, peak, duration):
@@ -326,7 +549,13 @@ def copy_wave(iwave, start_sn, end_sn, file_num, freq, guess, sn_ratio, peak, du
     else:
         (mnote, notename, cents) = jmidi.midi_note_for_freq(freq)
 
-    fname = wavename(_folder, _fn_prefix, mnote, notename, guess, _fn_suffix)
+    cont = None
+    taken = ()
+    if _container and not _dry_run:
+        cont = container_for(iwave)
+        taken = cont.names
+
+    (fname, rr) = wavename(_folder, _fn_prefix, mnote, notename, guess, _fn_suffix, taken)
     print("File %3d:" % file_num, fname)
     print(_fn_prefix                    \
         ,",", file_num                  \
@@ -339,21 +568,33 @@ def copy_wave(iwave, start_sn, end_sn, file_num, freq, guess, sn_ratio, peak, du
         ,",", jtime.sm(duration, iwave.fmt.sampleRate) + "s",
         file=_logfile)
 
-    if not _dry_run:
+    offset = end = None
+    if cont:
+        (offset, end) = cont.add(iwave, start_sn, end_sn, fname, mnote)
+    elif not _dry_run:
         ofile = open(fname, "wb")
         owave = jwave.WaveChunk(outf = ofile)
-        owave.copyHeader(iwave)
+        setup_output(owave, iwave)
         # owave.setNote(mnote)
-        owave.writeHeader(end_sn + 1 - start_sn)
-        owave.copySamples(iwave, start_sn, end_sn)
+        owave.writeHeader(output_length(iwave, end_sn + 1 - start_sn))
+        owave.finishHeader(copy_note(owave, iwave, start_sn, end_sn, fname))
         ofile.close()
 
+    if _library and not _dry_run:
+        _library.add(fname, cont.fname if cont else fname, _infile,
+            offset=offset, end=end,
+            instrument=_fn_prefix[:-1], layer=_fn_suffix[1:],
+            note=mnote, rr=rr, guess=int(guess),
+            cents=cents, freq=freq, peak=peak, snr=sn_ratio,
+            duration=duration / iwave.fmt.sampleRate, rate=output_format(iwave)[2],
+            start_sn=start_sn, limit_sn=end_sn)
+
 
 # find first zero crossing before trig_sn, where
 # the difference bewteen two successive samples is less than
-# twice the default noise level.
+# twice the given noise level.
 
-def find_start(wave, trig_sn, start_sn):
+def find_start(wave, trig_sn, start_sn, noise_db=_default_noise):
 
     vbose = True
     if vbose:
@@ -361,30 +602,23 @@ def find_start(wave, trig_sn, start_sn):
 
     # read channel 1 samples into buffer
 
-    samps = []
-    wave.seekSample(start_sn)
-    for sn in range(start_sn, trig_sn):
-        samps.append(wave.readSample()[0])
-
-    end_ix = len(samps) - 1
-    last = samps[end_ix]
+    samps = wave.readMono(start_sn, trig_sn)
 
-    noise = wave.dB2v(_default_noise) * 8
+    noise = wave.dB2v(noise_db) * 8
 
-    for ix in range(end_ix - 1, 0, -1):
+    # candidates are samples within the noise level whose difference
+    # from the following sample is also within the noise level
+    quiet = np.abs(samps[1:-1]) < noise
+    found = np.flatnonzero(quiet & (np.abs(samps[1:-1] - samps[2:]) < noise))
 
-        this = samps[ix]
-
-        if -noise < this < noise:
-            if vbose:
-                print(".", end="")
-            if abs(this - last) < noise:
-                if vbose:
-                    print()
-                return start_sn + ix
-
-        last = this
+    if len(found):
+        ix = found[-1] + 1
+        if vbose:
+            print("." * int(np.count_nonzero(quiet[ix - 1:])))
+        return start_sn + int(ix)
 
+    if vbose:
+        print("." * int(np.count_nonzero(quiet)), end="")
     raise Exception("Can't find start of sample")
 
 
@@ -420,10 +654,40 @@ def old_find_start(wave, trig_sn, start_sn):
 
     raise Exception("Start of sample not found")
 
+# Sample number where the next expected note should start, if known.
+# The note times are lined up with the recording by the first note.
+
+def expected_sn(note_ix, onset_sn, rate):
+    if not _notes or note_ix >= len(_notes) or onset_sn == None:
+        return None
+    onset = _notes[note_ix][1]
+    if onset == None:
+        return None
+    return onset_sn + int(onset * rate)
+
+# Wait for a file that's being recorded to grow.
+# Returns False once it has stopped growing for _follow_idle seconds.
+
+def wait_for_data(wave):
+    global _following
+
+    have = wave.numSamples
+    idle = 0.0
+    while idle < _follow_idle:
+        time.sleep(_follow_poll)
+        if wave.refresh() > have:
+            return True
+        idle += _follow_poll
+
+    print("  No new audio for %d seconds, finishing up" % _follow_idle)
+    _following = False
+    return False
+
 def process_samples():
-    global _default_noise
+    global _following
+    global _layer_mono
 
-    with open(_infile, "rb") as inf:
+    with open(_readfile, "rb") as inf:
 
         riff = jwave.RiffChunk(inf)
         riff.readHeader()
@@ -434,6 +698,9 @@ def process_samples():
 
         wave = jwave.WaveChunk(riff=riff, inf=inf)
         wave.readHeader()
+        _following = _follow
+        if _following:
+            wave.refresh()
         wave.printHeader()
         rate = wave.fmt.sampleRate
 
@@ -443,15 +710,49 @@ def process_samples():
             print(" ### %s CLOSE" % _infile)
             sys.exit(1)
 
+        # write the notes as mono if the channels are (nearly) the same
+        _layer_mono = False
+        if _mono and wave.fmt.numChan > 1:
+            if _following:
+                print("Can't check the channels of a file being recorded, writing all of them")
+            else:
+                _layer_mono = wave.channelsMatch(wave.dB2v(_mono_tolerance))
+                if _layer_mono:
+                    print("Channels match, writing mono")
+                else:
+                    print("Channels differ, writing all of them")
+
+        if _measure_noise:
+            noise = jnoise.NoiseFloor(wave, _noise_segment)
+            if _verbose:
+                print("Noise floor: %5.2f dB" % (noise.at(0) or _default_noise))
+
         print()
         file_num = 1
         end_sn = 1          # sample number at end of last note
+        note_ix = 0         # next note in _notes
+        onset_sn = None     # sample number where the _notes times start
         while True:
             t = jtime.start()
 
             # 1) find the next peak that exceeds the trigger level
 
-            trig_sn = find_trigger(wave, end_sn, trig_dB=_trig_db)
+            search_sn = end_sn
+            try:
+                trig_sn = None
+                expect = expected_sn(note_ix, onset_sn, rate)
+                if expect != None:
+                    window = int(_note_window * rate)
+                    trig_sn = find_trigger(wave, max(end_sn, expect - window),
+                        trig_dB=_trig_db, limit_sn=expect + window)
+                    if trig_sn == None:
+                        print("    Note %d not found near %s, searching on" %
+                            (note_ix + 1, jtime.hmsm(expect, rate)))
+                if trig_sn == None:
+                    trig_sn = find_trigger(wave, end_sn, trig_dB=_trig_db)
+            except NeedMore:
+                wait_for_data(wave)
+                continue
             if trig_sn == 0:
                 inf.close()
                 print(" ### %s CLOSE on return" % _infile)
@@ -467,24 +768,22 @@ def process_samples():
             end_sn = max(end_sn, trig_sn - rate//10)
             # print("    end_sn", end_sn, "trig_sn", trig_sn)
             # start_sn = find_nth_zero(wave, trig_sn, end_sn, slope=1)
-            start_sn = find_start(wave, trig_sn, end_sn)
+            floor_lev = _default_noise
+            if _measure_noise:
+                floor_lev = noise.at(trig_sn) or _default_noise
+            start_sn = find_start(wave, trig_sn, end_sn, floor_lev)
             start_sn = max(1, start_sn - int(_lead_time * rate))
 
             if _verbose:
                 print("    start_sn     ", start_sn, jtime.hmsm(start_sn, rate))
 
-            # 3) Back up at most a second and measure a half-second of noise
+            # 3) Look up the noise floor at the start of the note
 
             if _measure_noise:
-                noise_sn = max(1, start_sn - rate)
-                dur = min(rate // 2, (start_sn - noise_sn) // 2)
-                noise_lev = measure_rms(wave, noise_sn, dur)
-                if noise_lev == None or noise_lev == 0.0:
+                noise_lev = noise.at(start_sn)
+                if noise_lev == None:
                     print("  Can't measure noise, using %5.2f dB" % _default_noise)
                     noise_lev = _default_noise
-                else:
-                    # use this value if we can't measure it later
-                    _default_noise = noise_lev
             else:
                 noise_lev = _default_noise
 
@@ -494,8 +793,14 @@ def process_samples():
             # 4) Find where the sample ends:
             #    where the RMS level matches the initial noise level plus a delta,
             #    plus a dwell time.
-            (end_sn, limit_sn, peak_lev) = find_end(wave, trig_sn, noise_lev + _noise_delta,
-                _dwell_time, _max_duration)
+            try:
+                (end_sn, limit_sn, peak_lev) = find_end(wave, trig_sn, noise_lev + _noise_delta,
+                    _dwell_time, _max_duration)
+            except NeedMore:
+                # the note isn't finished yet; look for it again when there's more
+                end_sn = search_sn
+                wait_for_data(wave)
+                continue
 
             sdur = limit_sn - start_sn
             ndur = end_sn - start_sn
@@ -513,7 +818,19 @@ def process_samples():
 
 
             # 5) Find which note the sample is
-            if _find_note:
+            if _notes and note_ix < len(_notes):
+                (mnote, onset) = _notes[note_ix]
+                if onset != None and onset_sn == None:
+                    onset_sn = trig_sn - int(onset * rate)
+                note_ix += 1
+                freq = jmidi.freq_for_note(mnote)
+                guess = False
+                if _verify_pitch and not verify_pitch(wave, trig_sn, mnote):
+                    print("    Pitch doesn't match expected note", jmidi.mnote_name(mnote, None))
+                    guess = True
+            elif _find_note:
+                if _notes:
+                    print("    More notes than expected, finding pitch")
                 freq, guess = find_pitch(wave, trig_sn)
 
             if _verbose:
@@ -542,16 +859,64 @@ def process_samples():
             print()
             print("    Elapsed time:", jtime.msm(t, 1))
 
+# Denoise a layer file into a temporary file in the output folder,
+# returning its name, or the layer file if it can't be denoised.
+
+def denoise(fname):
+    fd, tmpname = tempfile.mkstemp(suffix=".wav", prefix="denoise_", dir=_folder or ".")
+    os.close(fd)
+    try:
+        floor = jdenoise.denoise_file(fname, tmpname)
+    except (IOError, OSError, ValueError, EOFError) as msg:
+        print("Can't reduce the noise: %s" % msg)
+        floor = None
+    else:
+        if floor is None:
+            print("No silence to learn the noise from, cutting it as is")
+    if floor is None:
+        os.remove(tmpname)
+        return fname
+    print("Noise reduced by %g dB from %5.2f dB" % (-jdenoise._reduction_db, floor))
+    return tmpname
+
+
 def usage(prog):
     print(file=sys.stderr)
     print("%s: cut wave file into individual samples" % prog, file=sys.stderr)
-    print(file=ys.stderr)
-    print("  Usage: %s {[-f <outfolder>] {<wavefile>}}" % prog, file=sys.stderr)
+    print(file=sys.stderr)
+    print("  Usage: %s {[-f <outfolder>] [-d <libfile>] [-1] [-n] [-16|-16s] [-r <rate>] [-c|-C] [-m|-mv <notefile>] [-t] {<wavefile>}}" % prog, file=sys.stderr)
     print(file=sys.stderr)
     print("where:", file=sys.stderr)
     print("  { x } means 'any number of x'", file=sys.stderr)
+    print("  Options may be given in any order, and apply to the", file=sys.stderr)
+    print("     wave files that follow them.", file=sys.stderr)
     print("  -f <outfolder> specifies the output folder for", file=sys.stderr)
     print("     sample files for following input wave files.", file=sys.stderr)
+    print("  -d <libfile> records each note cut from the following", file=sys.stderr)
+    print("     wave files in a sample library (.sfl), which jMap", file=sys.stderr)
+    print("     can map from instead of the file names.", file=sys.stderr)
+    print("  -1 writes the notes of the following wave files as mono", file=sys.stderr)
+    print("     if their channels are the same, within %g dB." % _mono_tolerance, file=sys.stderr)
+    print("  -n reduces the background noise of the following wave", file=sys.stderr)
+    print("     files before cutting them, learning the noise from the", file=sys.stderr)
+    print("     silence between notes.", file=sys.stderr)
+    print("  -16 writes the notes of the following wave files with 16", file=sys.stderr)
+    print("     bits per sample, with TPDF dither.  -16s uses noise-", file=sys.stderr)
+    print("     shaped dither.", file=sys.stderr)
+    print("  -r <rate> writes the notes of the following wave files", file=sys.stderr)
+    print("     at the given sample rate, in Hz.", file=sys.stderr)
+    print("  -c writes the notes of each following layer file into one", file=sys.stderr)
+    print("     wave file, <prefix>_<layer>_notes.wav, with a manifest", file=sys.stderr)
+    print("     (.sfm) of where each note is, for jMap.", file=sys.stderr)
+    print("  -C is like -c, but writes all layers into <prefix>_notes.wav.", file=sys.stderr)
+    print("  -m <notefile> gives the notes played in the following layer", file=sys.stderr)
+    print("     files, instead of detecting their pitch.  <notefile> is", file=sys.stderr)
+    print("     a MIDI file (.mid), or a text file with one note per line", file=sys.stderr)
+    print("     (number or name), optionally followed by its start time", file=sys.stderr)
+    print("     in seconds.  -mv also does a quick check of each pitch.", file=sys.stderr)
+    print("     (%s -k, alone, tests that check on clean tones.)" % prog, file=sys.stderr)
+    print("  -t follows the following wave files while they're being", file=sys.stderr)
+    print("     recorded, cutting each note as soon as it ends.", file=sys.stderr)
     print("  <wavefile> is a wave file containing mutliple", file=sys.stderr)
     print("     samples.  Unix-style globbing is permitted,", file=sys.stderr)
     print("     that is, you can use '*.wav' or 'samp*/my*foo.wav'.", file=sys.stderr)
@@ -560,9 +925,20 @@ def usage(prog):
 
 
 def main(prog, args):
+    global _notes
+    global _verify_pitch
+    global _container
+    global _mono
+    global _denoise
+    global _bits
+    global _dither
+    global _rate
+    global _library
+    global _follow
     global _fn_prefix
     global _fn_suffix
     global _infile
+    global _readfile
     global _folder
     global _pitchlog
     global _logfile
@@ -582,11 +958,75 @@ def main(prog, args):
 
     while len(args) > 0:
 
-        if len(args) > 2 and args[0] == "-f":
-            _folder = args[1] + "/"
-            print("Output folder:", args[1])
-            del args[0]
-            del args[0]
+        # options, in any order, apply to the wave files after them
+        while len(args) > 0 and args[0].startswith("-"):
+
+            if len(args) > 1 and args[0] == "-f":
+                _folder = args[1] + "/"
+                print("Output folder:", args[1])
+                del args[0:2]
+
+            elif len(args) > 1 and args[0] == "-d":
+                if _library:
+                    _library.close()
+                try:
+                    _library = jlib.Library(args[1])
+                except sqlite3.Error as msg:
+                    print("%s: %s" % (args[1], msg), file=sys.stderr)
+                    return 1
+                print("Sample library:", args[1])
+                del args[0:2]
+
+            elif args[0] == "-1":
+                _mono = True
+                print("Writing mono layers as mono")
+                del args[0]
+
+            elif args[0] == "-n":
+                _denoise = True
+                print("Reducing noise before cutting")
+                del args[0]
+
+            elif args[0] in ("-16", "-16s"):
+                _bits = 16
+                if args[0] == "-16s":
+                    _dither = "shaped"
+                print("Writing 16 bits per sample, %s dither" % _dither)
+                del args[0]
+
+            elif len(args) > 1 and args[0] == "-r":
+                try:
+                    _rate = int(args[1])
+                except ValueError:
+                    usage(prog)
+                print("Writing at %d Hz" % _rate)
+                del args[0:2]
+
+            elif args[0] in ("-c", "-C"):
+                if args[0] == "-c":
+                    _container = "layer"
+                else:
+                    _container = "instrument"
+                print("Writing notes into one file per", _container)
+                del args[0]
+
+            elif len(args) > 1 and args[0] in ("-m", "-mv"):
+                _verify_pitch = args[0] == "-mv"
+                try:
+                    _notes = jmidi.read_notes(args[1])
+                except Exception as msg:
+                    print(msg, file=sys.stderr)
+                    return 1
+                print("Notes from", args[1] + ":", len(_notes))
+                del args[0:2]
+
+            elif args[0] == "-t":
+                _follow = True
+                print("Following files as they're recorded")
+                del args[0]
+
+            else:
+                usage(prog)
 
         if len(args) < 1:
             return rCode
@@ -625,7 +1065,15 @@ def main(prog, args):
                 ,",", "duration"        \
                 , file=_logfile)
 
+            if _library and not _dry_run:
+                _library.forget_source(_infile)
+
             t2 = jtime.start()
+            _readfile = _infile
+            if _denoise and _follow:
+                print("Can't reduce the noise of a file being recorded, cutting it as is")
+            elif _denoise:
+                _readfile = denoise(_infile)
             try:
                 if prof:
                     rCode = profile.run("process_samples()")
@@ -637,12 +1085,19 @@ def main(prog, args):
                     print("Skipping ", _infile, file=sys.stderr)
                     _logfile.close()
                     continue
+            finally:
+                if _readfile != _infile:
+                    os.remove(_readfile)
 
             print()
             print(("Elapsed time for %s: " % _infile), jtime.hms(jtime.end(t2), 1))
 
             _logfile.close()
 
+    close_containers()
+    if _library:
+        _library.close()
+
     if file_count > 1:
         print()
         print("Elapsed time for all files:", jtime.hms(jtime.end(t1), 1))
@@ -660,6 +1115,14 @@ if __name__ == "__main__":
     prog = args[0].split("\\")[-1]
     del args[0]
 
+    if args == ["-k"]:
+        wrong = check_verify_pitch()
+        if wrong:
+            print("-mv pitch check wrong for notes:", " ".join(str(mnote) for mnote in wrong))
+            sys.exit(1)
+        print("-mv pitch check right for clean tones at every MIDI note")
+        sys.exit(0)
+
     # command line mode
     rCode = main(prog, args)
     sys.exit(rCode)
@@ -39,17 +39,37 @@
 # TODO: add "lowest-velocity" for piano low-velocity dead zone
 
 import sys
+import re
+import os.path
 import warnings
 import glob
+import csv
+import io
+import contextlib
+import json
+import shlex
+import hashlib
+import sqlite3
+import concurrent.futures
 
 import jmidi
+import jmeta
+import jlib
+import jpitch
+import jtail
+import jloud
+import jloop
+import jalign
+import jdedup
+import jwatch
 import jtime
 import jtrans
 
-import collections
 import pprint
 
-# index constants into LAYER list
+import numpy as np
+
+# index constants into layer entries (MapBuilder.layers)
 
 LNAME           = 0
 LVEL            = 1
@@ -60,9 +80,7 @@ LXFIN_HI        = 5
 LXFOUT_LO       = 6
 LXFOUT_HI       = 7
 
-# initializations
-
-# entry structure - list of:
+# layer entry structure - list of:
 #  lname        name
 #  lvel         velocity
 #  latten       sf attenuation for layer (obsolete?)
@@ -72,12 +90,6 @@ LXFOUT_HI       = 7
 #
 # Layer entries must be ordered from softest to loudest.
 
-LAYER = []
-
-# release note ranges: list from high-to-low of (relnote, relval)
-
-RELEASE_RANGES = []
-
 ############################################################################
 #
 # Configuration (should be read in)
@@ -116,6 +128,8 @@ EXTEND_NOTE_UP  = True          # whether better to map higher note sample than
 
 LOWEST_LEVEL    = 640           # attenuation for vel=1 notes (when using "level"), in cB
 
+TUNE_MAX_CENTS  = 50            # with "tune", don't correct samples further off than this
+
 # default range for whole keyboard map
 
 LO_KEY          = jmidi.notenum("C1")   # lowest C on piano, lowest key I use
@@ -123,28 +137,118 @@ HI_KEY          = jmidi.notenum("G7")   # highest key on MR76
 
 ###############################################################################
 
-class Globals:
-    def __init__(self):
-        pass
-
-gl = Globals
-gl.grid = []
-gl.samps = {}
-gl.layernum = {}
-gl.lnamelen = 0
-
 class Samp:
     def __init__(self):
         pass
 
-def build_grid(grid):
-
-    for layer in range(0, len(LAYER)):
-        grid.append([])
-        for key in range(0, HI_KEY+MAX_NOTE_SHIFT+1):
-            grid[layer].append(collections.OrderedDict())
+# Parser for sample file names, compiled from the "format" line.
+#
+# The directory and extension are dropped and the rest is split into
+# parts at runs of delimiters.  A round-robin suffix ("-<rr>") is taken
+# off the end of the last part, so other hyphens in the name are just
+# part of the name.  The layer and note are then the parts at layer_loc
+# and note_loc (which count from the end if negative).
+
+class NameFormat:
+    def __init__(self, delims, layer_loc, note_loc):
+        self.layer_loc = layer_loc
+        self.note_loc = note_loc
+        self.parts = re.compile("[^%s\\s]+" % re.escape(delims))
+        self.need = max(layer_loc + 1 if layer_loc >= 0 else -layer_loc,
+                        note_loc + 1 if note_loc >= 0 else -note_loc)
+
+    # Returns (layer name, note spec, MIDI note, rr), or raises
+    # ValueError saying what's wrong with the name.
+    def parse(self, fname):
+        basename = fname[max(fname.rfind("/"), fname.rfind("\\")) + 1:]
+        dot = basename.rfind(".")
+        if dot >= 0:
+            basename = basename[:dot]
+
+        parts = self.parts.findall(basename)
+        rr = ""
+        if parts:
+            (name, dash, rrname) = parts[-1].rpartition("-")
+            if dash:
+                parts[-1] = name
+                rr = rrname
+
+        if len(parts) < self.need:
+            raise ValueError("%s: only %d parts after splitting at delimiters, need %d"
+                % (fname, len(parts), self.need))
+
+        notespec = parts[self.note_loc]
+        mnote = jmidi.notenum(notespec)
+        if mnote == None:
+            raise ValueError("%s: invalid MIDI note designation '%s' (parts are %s)"
+                % (fname, notespec, parts))
+
+        return (parts[self.layer_loc], notespec, mnote, rr)
+
+# All the samples found, and the groups of round-robin samples for each
+# layer and note.  A group is a list of sample numbers, in the order the
+# round-robins were found; a later sample with the same RR name replaces
+# an earlier one.
+#
+# After freeze(), note, layer, rr and path are int32 arrays indexed by
+# sample number, where rr is the sample's place in its group and path
+# indexes paths (container files are shared by many samples).
 
-        gl.layernum[LAYER[layer][LNAME]] = layer
+class SampleTable:
+    def __init__(self):
+        self.samps = []
+        self.paths = []
+        self.pathix = {}
+        self.groups = []
+        self.groupix = {}           # (layer, mnote) -> group number
+        self.rrix = []              # for each group, RR name -> place in group
+
+    # add a sample, returning its group number
+    def add(self, samp):
+        if samp.fname not in self.pathix:
+            self.pathix[samp.fname] = len(self.paths)
+            self.paths.append(samp.fname)
+        sampnum = len(self.samps)
+        self.samps.append(samp)
+
+        key = (samp.layer, samp.mnote)
+        if key not in self.groupix:
+            self.groupix[key] = len(self.groups)
+            self.groups.append([])
+            self.rrix.append({})
+        group = self.groupix[key]
+        if samp.rrob in self.rrix[group]:
+            self.groups[group][self.rrix[group][samp.rrob]] = sampnum
+        else:
+            self.rrix[group][samp.rrob] = len(self.groups[group])
+            self.groups[group].append(sampnum)
+        return group
+
+    def freeze(self):
+        self.note = np.array([samp.mnote for samp in self.samps], dtype=np.int32)
+        self.layer = np.array([samp.layer for samp in self.samps], dtype=np.int32)
+        self.path = np.array([self.pathix[samp.fname] for samp in self.samps], dtype=np.int32)
+        self.rr = np.zeros(len(self.samps), dtype=np.int32)
+        for group in self.groups:
+            for (rr, sampnum) in enumerate(group):
+                self.rr[sampnum] = rr
+
+    # the samples in a group, or None for no group (-1)
+    def group(self, groupnum):
+        if groupnum < 0:
+            return None
+        return [self.samps[sampnum] for sampnum in self.groups[groupnum]]
+
+# The result of mapping: the sample table, the layers, and the grid of
+# which group plays for each layer and key.  It isn't changed once it's
+# built, so any number of .sfz variants can be rendered from it.
+
+class Keymap:
+    def __init__(self, grid, table, layers):
+        grid.setflags(write=False)
+        self.grid = grid
+        self.table = table
+        self.layers = tuple(tuple(layer) for layer in layers)
 
 def build_sampchars():
 
@@ -161,373 +265,54 @@ def build_sampchars():
     return chars
 
 
-def load_filenames(args, print_map=True):
-    global gl
-    global CROSSFADE
-    global no_xfade
-    global TRANSPOSE
-
-    warnings = []
-    errors = []
-
-    for arg in args:
-    #{
-        for sampfname in glob.glob(arg):
-
-            if True:
-                try:
-                    sampf = open(sampfname, "rb")
-                except IOError as msg:
-                    errors.append("Can't open sample file: " + str(msg))
-                    continue
-                else:
-                    sampf.close()
-
-            samp = Samp()
-
-            # strip directory
-            basename = sampfname.replace("\\", "/")
-            basename = basename.split("/")[-1]
-
-            # strip ".wav" extension
-            basename = basename.split(".")
-            basename = ".".join(basename[0:-1])
-            basename = jtrans.tr(basename, DELIMS, " ")
-
-            # get round-robin (RR) index, if any
-            # FIXME: this doesn't allow hyphens in the file name!
-            rrob = ''
-            parts = basename.split("-")
-            if len(parts) == 2:
-                rrob = parts[1]
-
-            # get layer name
-
-            parts = basename.split()
-            if len(parts) <= abs(LAYER_LOC):
-                loc = LAYER_LOC
-                if loc >= 0:
-                    loc += 1
-                print(("After splitting filename '%s' delimiters," % (basename)), file=sys.stderr)
-                print(("there aren't enough parts to find part number %d." % loc), file=sys.stderr)
-                sys.exit(1)
-            layername  = parts[LAYER_LOC]
-
-            # handle RR
-            layerparts = layername.split("-")
-            if len(layerparts) > 1:
-                layername = layerparts[0]
-
-            # get note: might be MIDI number or note name
-
-            if len(parts) <= abs(NOTE_LOC):
-                loc = NOTE_LOC
-                if loc >= 0:
-                    loc += 1
-                print(("After splitting filename '%s' at delimiters, " % sampfname), file=sys.stderr)
-                print(("there aren't enough parts to find part number %d." % loc), file=sys.stderr)
-                sys.exit(1)
-            notespec   = parts[NOTE_LOC]
-
-            mnote = jmidi.notenum(notespec)
-            if mnote == None:
-                print(("Invalid MIDI note designation '%s' in '%s'" % (notespec, basename)), file=sys.stderr)
-                print("Parts are:", parts, file=sys.stderr)
-                sys.exit(1)
-            # print("MNOTE:", mnote, "XPOSE:", TRANSPOSE, file=sys.stderr)
-            mnote = mnote + TRANSPOSE
-
-            # print(sampfname, mnote, layername, jmidi.mnote_name(mnote)[0])
-            samp.fname = sampfname
-            samp.mnote = mnote
-            samp.notename = jmidi.mnote_name(mnote, pad=None)
-            samp.layername = layername
-            samp.rrob = rrob
-            if layername not in gl.layernum:
-                warnings.append("Sample for unconfigured layer '%s': %s, parts = %s"
-                    % (samp.layername, samp.fname, str(parts)))
-                continue
-            samp.layer = gl.layernum[layername]
-
-            if samp.layer == None:
-                warnings.append("Sample for missing layer '%s': %s"
-                    % (samp.layername, samp.fname))
-                continue
-
-            x = LO_KEY - MAX_NOTE_SHIFT
-            if (samp.mnote < max(0, LO_KEY - MAX_NOTE_SHIFT)
-                or samp.mnote > HI_KEY + MAX_NOTE_SHIFT):
-
-                warnings.append("Sample outside useful note range (%s): %s"
-                    % (samp.notename, samp.fname))
-                continue
-
-            samp.char = None
-            gl.samps[sampfname] = samp
-            # gl.grid[samp.layer][mnote] = samp
-            gl.grid[samp.layer][mnote][rrob] = samp
-
-    #}
-
-    if errors:
-        for msg in errors:
-            print(msg, file=sys.stderr)
-        sys.exit(1)
-
-    if warnings:
-        for msg in warnings:
-            print("Warning:", msg, file=sys.stderr)
-
-    # print the samples, along with a character to assigned for
-    # showing the key map in showmap().
-
-    if print_map:
-        print("KEYBOARD MAPPING", file=gl.ofile)
-        print(file=gl.ofile)
-        print("Sample Table -- each character represents a sample:", file=gl.ofile)
-
-    # if we're crossfading, calculate the crossfades
-    if CROSSFADE:
-        prev_hivel = 0
-        for layer in range(len(LAYER)):
-            # fade out unless last layer
-            if layer != len(LAYER)-1:
-                nextl = layer + 1
-                this_lovel = prev_hivel + 1
-                this_hivel = LAYER[layer][LVEL]
-                this_midvel = this_lovel + (this_hivel - this_lovel) / 2
-                next_lovel = this_hivel + 1
-                next_hivel = LAYER[nextl][LVEL]
-                next_midvel = next_lovel + (next_hivel - next_lovel) / 2
-                # print("==", layer, this_lovel, this_hivel, next_lovel, next_midvel)
-                LAYER[layer][LXFOUT_LO] = this_midvel + 1
-                LAYER[layer][LXFOUT_HI] = next_midvel
-                next_hivel = LAYER[nextl][LVEL]
-                prev_hivel = this_hivel
-
-            # fade in: match previous layer's fade-out
-            if layer != 0:
-                prevl = layer - 1
-                LAYER[layer][LXFIN_LO] = LAYER[prevl][LXFOUT_LO]
-                LAYER[layer][LXFIN_HI] = LAYER[prevl][LXFOUT_HI]
-
-    sampnum = 0
-    sampchars = build_sampchars()
-
-    for layer in range(len(LAYER)-1, -1, -1):
-        if print_map:
-            print(("  Layer %*s vel %3d: " % (gl.lnamelen, LAYER[layer][LNAME], LAYER[layer][LVEL])),
-                end=" ", file=gl.ofile)
-        for mnote in range(LO_KEY, HI_KEY+1):
-            # samps = gl.grid[layer][mnote]
-
-            samps = gl.grid[layer][mnote]
-
-            if len(samps):
-                # print("SAMPS ", end="")
-                # pprint.pprint(samps)
-                samp = samps[next(iter(samps))]
-                # print("SAMP ", end="")
-                # pprint.pprint(samp)
-                if samp.char == None:
-                    samp.char = sampchars[sampnum]
-                    sampnum += 1
-                    if sampnum >= len(sampchars):
-                        sampnum = 0
-                if print_map:
-                    print("%3s=%c" % (samp.notename, samp.char), end="", file=gl.ofile)
-        if print_map:
-            print(file=gl.ofile)
-
-    print(file=gl.ofile)
-
-def window(row, col, bounds):
-    row_min = bounds[0]
-    row_max = bounds[1]
-    col_min = bounds[2]
-    col_max = bounds[3]
-
-    row_lo = max(row - MAX_LAYER_SHIFT, row_min)
-    row_hi = min(row + MAX_LAYER_SHIFT, row_max)
-    col_lo = max(col - MAX_NOTE_SHIFT, col_min)
-    col_hi = min(col + MAX_NOTE_SHIFT, col_max)
-
-    return (row_lo, row_hi, col_lo, col_hi)
+# Return a copy of the layer data with crossfades between layers
 
+def crossfade_layers(layers):
+    layers = [list(layer) for layer in layers]
 
-def distance(torow, tocol, fromrow, fromcol):
-    row_dist = (abs(torow - fromrow) * LAYER_SHIFT_COST) * 2
-    col_dist = (abs(tocol - fromcol) * NOTE_SHIFT_COST) * 2
+    prev_hivel = 0
+    for layer in range(len(layers)):
+        # fade out unless last layer
+        if layer != len(layers)-1:
+            nextl = layer + 1
+            this_lovel = prev_hivel + 1
+            this_hivel = layers[layer][LVEL]
+            this_midvel = this_lovel + (this_hivel - this_lovel) / 2
+            next_lovel = this_hivel + 1
+            next_hivel = layers[nextl][LVEL]
+            next_midvel = next_lovel + (next_hivel - next_lovel) / 2
+            # print("==", layer, this_lovel, this_hivel, next_lovel, next_midvel)
+            layers[layer][LXFOUT_LO] = this_midvel + 1
+            layers[layer][LXFOUT_HI] = next_midvel
+            prev_hivel = this_hivel
 
-    if torow > fromrow and EXTEND_LAYER_UP:
-        row_dist += 1
-    elif torow < fromrow and not EXTEND_LAYER_UP:
-        row_dist += 1
+        # fade in: match previous layer's fade-out
+        if layer != 0:
+            prevl = layer - 1
+            layers[layer][LXFIN_LO] = layers[prevl][LXFOUT_LO]
+            layers[layer][LXFIN_HI] = layers[prevl][LXFOUT_HI]
 
-    if tocol > fromcol and EXTEND_NOTE_UP:
-        col_dist += 1
-    elif tocol < fromcol and not EXTEND_NOTE_UP:
-        col_dist += 1
-
-    # print("(", fromrow, fromcol, ")", end="")
-    # print(torow, fromrow, "=>", row_dist, "|", tocol, fromcol, "=>", col_dist)
-    return col_dist + row_dist
+    return layers
 
 def sname(samp):
     return "%s-%s" % (samp.layername, samp.notename)
 
-def assign_keys():
-    global gl
-
-    # fix bounds of search
-    row_min = 0
-    row_max = len(LAYER)-1
-    col_min = LO_KEY
-    col_max = HI_KEY
-
-    bounds = (row_min, row_max, col_min - MAX_NOTE_SHIFT, col_max + MAX_NOTE_SHIFT)
-    keymap = []
-    build_grid(keymap)
-
-    for row in range(row_min, row_max+1):
-    #{
-        # set initial window for this row pass
-        win = window(row, col_min, bounds)
-
-        # load initial neighbors.  Omit rightmost column (they're added below)
-
-        neighbors = []  # (samp, row, col)
-
-        col = 0
-        # note: rr here means row, not RR (round-robin)
-        for rr in range(win[0], win[1]+1):
-            for cc in range(win[2], win[3]):
-                # note that nbr is a collection of RR notes
-                nbr = gl.grid[rr][cc]
-                if nbr:
-                    # print("init:", sname(next(iter(nbr))))
-                    neighbors.append((nbr, rr, cc))
-
-        for col in range(col_min, col_max+1):
-        #{
-            # set new window
-            win = window(row, col, bounds)
-
-            # add new neighbors at right of window
-            cc = win[3]
-            for rr in range(win[0], win[1]+1):
-                nbr = gl.grid[rr][cc]
-                if nbr and len(nbr) > 0:
-                    # print("new: ", rr, cc, sname(next(iter(nbr))))
-                    neighbors.append((nbr, rr, cc))
-
-            # Visit neighbors.
-            # Discard any neighbors in old left column.
-            # Go backwards to make deletion easy
-            # Calculate distance and find closest neighbor.
-
-            bestdist = 9999
-            bestnbr = None
-
-            # print(jmidi.mnote_name(col), len(neighbors), col, win)
-            if len(neighbors) == 0:
-                ### print(" -- No neighbors for layer", row, "key", col, file=sys.stderr)
-                pass
-            for nbrix in range(len(neighbors)-1, -1, -1):
-                (nbr, rr, cc) = neighbors[nbrix]
-                if cc < win[2]:
-                    del neighbors[nbrix]
-                    continue
-
-                dist = distance(rr, cc, row, col)
-                # print("  ", row, col, rr, cc, ":", dist, end=""))
-                if dist < bestdist:
-                    bestnbr = nbr
-                    bestdist = dist
-
-            keymap[row][col] = bestnbr
-        #}
-    #}
-
-    gl.grid = keymap
-
+# The <region> lines for a group of round-robin samples mapped to keys
+# keyLo..keyHi.  names has the (padded) note name for each key, and
+# releases the ampeg_release opcode (or "") for each key.
 
-def showmap(grid, layerdata):
-
-    print("Map Table: each column is for a MIDI note.  Each row is for a MIDI velocity range.", file=gl.ofile)
-    print("Each character in the table is the charater for a sample, as shown in the section above.", file=gl.ofile)
-    print(file=gl.ofile)
-
-    # Generate heading showing "piano keyboard" in three lines:
-    # first line is octave number
-    # second line is key name, omitting sharp or flat
-    # third line is "b" for flats and " " for naturals
-    #
-    # Example:
-    #    111111111111222222222222333333333333444444444444...
-    #    CDDEEFGGAABBCDDEEFGGAABBCDDEEFGGAABBCDDEEFGGAABB...
-    #     b b  b b b  b b  b b b  b b  b b b  b b  b b b ...
-
-    octave_line = note_line = sharpflat_line = ""
-    for col in range(LO_KEY, HI_KEY+1):
-        notename = jmidi.mnote_name(col, pad=None)
-        note_line += notename[0]
-        if notename[1] == "b":
-            sharpflat_line += "b"
-            octave = notename[2]
-        else:
-            sharpflat_line += " "
-            octave = notename[1]
-        octave_line += octave
-
-    # print("keyboard")
-    print(note_line, file=gl.ofile)
-    print(sharpflat_line, file=gl.ofile)
-    print(octave_line, file=gl.ofile)
-    print(file=gl.ofile)
-
-    # print key assignments
-
-    # FIXME: find out why this is skipped for no-xfade
-    for row in range(len(layerdata)-1, -1, -1):
-        line = ""
-        for col in range(LO_KEY, HI_KEY+1):
-            # samp = gl.grid[row][col]
-            samps = gl.grid[row][col]
-            if samps and len(samps):
-                samp = samps[next(iter(samps))]
-                if samp.layer == row and samp.mnote == col:
-                    line += " "
-                elif samp.char:
-                    line += samp.char
-                else:
-                    line += "!"
-            else:
-                line += "!"
-        print(("%s Layer %-6s v=%03d"
-            % (line, layerdata[row][LNAME], layerdata[row][LVEL])),
-            file=gl.ofile)
-
-    print(file=gl.ofile)
-    print("Key:", file=gl.ofile)
-    print("  space = unity-mapped key (and not borrowed from another layer)", file=gl.ofile)
-    print("  !     = unmapped key", file=gl.ofile)
-    print("  anything else: see Sample Table above", file=gl.ofile)
-
-
-def emit_keymap(samps, keyLo, keyHi):
+def emit_keymap(samps, keyLo, keyHi, names, releases):
 
     if False:
         # inhibit RR ########
-        sampkey = next(iter(samps))
-        sampval = samps[sampkey]
-        samps = {sampkey:sampval}
+        samps = samps[:1]
 
+    regions = []
     rr_count = len(samps)
     rr_num = 0
     if rr_count > 1:
         rr_frac = 1.0/rr_count
-    for samp in samps.values():
+    for samp in samps:
         # We needed this when we used sfk file to generate .sf2 file.
         # Keep it in case it helps for debugging.
         # print("  SAMP:%s:%d:%d:%d:\t(%3s - %3s)" % (
@@ -536,132 +321,47 @@ def emit_keymap(samps, keyLo, keyHi):
         #     jmidi.mnote_name(keyHi, None)),
         #     file=gl.ofile)
 
-        print("<region>", end=" ", file=gl.sfzf)
-        print("sample=%s" % samp.fname, end=" ", file=gl.sfzf)
+        parts = ["<region> sample=%s " % samp.fname]
+        loops = samp.loops
+        if samp.offset != None:
+            parts.append("offset=%d end=%d " % (samp.offset + samp.shift, samp.end))
+        elif samp.frames > 0:
+            if samp.shift:
+                parts.append("offset=%d " % samp.shift)
+            parts.append("end=%d " % (samp.frames - 1 if samp.end == None else samp.end))
+        else:
+            loops = None
+        if samp.delay:
+            parts.append("delay=%.6f " % samp.delay)
+        if loops:
+            parts.append("loop_mode=loop_continuous loop_start=%d loop_end=%d "
+                % tuple(loops[0]))
         if keyLo == samp.mnote and keyHi == samp.mnote:
-            print("key=%-3s" %jmidi.mnote_name(samp.mnote, None), end=" ", file=gl.sfzf)
+            parts.append("key=%s " % names[samp.mnote])
         else:
-            print("lokey=%-3s" % jmidi.mnote_name(keyLo, None), end=" ", file=gl.sfzf)
-            print("hikey=%-3s" % jmidi.mnote_name(keyHi, None), end=" ", file=gl.sfzf)
-            print("pitch_keycenter=%-3s" %jmidi.mnote_name(samp.mnote, None), end=" ", file=gl.sfzf)
+            parts.append("lokey=%s hikey=%s pitch_keycenter=%s "
+                % (names[keyLo], names[keyHi], names[samp.mnote]))
+        if samp.tune:
+            parts.append("tune=%d " % samp.tune)
 
         # programmed release times based on MIDI note
         # %%% todo: interpolate!
-        for (relnote, relval) in RELEASE_RANGES:
-            if keyLo >= relnote:
-                print("ampeg_release=%s" % relval, end=" ", file=gl.sfzf)
-                break
+        parts.append(releases[keyLo])
 
         # random round-robins
         if rr_count > 1:
-            print("lorand=" + str(rr_frac * rr_num), end=" ", file=gl.sfzf)
-            print("hirand=" + str(rr_frac * (rr_num+1)), end=" ", file=gl.sfzf)
+            parts.append("lorand=%s hirand=%s "
+                % (str(rr_frac * rr_num), str(rr_frac * (rr_num+1))))
             rr_num += 1
 
-        print(file=gl.sfzf)
+        regions.append("".join(parts))
+
+    return regions
 
 
 def cB2scalefactor(cb):
     return (pow(10.0, cb/200.0))
 
-def emit_map(grid, layerdata):
-
-    loVel = 1
-    lprevl = LOWEST_LEVEL
-
-    if len(SFZ_HEADERS):
-        # print("HEADERS:", SFZ_HEADERS)
-        print("\n".join(SFZ_HEADERS), file=gl.sfzf)
-
-    if len(SFZ_CONTROLS):
-        # print("CONTROLS:", SFZ_CONTROLS
-        print(file=gl.sfzf)
-        print("<control>", file=gl.sfzf)
-        print("\n".join(SFZ_CONTROLS), file=gl.sfzf)
-
-    if len(SFZ_GLOBALS):
-        # print("GLOBALS:", SFZ_GLOBALS)
-        print(file=gl.sfzf)
-        print("<global>", file=gl.sfzf)
-        print("\n".join(SFZ_GLOBALS), file=gl.sfzf)
-
-    if len(SFZ_MASTERS):
-        # print("MASTERS:", SFZ_MASTERS)
-        print(file=gl.sfzf)
-        print("<master>", file=gl.sfzf)
-        print("\n".join(SFZ_MASTERS), file=gl.sfzf)
-
-    # Emit <group> for each velocity layer and <region> for each sample in it
-    for row in range(0, len(layerdata)):
-    #{
-        hiVel  = layerdata[row][LVEL]
-        latten = layerdata[row][LATTEN]
-        llevel = layerdata[row][LLEVEL]
-        xfin_lo = layerdata[row][LXFIN_LO]
-        xfin_hi = layerdata[row][LXFIN_HI]
-        xfout_lo = layerdata[row][LXFOUT_LO]
-        xfout_hi = layerdata[row][LXFOUT_HI]
-
-        # We needed this when we used sfk file to generate .sf2 file.
-        # Keep it in case it helps for debugging.
-        # print(file=gl.ofile)
-        # print("VLAYER:%s:%3d:%3d:%2d" % (
-        #     layerdata[row][LNAME], loVel, hiVel, latten),       # %%% llevel
-        #     file=gl.ofile)
-
-        print(file=gl.sfzf)
-        print("<group>", end=" ", file=gl.sfzf)
-        if xfin_lo:
-            print("xfin_lovel=%d xfin_hivel=%d" % (xfin_lo, xfin_hi), end=" ", file=gl.sfzf)
-        else:
-            print("lovel=%d" % loVel, end=" ", file=gl.sfzf)
-        if xfout_lo:
-            print("xfout_lovel=%d xfout_hivel=%d" % (xfout_lo, xfout_hi), end=" ", file=gl.sfzf)
-        else:
-            print("hivel=%d" % hiVel, end=" ", file=gl.sfzf)
-
-        if (latten != 0):
-            print("volume=%f" % (-latten/10.0), end=" ")
-        print("ampeg_release=%f" % RELEASE, file=gl.sfzf, end=" ")
-
-        if (llevel != 0):
-            midVel = (hiVel + loVel) / 2
-            midLev = (llevel + lprevl) / 2
-            print("amp_velcurve_%d %f" % (loVel,  cB2scalefactor(-lprevl)), file=gl.sfzf)
-            print("amp_velcurve_%d %f" % (midVel, cB2scalefactor(-midLev)), file=gl.sfzf)
-            print("amp_velcurve_%d %f" % (hiVel,  cB2scalefactor(-llevel)), file=gl.sfzf)
-
-            print(("row %s velocity %3d level %3d cB, scale %f"
-                % (layerdata[row][LNAME], loVel,  lprevl, cB2scalefactor(-lprevl))), file=gl.sfzf)
-            print(("row %s velocity %3d level %3d cB, scale %f"
-                % (layerdata[row][LNAME], midVel, midLev, cB2scalefactor(-midLev))), file=gl.sfzf)
-            print(("row %s velocity %3d level %3d cB, scale %f"
-                % (layerdata[row][LNAME], hiVel,  llevel, cB2scalefactor(-llevel))), file=gl.sfzf)
-            lprevl = llevel
-
-        print(file=gl.sfzf)
-        lastSamps = None
-
-        for col in range(LO_KEY, HI_KEY+1):
-            samps = gl.grid[row][col]
-            if samps != lastSamps:
-                if lastSamps != None:
-                    emit_keymap(lastSamps, firstKey, col-1)
-                lastSamps = samps
-                firstKey = col
-
-        # handle last unfinished keymap
-        if lastSamps != None:
-            emit_keymap(lastSamps, firstKey, col)
-
-        loVel = hiVel + 1
-    #}
-
-    if len(SFZ_FINALS):
-        # print("FINALS:", SFZ_FINALS)
-        print(file=gl.sfzf)
-        print("\n".join(SFZ_FINALS), file=gl.sfzf)
-
 def convert_int(val, lineno):
     try:
         ival = int(val)
@@ -681,328 +381,1421 @@ def kwval(group, lineno):
         sys.exit(1)
     return (kw, val)
 
-def process_cfg(cfg_fname, sfname, print_map=True):
-    global LAYER_LOC, NOTE_LOC
-    global LO_KEY, HI_KEY
-    global MAX_LAYER_SHIFT, LAYER_SHIFT_COST, EXTEND_LAYER_UP
-    global MAX_NOTE_SHIFT, NOTE_SHIFT_COST, EXTEND_NOTE_UP
-    global PRESETNAME, RELEASE, LAYER
-    global LOWEST_LEVEL
-    global gl
-    global SFZ_HEADERS
-    global SFZ_GLOBALS
-    global SFZ_MASTERS
-    global SFZ_CONTROLS
-    global SFZ_FINALS
-    global CROSSFADE
-    global TRANSPOSE
+# Builds the keymap and .sfz files for one instrument.  Holds the
+# config read from <sfname>.sfc, the sample table, and the keymap, so
+# any number of instruments can be built in one process.
+#
+# layers is the list of layer entries (see above), and release_ranges
+# is a list from high to low of (relnote, relval).  The other settings
+# start from the defaults above.
+
+class MapBuilder:
+    def __init__(self, sfname, args, meta=None):
+        self.sfname = sfname
+        self.cfname = sfname + ".sfc"
+        self.args = args
+        if meta == None:
+            meta = jmeta.MetaIndex()
+        self.meta = meta
+        self.ofile = None
+        self.grid = None
+        self.table = None
+        self.keymap = None
+        self.layernum = {}
+        self.reset_cfg()
+
+    # Start over from the default settings
+    def reset_cfg(self):
+        self.layers = []
+        self.release_ranges = []
+        self.layer_loc = None
+        self.note_loc = None
+        self.name_format = None
+        self.lo_key = LO_KEY
+        self.hi_key = HI_KEY
+        self.max_layer_shift = MAX_LAYER_SHIFT
+        self.max_note_shift = MAX_NOTE_SHIFT
+        self.layer_shift_cost = LAYER_SHIFT_COST
+        self.note_shift_cost = NOTE_SHIFT_COST
+        self.extend_layer_up = EXTEND_LAYER_UP
+        self.extend_note_up = EXTEND_NOTE_UP
+        self.lowest_level = LOWEST_LEVEL
+        self.lnamelen = 0
+        self.transpose = 0
+        self.crossfade = False
+        self.tune = False
+        self.tune_max = TUNE_MAX_CENTS
+        self.tail_db = None
+        self.loop_min = None
+        self.align = None
+        self.align_max = jalign._max_shift
+        self.dedup = None
+        self.auto_levels = {}
+        self.release = 0.1
+        self.sfz_headers = []
+        self.sfz_controls = []
+        self.sfz_globals = []
+        self.sfz_masters = []
+        self.sfz_finals = []
+        self.sfz_variants = []
+
+    def process_cfg(self, print_map=True):
+
+        try:
+            cfgf = open(self.cfname, "r")
+        except Exception as msg:
+            print(msg, file=sys.stderr)
+            sys.exit(1)
 
-    try:
-        cfgf = open(cfg_fname, "r")
-    except Exception as msg:
-        print(msg, file=sys.stderr)
-        sys.exit(1)
+        # Defaults
+        self.reset_cfg()
 
-    # Defaults
-    CROSSFADE = False
-    RELEASE = 0.1
-    SFZ_HEADERS = []
-    SFZ_CONTROLS = []
-    SFZ_GLOBALS = []
-    SFZ_MASTERS = []
-    SFZ_FINALS = []
-
-    # entry structure - list of:
-    #  lname    name
-    #  lvel     velocity
-    #  lrange   velocity range
-    #  latten   sf attenuation for layer (obsolete?)
-    #  llevel   amount layer was boosted by when normalized.
-    #             If zero, velocity curve adjustment not done.
-
-    layers = []
-
-    lvmode = None
-
-    lineno = 0
-    for iline in cfgf.readlines():
-    #{
-        line = jtrans.tr(iline.strip(), "\t", " ")
-        lineno += 1
-
-        # skip blank line or comment
-        if len(line) == 0 or line[0] == "#":
-            continue
-
-        # print(line, file=sys.stderr)
-
-        groups = line.split(" ")
-        cmd = groups[0]
-        for ix in range(len(groups)-1, -1, -1):
-            if len(groups[ix]) == 0:
-                del groups[ix]
-
-        if cmd == "crossfade":
-            CROSSFADE = True
-            continue
-
-        if cmd == "release":
-            if len(groups) < 2 or len(groups) > 3:
-                print(("Line %d: expecting release value and optional midi note." % (lineno)), file=sys.stderr)
-                sys.exit(1)
-            val = groups[1]
-            try:
-                relval = float(val)
-            except:
-                print(("Line %d: expecting float value for release time, got '%s'."
-                    % (lineno, val)),
-                    file=sys.stderr)
-                sys.exit(1)
-            if len(groups) == 3:
-                # note range release level (note given is low note of range)
-                val = groups[2]
+        # entry structure - list of:
+        #  lname    name
+        #  lvel     velocity
+        #  lrange   velocity range
+        #  latten   sf attenuation for layer (obsolete?)
+        #  llevel   amount layer was boosted by when normalized.
+        #             If zero, velocity curve adjustment not done.
+
+        cfg_layers = []
+        variant_lines = []
+
+        lvmode = None
+
+        lineno = 0
+        for iline in cfgf.readlines():
+        #{
+            line = jtrans.tr(iline.strip(), "\t", " ")
+            lineno += 1
+
+            # skip blank line or comment
+            if len(line) == 0 or line[0] == "#":
+                continue
+
+            # print(line, file=sys.stderr)
+
+            groups = line.split(" ")
+            cmd = groups[0]
+            for ix in range(len(groups)-1, -1, -1):
+                if len(groups[ix]) == 0:
+                    del groups[ix]
+
+            if cmd == "crossfade":
+                self.crossfade = True
+                continue
+
+            if cmd == "tune":
+                self.tune = True
+                for group in groups[1:]:
+                    (kw, val) = kwval(group, lineno)
+                    if kw == "max-cents":
+                        self.tune_max = convert_int(val, lineno)
+                    else:
+                        print(("Line %d: unknown tune option '%s'." % (lineno, kw)), file=sys.stderr)
+                        sys.exit(1)
+                continue
+
+            if cmd == "trim-tails":
+                self.tail_db = jtail._threshold_db
+                for group in groups[1:]:
+                    (kw, val) = kwval(group, lineno)
+                    if kw == "threshold":
+                        try:
+                            self.tail_db = float(val)
+                        except ValueError:
+                            print(("Line %d: expecting dB value for threshold, got '%s'."
+                                % (lineno, val)), file=sys.stderr)
+                            sys.exit(1)
+                    else:
+                        print(("Line %d: unknown trim-tails option '%s'." % (lineno, kw)), file=sys.stderr)
+                        sys.exit(1)
+                continue
+
+            if cmd == "align":
+                self.align = "offset"
+                for group in groups[1:]:
+                    (kw, val) = kwval(group, lineno)
+                    if kw == "mode":
+                        if val not in ("offset", "delay"):
+                            print(("Line %d: align mode must be offset or delay, not '%s'."
+                                % (lineno, val)), file=sys.stderr)
+                            sys.exit(1)
+                        self.align = val
+                    elif kw == "max-shift":
+                        try:
+                            self.align_max = float(val)
+                        except ValueError:
+                            print(("Line %d: expecting ms for max-shift, got '%s'."
+                                % (lineno, val)), file=sys.stderr)
+                            sys.exit(1)
+                    else:
+                        print(("Line %d: unknown align option '%s'." % (lineno, kw)), file=sys.stderr)
+                        sys.exit(1)
+                continue
+
+            if cmd == "dedup":
+                self.dedup = jdedup._max_distance
+                for group in groups[1:]:
+                    (kw, val) = kwval(group, lineno)
+                    if kw == "max-distance":
+                        try:
+                            self.dedup = float(val)
+                        except ValueError:
+                            print(("Line %d: expecting a fraction for max-distance, got '%s'."
+                                % (lineno, val)), file=sys.stderr)
+                            sys.exit(1)
+                    else:
+                        print(("Line %d: unknown dedup option '%s'." % (lineno, kw)), file=sys.stderr)
+                        sys.exit(1)
+                continue
+
+            if cmd == "find-loops":
+                self.loop_min = jloop._min_time
+                for group in groups[1:]:
+                    (kw, val) = kwval(group, lineno)
+                    if kw == "min-length":
+                        try:
+                            self.loop_min = float(val)
+                        except ValueError:
+                            print(("Line %d: expecting seconds for min-length, got '%s'."
+                                % (lineno, val)), file=sys.stderr)
+                            sys.exit(1)
+                    else:
+                        print(("Line %d: unknown find-loops option '%s'." % (lineno, kw)), file=sys.stderr)
+                        sys.exit(1)
+                continue
+
+            if cmd == "release":
+                if len(groups) < 2 or len(groups) > 3:
+                    print(("Line %d: expecting release value and optional midi note." % (lineno)), file=sys.stderr)
+                    sys.exit(1)
+                val = groups[1]
                 try:
-                    relnote = int(val)
+                    relval = float(val)
                 except:
-                    print(("Line %d: expecting int (midi note) value for release note, got '%s'."
+                    print(("Line %d: expecting float value for release time, got '%s'."
                         % (lineno, val)),
                         file=sys.stderr)
                     sys.exit(1)
-                RELEASE_RANGES.append((relnote, relval))
+                if len(groups) == 3:
+                    # note range release level (note given is low note of range)
+                    val = groups[2]
+                    try:
+                        relnote = int(val)
+                    except:
+                        print(("Line %d: expecting int (midi note) value for release note, got '%s'."
+                            % (lineno, val)),
+                            file=sys.stderr)
+                        sys.exit(1)
+                    self.release_ranges.append((relnote, relval))
 
-            continue
+                continue
 
-        if cmd == "transpose":
-            TRANSPOSE = int(groups[1])
-            print("TRANSPOSE by", TRANSPOSE, file=sys.stderr)
+            if cmd == "variant":
+                if len(groups) < 2:
+                    print(("Line %d: expecting variant name." % (lineno)), file=sys.stderr)
+                    sys.exit(1)
+                opts = {}
+                for group in groups[2:]:
+                    (kw, val) = kwval(group, lineno)
+                    if kw == "crossfade":
+                        opts["crossfade"] = val.upper() == "Y"
+                    elif kw == "transpose":
+                        opts["transpose"] = convert_int(val, lineno)
+                    elif kw in ("low-key", "high-key"):
+                        key = jmidi.notenum(val)
+                        if key == None:
+                            print(("Line %d: expecting note name, got '%s'." % (lineno, val)), file=sys.stderr)
+                            sys.exit(1)
+                        opts[kw.replace("-key", "_key").replace("low", "lo").replace("high", "hi")] = key
+                    else:
+                        print(("Line %d: unknown variant option '%s'." % (lineno, kw)), file=sys.stderr)
+                        sys.exit(1)
+                self.sfz_variants.append((groups[1], opts))
+                variant_lines.append(lineno)
+                continue
 
-        if cmd == "sfz-header":
-            SFZ_HEADERS.append(" ".join(groups[1:]))
+            if cmd == "transpose":
+                self.transpose = int(groups[1])
+                print("TRANSPOSE by", self.transpose, file=sys.stderr)
 
-        if cmd == "sfz-control":
-            SFZ_CONTROLS.append(" ".join(groups[1:]))
+            if cmd == "sfz-header":
+                self.sfz_headers.append(" ".join(groups[1:]))
 
-        if cmd == "sfz-global":
-            SFZ_GLOBALS.append(" ".join(groups[1:]))
+            if cmd == "sfz-control":
+                self.sfz_controls.append(" ".join(groups[1:]))
 
-        if cmd == "sfz-master":
-            SFZ_MASTERS.append(" ".join(groups[1:]))
+            if cmd == "sfz-global":
+                self.sfz_globals.append(" ".join(groups[1:]))
 
-        if cmd == "sfz-final":
-            SFZ_FINALS.append(" ".join(groups[1:]))
+            if cmd == "sfz-master":
+                self.sfz_masters.append(" ".join(groups[1:]))
 
-        if cmd == "layer-opts":
-            for group in groups[1:]:
-                if len(group) == 0:
-                    continue
+            if cmd == "sfz-final":
+                self.sfz_finals.append(" ".join(groups[1:]))
 
-                (kw, val) = kwval(group, lineno)
+            if cmd == "layer-opts":
+                for group in groups[1:]:
+                    if len(group) == 0:
+                        continue
 
-                if kw == "max-shift":
-                    MAX_LAYER_SHIFT = convert_int(val, lineno)
+                    (kw, val) = kwval(group, lineno)
 
-                elif kw == "shift-cost":
-                    LAYER_SHIFT_COST = convert_int(val, lineno)
+                    if kw == "max-shift":
+                        self.max_layer_shift = convert_int(val, lineno)
 
-                elif kw == "extend-up":
-                    if val.upper() == "Y":
-                        EXTEND_LAYER_UP = True
-                    else:
-                        EXTEND_LAYER_UP = False
-            continue
+                    elif kw == "shift-cost":
+                        self.layer_shift_cost = convert_int(val, lineno)
 
-        if cmd == "note-opts":
-            for group in groups[1:]:
-                if len(group) == 0:
-                    continue
+                    elif kw == "extend-up":
+                        if val.upper() == "Y":
+                            self.extend_layer_up = True
+                        else:
+                            self.extend_layer_up = False
+                continue
 
-                (kw, val) = kwval(group, lineno)
+            if cmd == "note-opts":
+                for group in groups[1:]:
+                    if len(group) == 0:
+                        continue
 
-                if kw == "max-shift":
-                    MAX_NOTE_SHIFT = convert_int(val, lineno)
+                    (kw, val) = kwval(group, lineno)
 
-                elif kw == "shift-cost":
-                    NOTE_SHIFT_COST = convert_int(val, lineno)
+                    if kw == "max-shift":
+                        self.max_note_shift = convert_int(val, lineno)
 
-                elif kw == "extend-up":
-                    if val.upper() == "Y":
-                        EXTEND_NOTE_UP = True
-                    else:
-                        EXTEND_NOTE_UP = False
-            continue
+                    elif kw == "shift-cost":
+                        self.note_shift_cost = convert_int(val, lineno)
 
+                    elif kw == "extend-up":
+                        if val.upper() == "Y":
+                            self.extend_note_up = True
+                        else:
+                            self.extend_note_up = False
+                continue
 
-        if cmd == "keyboard-range":
-            for group in groups[1:]:
-                if len(group) == 0:
-                    continue
 
-                (kw, val) = kwval(group, lineno)
+            if cmd == "keyboard-range":
+                for group in groups[1:]:
+                    if len(group) == 0:
+                        continue
 
-                if kw == "low-key":
-                    key = jmidi.notenum(val)
-                    if key == None:
-                        print(("Line %d: expecting note name, got '%s'." % (lineno, val)), file=sys.stderr)
-                        sys.exit(1)
-                    LO_KEY = key
-                    # print("LO_KEY", key, file=sys.stderr)
+                    (kw, val) = kwval(group, lineno)
 
-                elif kw == "high-key":
-                    key = jmidi.notenum(val)
-                    if key == None:
-                        print(("Line %d: expecting note name, got '%s'." % (lineno, val)), file=sys.stderr)
-                        sys.exit(1)
-                    HI_KEY = key
-            continue
-
-        # sample filename format (the parts we need to know)
-
-        if cmd == "format":
-            for group in groups[1:]:
-
-                (kw, val) = kwval(group, lineno)
-
-                if kw == "layer-loc":
-                    ival = convert_int(val, lineno)
-                    if ival > 0:
-                        ival -= 1
-                    LAYER_LOC = ival
-
-                elif kw == "note-loc":
-                    ival = convert_int(val, lineno)
-                    if ival > 0:
-                        ival -= 1
-                    NOTE_LOC = ival
-            continue
-
-        if cmd == "lowest-level":
-            LOWEST_LEVEL = convert_int(groups[1], lineno)
-            if (LOWEST_LEVEL < 0):
-                print(("Line %d: lowest-level must not be negative." % (lineno, groups[1:])), file=sys.stderr)
-            continue
-
-        if cmd == "layer":
-            if len(groups) < 2:
-                print(("Line %d: expecting layer name." % (lineno)), file=sys.stderr)
-                sys.exit(1)
+                    if kw == "low-key":
+                        key = jmidi.notenum(val)
+                        if key == None:
+                            print(("Line %d: expecting note name, got '%s'." % (lineno, val)), file=sys.stderr)
+                            sys.exit(1)
+                        self.lo_key = key
+                        # print("LO_KEY", key, file=sys.stderr)
 
-            lname       = groups[1]
-            latten      = 0
-            llevel      = 0     # no adjustment
-            lvel        = -1
-            lrange      = -1
+                    elif kw == "high-key":
+                        key = jmidi.notenum(val)
+                        if key == None:
+                            print(("Line %d: expecting note name, got '%s'." % (lineno, val)), file=sys.stderr)
+                            sys.exit(1)
+                        self.hi_key = key
+                continue
 
-            gl.lnamelen = max(gl.lnamelen, len(lname))
+            # sample filename format (the parts we need to know)
 
-            for group in groups[2:]:
-                if len(group) == 0:
-                    continue
+            if cmd == "format":
+                for group in groups[1:]:
 
-                (kw, val) = kwval(group, lineno)
+                    (kw, val) = kwval(group, lineno)
 
-                if kw == "vel":
-                    if lvmode and lvmode != "vel":
-                        print(("Line %d: can't mix 'vel' and 'vel-range' in same sampleset." % (lineno)), file=sys.stderr)
-                        sys.exit(1)
-                    lvel = convert_int(val, lineno)
-                    lvmode = "vel"
+                    if kw == "layer-loc":
+                        ival = convert_int(val, lineno)
+                        if ival > 0:
+                            ival -= 1
+                        self.layer_loc = ival
 
-                elif kw == "vel-range":
-                    if lvmode and lvmode != "range":
-                        print(("Line %d: can't mix 'vel' and 'vel-range' in same sampleset." % (lineno)), file=sys.stderr)
-                        sys.exit(1)
-                    lrange = convert_int(val, lineno)
-                    lvmode = "range"
+                    elif kw == "note-loc":
+                        ival = convert_int(val, lineno)
+                        if ival > 0:
+                            ival -= 1
+                        self.note_loc = ival
+                continue
+
+            if cmd == "lowest-level":
+                self.lowest_level = convert_int(groups[1], lineno)
+                if (self.lowest_level < 0):
+                    print(("Line %d: lowest-level must not be negative." % (lineno, groups[1:])), file=sys.stderr)
+                continue
+
+            if cmd == "layer":
+                if len(groups) < 2:
+                    print(("Line %d: expecting layer name." % (lineno)), file=sys.stderr)
+                    sys.exit(1)
+
+                lname       = groups[1]
+                latten      = 0
+                llevel      = 0     # no adjustment
+                lvel        = -1
+                lrange      = -1
+
+                self.lnamelen = max(self.lnamelen, len(lname))
+
+                for group in groups[2:]:
+                    if len(group) == 0:
+                        continue
+
+                    (kw, val) = kwval(group, lineno)
+
+                    if kw == "vel":
+                        if lvmode and lvmode != "vel":
+                            print(("Line %d: can't mix 'vel' and 'vel-range' in same sampleset." % (lineno)), file=sys.stderr)
+                            sys.exit(1)
+                        lvel = convert_int(val, lineno)
+                        lvmode = "vel"
+
+                    elif kw == "vel-range":
+                        if lvmode and lvmode != "range":
+                            print(("Line %d: can't mix 'vel' and 'vel-range' in same sampleset." % (lineno)), file=sys.stderr)
+                            sys.exit(1)
+                        lrange = convert_int(val, lineno)
+                        lvmode = "range"
 
-                elif kw == "atten":
-                    latten = convert_int(val, lineno)
+                    elif kw == "atten":
+                        latten = convert_int(val, lineno)
+
+                    elif kw == "level":
+                        if val == "auto":
+                            llevel = None
+                        else:
+                            llevel = convert_int(val, lineno)
+
+                cfg_layers.append((lname, lvel, lrange, latten, llevel))
+
+                continue
+        #}
+
+        # Are we assigning velocities?
+
+        if lvmode == "vel":
+
+            # No.  Check the assignments.
+            last_lvel = -1
+            for (lname, lvel, lrange, latten, llevel) in cfg_layers:
+                if lvel == -1:
+                    print(("No velocity assigned for layer '%s'" % lname), file=sys.stderr)
+                    sys.exit(1)
+                if lvel <= last_lvel:
+                    print(("Velocity for layer '%s' must be higher than previous layer" % lname), file=sys.stderr)
+                    sys.exit(1)
+                last_lvel = lvel
 
-                elif kw == "level":
-                    llevel = convert_int(val, lineno)
+            if last_lvel != 127:
+                print(("Warning: velocity for top layer '%s' should be 127" % lname), file=sys.stderr)
 
-            layers.append((lname, lvel, lrange, latten, llevel))
+        else:
+        #{
+            # We're assigning velocities.
+
+            # Find how many layers need ranges assigned,
+            # and how much room is left
+            count = 0
+            unused  = 127
+            for (lname, lvel, lrange, latten, llevel) in cfg_layers:
+                if lrange == -1:
+                    count += 1
+                else:
+                    unused -= lrange
 
-            continue
-    #}
+            if unused < 0:
+                print("Total of velocity ranges must not exceed 127", file=sys.stderr)
+                sys.exit(1)
 
-    # Are we assigning velocities?
+            # allocate unused velocity range to layers without vel-range specs
+            ix = 0
+            for (lname, lvel, lrange, latten, llevel) in cfg_layers:
+                if lrange == -1:
+                    lrange = unused / count
+                    count -= 1
+                    unused -= lrange
+                    cfg_layers[ix] = (lname, lvel, lrange, latten, llevel)
+                ix += 1
+
+            # assign specific max velocities to each
+            ix = 0
+            last_lvel = 0
+            for (lname, lvel, lrange, latten, llevel) in cfg_layers:
+                last_lvel += lrange
+                cfg_layers[ix] = (lname, last_lvel, lrange, latten, llevel)
+                if print_map:
+                    print(("Layer %*s: velocity %3d, range %3d, level %s"
+                        % (self.lnamelen, lname, last_lvel, lrange,
+                            "auto" if llevel == None else "%3d cB" % llevel)),
+                        file=sys.stderr)
+                ix += 1
 
-    if lvmode == "vel":
+        #}
 
-        # No.  Check the assignments.
-        last_lvel = -1
-        for (lname, lvel, lrange, latten, llevel) in layers:
-            if lvel == -1:
-                print(("No velocity assigned for layer '%s'" % lname), file=sys.stderr)
+        # the keys a variant maps must be on the keyboard, and stay
+        # MIDI notes once transposed
+        for ((vname, opts), vline) in zip(self.sfz_variants, variant_lines):
+            lo_key = opts.get("lo_key", self.lo_key)
+            hi_key = opts.get("hi_key", self.hi_key)
+            for key in (lo_key, hi_key):
+                if key < self.lo_key or key > self.hi_key:
+                    print(("Line %d: variant key %s outside keyboard-range %s-%s."
+                        % (vline, jmidi.mnote_name(key, None), jmidi.mnote_name(self.lo_key, None),
+                            jmidi.mnote_name(self.hi_key, None))), file=sys.stderr)
+                    sys.exit(1)
+            if lo_key > hi_key:
+                print(("Line %d: variant low-key is above high-key." % (vline)), file=sys.stderr)
                 sys.exit(1)
-            if lvel <= last_lvel:
-                print(("Velocity for layer '%s' must be higher than previous layer" % lname), file=sys.stderr)
+            transpose = opts.get("transpose", 0)
+            if lo_key + transpose < 0 or hi_key + transpose > jmidi.max_mnote:
+                print(("Line %d: variant transpose %d moves keys outside MIDI notes 0-%d."
+                    % (vline, transpose, jmidi.max_mnote)), file=sys.stderr)
                 sys.exit(1)
-            last_lvel = lvel
-
-        if last_lvel != 127:
-            print(("Warning: velocity for top layer '%s' should be 127" % lname), file=sys.stderr)
-
-    else:
-    #{
-        # We're assigning velocities.
-
-        # Find how many layers need ranges assigned,
-        # and how much room is left
-        count = 0
-        unused  = 127
-        for (lname, lvel, lrange, latten, llevel) in layers:
-            if lrange == -1:
-                count += 1
-            else:
-                unused -= lrange
 
-        if unused < 0:
-            print("Total of velocity ranges must not exceed 127", file=sys.stderr)
+        # build the layer table
+        for (lname, lvel, lrange, latten, llevel) in cfg_layers:
+            if llevel == None:
+                self.auto_levels[lname] = latten
+                llevel = 0
+            self.layers.append([lname, lvel, latten, llevel, 0, 0, 0, 0])
+
+        if self.layer_loc != None and self.note_loc != None:
+            self.name_format = NameFormat(DELIMS, self.layer_loc, self.note_loc)
+
+    # The keyboard grid: a group number for each layer and key (-1 for none)
+
+    def build_grid(self):
+
+        self.layernum = {}
+        for layer in range(0, len(self.layers)):
+            self.layernum[self.layers[layer][LNAME]] = layer
+
+        return np.full((len(self.layers), self.hi_key+self.max_note_shift+1), -1, dtype=np.int32)
+
+    # Return (sampfname, entry) for each sample matching a file spec.
+    # For a sample file, entry is None.  A container manifest (.sfm, written
+    # by jCutSamps -c) gives an entry for each note in the container, with
+    # its original name and its sample range in the container.
+
+    def sample_files(self, arg, errors):
+        found = []
+        containers = set()
+
+        (arg, instrument) = jlib.split_arg(arg)
+
+        for fname in glob.glob(arg):
+            if fname.endswith(".sfl"):
+                try:
+                    lib = jlib.Library(fname)
+                    for row in lib.samples(instrument):
+                        entry = dict(row)
+                        sampfname = lib.path(row["file"]).replace("\\", "/")
+                        if row["offset"] is not None:
+                            containers.add(sampfname)
+                        found.append((sampfname, entry))
+                    lib.close()
+                except sqlite3.Error as msg:
+                    errors.append("Can't read sample library %s: %s" % (fname, str(msg)))
+                continue
+
+            if not fname.endswith(".sfm"):
+                found.append((fname, None))
+                continue
+
+            folder = os.path.dirname(fname)
+            try:
+                with open(fname, "r", newline="") as mfile:
+                    for row in csv.DictReader(mfile):
+                        sampfname = os.path.join(folder, row["container"]).replace("\\", "/")
+                        containers.add(sampfname)
+                        entry = {
+                            "name":   row["name"],
+                            "offset": int(row["offset"]),
+                            "end":    int(row["end"]),
+                            }
+                        found.append((sampfname, entry))
+            except (IOError, KeyError, ValueError) as msg:
+                errors.append("Can't read manifest %s: %s" % (fname, str(msg)))
+
+        # scan the header of each sample file (or container), or get it
+        # from the metadata index if the file hasn't changed
+        paths = sorted(set(f for (f, entry) in found))
+        info = self.meta.scan(paths, "wave", jmeta.wave_info, errors)
+
+        return [(f, entry, info[f]) for (f, entry) in found if f in info]
+
+    def load_filenames(self, args, print_map=True):
+
+        warnings = []
+        errors = []
+        samps = []
+
+        for arg in args:
+        #{
+            for (sampfname, entry, info) in self.sample_files(arg, errors):
+
+                samp = Samp()
+                samp.offset = None
+                samp.end = None
+                samp.tune = 0
+                samp.shift = 0
+                samp.delay = 0.0
+                samp.rate = info["rate"]
+                samp.frames = info["frames"]
+                samp.loops = info["loops"]
+                if entry:
+                    samp.offset = entry["offset"]
+                    samp.end = entry["end"]
+                    samp.loops = []     # the container's loops aren't the note's
+                    basename = entry["name"]
+                else:
+                    basename = sampfname
+
+                if entry and "layer" in entry:
+                    # from a sample library: no need to parse the name
+                    (layername, mnote, rrob) = (entry["layer"], entry["note"], entry["rr"])
+                else:
+                    if self.name_format == None:
+                        print("%s: no 'format' line giving the layer and note locations" % self.cfname,
+                            file=sys.stderr)
+                        sys.exit(1)
+                    try:
+                        (layername, notespec, mnote, rrob) = self.name_format.parse(basename)
+                    except ValueError as msg:
+                        errors.append(str(msg))
+                        continue
+
+                # print("MNOTE:", mnote, "XPOSE:", self.transpose, file=sys.stderr)
+                mnote = mnote + self.transpose
+
+                # print(sampfname, mnote, layername, jmidi.mnote_name(mnote)[0])
+                samp.fname = sampfname
+                samp.name = basename        # the note's own name, even in a container
+                samp.mnote = mnote
+                samp.notename = jmidi.mnote_name(mnote, pad=None)
+                samp.layername = layername
+                samp.rrob = rrob
+                if layername not in self.layernum:
+                    warnings.append("Sample for unconfigured layer '%s': %s"
+                        % (samp.layername, samp.fname))
+                    continue
+                samp.layer = self.layernum[layername]
+
+                if samp.layer == None:
+                    warnings.append("Sample for missing layer '%s': %s"
+                        % (samp.layername, samp.fname))
+                    continue
+
+                x = self.lo_key - self.max_note_shift
+                if (samp.mnote < max(0, self.lo_key - self.max_note_shift)
+                    or samp.mnote > self.hi_key + self.max_note_shift):
+
+                    warnings.append("Sample outside useful note range (%s): %s"
+                        % (samp.notename, samp.fname))
+                    continue
+
+                samp.char = None
+                samps.append(samp)
+
+        #}
+
+        if self.dedup != None:
+            samps = self.drop_duplicates(samps, warnings)
+        for samp in samps:
+            self.grid[samp.layer][samp.mnote] = self.table.add(samp)
+
+        self.table.freeze()
+
+        rates = set(samp.rate for samp in self.table.samps)
+        if len(rates) > 1:
+            warnings.append("Samples have different sample rates: %s"
+                % ", ".join(str(rate) for rate in sorted(rates)))
+
+        if errors:
+            for msg in errors:
+                print(msg, file=sys.stderr)
             sys.exit(1)
 
-        # allocate unused velocity range to layers without vel-range specs
-        ix = 0
-        for (lname, lvel, lrange, latten, llevel) in layers:
-            if lrange == -1:
-                lrange = unused / count
-                count -= 1
-                unused -= lrange
-                layers[ix] = (lname, lvel, lrange, latten, llevel)
-            ix += 1
-
-        # assign specific max velocities to each
-        ix = 0
-        last_lvel = 0
-        for (lname, lvel, lrange, latten, llevel) in layers:
-            last_lvel += lrange
-            layers[ix] = (lname, last_lvel, lrange, latten, llevel)
+        if warnings:
+            for msg in warnings:
+                print("Warning:", msg, file=sys.stderr)
+
+        # print the samples, along with a character to assigned for
+        # showing the key map in showmap().
+
+        if print_map:
+            print("KEYBOARD MAPPING", file=self.ofile)
+            print(file=self.ofile)
+            print("Sample Table -- each character represents a sample:", file=self.ofile)
+
+        sampnum = 0
+        sampchars = build_sampchars()
+
+        for layer in range(len(self.layers)-1, -1, -1):
+            if print_map:
+                print(("  Layer %*s vel %3d: " % (self.lnamelen, self.layers[layer][LNAME], self.layers[layer][LVEL])),
+                    end=" ", file=self.ofile)
+            for mnote in range(self.lo_key, self.hi_key+1):
+                samps = self.table.group(self.grid[layer][mnote])
+
+                if samps:
+                    samp = samps[0]
+                    if samp.char == None:
+                        samp.char = sampchars[sampnum]
+                        sampnum += 1
+                        if sampnum >= len(sampchars):
+                            sampnum = 0
+                    if print_map:
+                        print("%3s=%c" % (samp.notename, samp.char), end="", file=self.ofile)
             if print_map:
-                print(("Layer %*s: velocity %3d, range %3d, level %3d cB"
-                    % (gl.lnamelen, lname, last_lvel, lrange, llevel)),
+                print(file=self.ofile)
+
+        print(file=self.ofile)
+
+    def distance(self, torow, tocol, fromrow, fromcol):
+        row_dist = (abs(torow - fromrow) * self.layer_shift_cost) * 2
+        col_dist = (abs(tocol - fromcol) * self.note_shift_cost) * 2
+
+        if torow > fromrow and self.extend_layer_up:
+            row_dist += 1
+        elif torow < fromrow and not self.extend_layer_up:
+            row_dist += 1
+
+        if tocol > fromcol and self.extend_note_up:
+            col_dist += 1
+        elif tocol < fromcol and not self.extend_note_up:
+            col_dist += 1
+
+        # print("(", fromrow, fromcol, ")", end="")
+        # print(torow, fromrow, "=>", row_dist, "|", tocol, fromcol, "=>", col_dist)
+        return col_dist + row_dist
+
+    # Map every (layer, key) to the nearest sample group, by distance().
+    #
+    # For each layer, the candidates for every key are laid out as arrays of
+    # (layer shift, note shift) by key, so all keys are costed at once.
+    # Ties go to the same neighbor that the original row-by-row scan picked:
+    # it kept its neighbors in a list (those in the first window by layer
+    # then note, later ones by note then layer), and the last one in the
+    # list won.
+
+    def assign_keys(self):
+
+        # fix bounds of search
+        row_min = 0
+        row_max = len(self.layers)-1
+        col_min = self.lo_key
+        col_max = self.hi_key
+
+        keymap = self.build_grid()
+
+        ncols = self.grid.shape[1]
+        occupied = self.grid >= 0
+
+        cols = np.arange(col_min, col_max+1)
+        shifts = np.arange(-self.max_note_shift, self.max_note_shift+1)
+        first_new = col_min + self.max_note_shift    # first column added after the first window
+        big = 1 << 10                           # more than any layer or key number
+
+        for row in range(row_min, row_max+1):
+        #{
+            rows = np.arange(max(row - self.max_layer_shift, row_min),
+                             min(row + self.max_layer_shift, row_max) + 1)
+
+            # (rows, shifts, cols) arrays of candidate layer and key
+            rr = rows[:, None, None]
+            cc = cols[None, None, :] + shifts[None, :, None]
+            cc = np.broadcast_to(cc, (len(rows), len(shifts), len(cols)))
+            inside = (cc >= 0) & (cc < ncols)
+            valid = np.zeros(cc.shape, dtype=bool)
+            valid[inside] = occupied[np.broadcast_to(rr, cc.shape)[inside], cc[inside]]
+
+            # distance only depends on the layer and note shifts
+            dist = np.array([[self.distance(r, col_min + shift, row, col_min) for shift in shifts]
+                             for r in rows])[:, :, None]
+
+            order = np.where(cc < first_new, rr * big + cc, (big + cc) * big + rr)
+            score = np.where(valid, dist.astype(np.int64) * big**3 - order, np.iinfo(np.int64).max)
+
+            score = score.reshape(-1, len(cols))
+            best = np.argmin(score, axis=0)
+            found = score[best, np.arange(len(cols))] != np.iinfo(np.int64).max
+            best_rr = np.broadcast_to(rr, cc.shape).reshape(-1, len(cols))[best, np.arange(len(cols))]
+            best_cc = cc.reshape(-1, len(cols))[best, np.arange(len(cols))]
+
+            keymap[row, cols] = np.where(found, self.grid[best_rr, best_cc], -1)
+        #}
+
+        self.grid = keymap
+
+    def showmap(self, keymap):
+        layerdata = keymap.layers
+
+        print("Map Table: each column is for a MIDI note.  Each row is for a MIDI velocity range.", file=self.ofile)
+        print("Each character in the table is the charater for a sample, as shown in the section above.", file=self.ofile)
+        print(file=self.ofile)
+
+        # Generate heading showing "piano keyboard" in three lines:
+        # first line is octave number
+        # second line is key name, omitting sharp or flat
+        # third line is "b" for flats and " " for naturals
+        #
+        # Example:
+        #    111111111111222222222222333333333333444444444444...
+        #    CDDEEFGGAABBCDDEEFGGAABBCDDEEFGGAABBCDDEEFGGAABB...
+        #     b b  b b b  b b  b b b  b b  b b b  b b  b b b ...
+
+        octave_line = note_line = sharpflat_line = ""
+        for col in range(self.lo_key, self.hi_key+1):
+            notename = jmidi.mnote_name(col, pad=None)
+            note_line += notename[0]
+            if notename[1] == "b":
+                sharpflat_line += "b"
+                octave = notename[2]
+            else:
+                sharpflat_line += " "
+                octave = notename[1]
+            octave_line += octave
+
+        # print("keyboard")
+        print(note_line, file=self.ofile)
+        print(sharpflat_line, file=self.ofile)
+        print(octave_line, file=self.ofile)
+        print(file=self.ofile)
+
+        # print key assignments
+
+        for row in range(len(layerdata)-1, -1, -1):
+            line = ""
+            for col in range(self.lo_key, self.hi_key+1):
+                samps = keymap.table.group(keymap.grid[row][col])
+                if samps:
+                    samp = samps[0]
+                    if samp.layer == row and samp.mnote == col:
+                        line += " "
+                    elif samp.char:
+                        line += samp.char
+                    else:
+                        line += "!"
+                else:
+                    line += "!"
+            print(("%s Layer %-6s v=%03d"
+                % (line, layerdata[row][LNAME], layerdata[row][LVEL])),
+                file=self.ofile)
+
+        print(file=self.ofile)
+        print("Key:", file=self.ofile)
+        print("  space = unity-mapped key (and not borrowed from another layer)", file=self.ofile)
+        print("  !     = unmapped key", file=self.ofile)
+        print("  anything else: see Sample Table above", file=self.ofile)
+
+    # The ampeg_release opcode for regions starting at each key, from the
+    # first of the release ranges (which go from high to low) at or below it.
+
+    def release_table(self):
+        releases = []
+        for key in range(self.hi_key + self.max_note_shift + 1):
+            opcode = ""
+            for (relnote, relval) in self.release_ranges:
+                if key >= relnote:
+                    opcode = "ampeg_release=%s " % relval
+                    break
+            releases.append(opcode)
+        return releases
+
+    # Render an .sfz file from a keymap, returning its text.  transpose
+    # moves the whole map up or down by that many keys, and lo_key and
+    # hi_key limit it to part of the keyboard.
+    #
+    # The file is built as a list of lines and joined once at the end.
+
+    def emit_map(self, keymap, crossfade=False, transpose=0, lo_key=None, hi_key=None):
+        if lo_key == None:
+            lo_key = self.lo_key
+        if hi_key == None:
+            hi_key = self.hi_key
+        lo_key = max(lo_key, self.lo_key)
+        hi_key = min(hi_key, self.hi_key)
+
+        if crossfade:
+            layerdata = crossfade_layers(keymap.layers)
+        else:
+            layerdata = keymap.layers
+
+        names = ["%-3s" % jmidi.mnote_name(key + transpose, None)
+            for key in range(self.hi_key + self.max_note_shift + 1)]
+        releases = self.release_table()
+
+        loVel = 1
+        lprevl = self.lowest_level
+        lines = []
+
+        if len(self.sfz_headers):
+            # print("HEADERS:", self.sfz_headers)
+            lines.extend(self.sfz_headers)
+
+        if len(self.sfz_controls):
+            # print("CONTROLS:", self.sfz_controls
+            lines.extend(["", "<control>"] + self.sfz_controls)
+
+        if len(self.sfz_globals):
+            # print("GLOBALS:", self.sfz_globals)
+            lines.extend(["", "<global>"] + self.sfz_globals)
+
+        if len(self.sfz_masters):
+            # print("MASTERS:", self.sfz_masters)
+            lines.extend(["", "<master>"] + self.sfz_masters)
+
+        # Emit <group> for each velocity layer and <region> for each sample in it
+        for row in range(0, len(layerdata)):
+        #{
+            hiVel  = layerdata[row][LVEL]
+            latten = layerdata[row][LATTEN]
+            llevel = layerdata[row][LLEVEL]
+            xfin_lo = layerdata[row][LXFIN_LO]
+            xfin_hi = layerdata[row][LXFIN_HI]
+            xfout_lo = layerdata[row][LXFOUT_LO]
+            xfout_hi = layerdata[row][LXFOUT_HI]
+
+            # We needed this when we used sfk file to generate .sf2 file.
+            # Keep it in case it helps for debugging.
+            # print(file=self.ofile)
+            # print("VLAYER:%s:%3d:%3d:%2d" % (
+            #     layerdata[row][LNAME], loVel, hiVel, latten),       # %%% llevel
+            #     file=self.ofile)
+
+            group = ["<group> "]
+            if xfin_lo:
+                group.append("xfin_lovel=%d xfin_hivel=%d " % (xfin_lo, xfin_hi))
+            else:
+                group.append("lovel=%d " % loVel)
+            if xfout_lo:
+                group.append("xfout_lovel=%d xfout_hivel=%d " % (xfout_lo, xfout_hi))
+            else:
+                group.append("hivel=%d " % hiVel)
+
+            if (latten != 0):
+                group.append("volume=%f " % (-latten/10.0))
+            group.append("ampeg_release=%f " % self.release)
+            lines.extend(["", "".join(group)])
+
+            if (llevel != 0):
+                midVel = (hiVel + loVel) // 2
+                midLev = (llevel + lprevl) / 2
+                curve = ((loVel, lprevl), (midVel, midLev), (hiVel, llevel))
+                for (vel, lev) in curve:
+                    lines.append("amp_velcurve_%d=%f" % (vel, cB2scalefactor(-lev)))
+                for (vel, lev) in curve:
+                    lines.append(("// row %s velocity %3d level %3d cB, scale %f"
+                        % (layerdata[row][LNAME], vel, lev, cB2scalefactor(-lev))))
+                lprevl = llevel
+                lines.append("")
+
+            lastSamps = -1
+            grid = keymap.grid[row]
+
+            for col in range(lo_key, hi_key+1):
+                samps = grid[col]
+                if samps != lastSamps:
+                    if lastSamps >= 0:
+                        lines.extend(emit_keymap(keymap.table.group(lastSamps), firstKey, col-1,
+                            names, releases))
+                    lastSamps = samps
+                    firstKey = col
+
+            # handle last unfinished keymap
+            if lastSamps >= 0:
+                lines.extend(emit_keymap(keymap.table.group(lastSamps), firstKey, col,
+                    names, releases))
+
+            loVel = hiVel + 1
+        #}
+
+        if len(self.sfz_finals):
+            # print("FINALS:", self.sfz_finals)
+            lines.extend([""] + self.sfz_finals)
+
+        lines.append("")
+        return "\n".join(lines)
+
+    # With "tune" in the config, measure the pitch of each sample (or
+    # get it from the metadata index) and set samp.tune to the cents
+    # that correct it.  Samples that are off by more than tune_max are
+    # probably named for the wrong note, so they're left alone.
+
+    def tune_samples(self, warn=True):
+        if not self.tune:
+            return
+
+        jobs = []
+        for samp in self.table.samps:
+            mnote = samp.mnote - self.transpose
+            if samp.offset == None:
+                jobs.append((samp.fname, "freq %d" % mnote, (mnote,)))
+            else:
+                jobs.append((samp.fname, "freq %d@%d" % (mnote, samp.offset),
+                    (mnote, samp.offset, samp.end)))
+
+        errors = []
+        found = self.meta.analyze(jobs, jpitch.pitch_info, errors, processes=True)
+        if warn:
+            for msg in errors:
+                print("Warning:", msg, file=sys.stderr)
+
+        for (samp, (path, section, args)) in zip(self.table.samps, jobs):
+            freq = found.get((path, section), {}).get("freq")
+            if freq == None:
+                if warn:
+                    print("Warning: can't measure pitch of %s, not tuned" % samp.fname,
+                        file=sys.stderr)
+                continue
+            cents = jpitch.cents_off(freq, args[0])
+            if abs(cents) > self.tune_max:
+                if warn:
+                    print("Warning: %s is %+.0f cents from %s, not tuned"
+                        % (samp.fname, cents, jmidi.mnote_name(args[0], pad=None)), file=sys.stderr)
+                continue
+            samp.tune = -int(round(cents))
+
+    # With "find-loops" in the config, find a sustain loop in each sample
+    # that doesn't have one (or get it from the metadata index).  The
+    # files aren't changed; the loops only go into the sfz.
+
+    def find_loops(self, warn=True):
+        if self.loop_min == None:
+            return
+
+        jobs = []
+        samps = []
+        for samp in self.table.samps:
+            if samp.loops:
+                continue
+            section = "loop %g" % self.loop_min
+            if samp.offset == None:
+                jobs.append((samp.fname, section, (self.loop_min,)))
+            else:
+                jobs.append((samp.fname, "%s@%d" % (section, samp.offset),
+                    (self.loop_min, samp.offset, samp.end)))
+            samps.append(samp)
+
+        errors = []
+        found = self.meta.analyze(jobs, jloop.loop_info, errors, processes=True)
+        if warn:
+            for msg in errors:
+                print("Warning:", msg, file=sys.stderr)
+
+        for (samp, (path, section, args)) in zip(samps, jobs):
+            loop = found.get((path, section), {}).get("loop")
+            if loop == None:
+                if warn and (path, section) in found:
+                    print("Warning: no loop found in %s" % samp.fname, file=sys.stderr)
+                continue
+            samp.loops = [loop]
+
+    # With "align" in the config, line up the attacks of the samples of
+    # each note (see jalign), from their attack windows in the metadata
+    # index.  With mode=offset, the later ones start that much later in
+    # the file (offset=, to the nearest sample); with mode=delay, the
+    # earlier ones are delayed (delay=, to a fraction of a sample).
+
+    def align_samples(self, warn=True):
+        if self.align == None:
+            return
+
+        jobs = []
+        for samp in self.table.samps:
+            if samp.offset == None:
+                jobs.append((samp.fname, "attack", ()))
+            else:
+                jobs.append((samp.fname, "attack@%d" % samp.offset, (samp.offset, samp.end)))
+
+        errors = []
+        found = self.meta.analyze(jobs, jalign.attack_info, errors, processes=True)
+        if warn:
+            for msg in errors:
+                print("Warning:", msg, file=sys.stderr)
+
+        # the samples of each note, for each rate
+        byNote = {}
+        for (samp, (path, section, args)) in zip(self.table.samps, jobs):
+            if (path, section) in found:
+                byNote.setdefault((samp.rate, samp.mnote), []).append((samp, found[(path, section)]))
+        byRate = {}
+        for ((rate, mnote), group) in sorted(byNote.items(), key=lambda item: item[0]):
+            if len(group) > 1:
+                byRate.setdefault(rate, []).append(group)
+
+        for (rate, groups) in byRate.items():
+            shifts = jalign.align_groups([[info for (samp, info) in group] for group in groups],
+                rate, self.align_max)
+            for (group, lags) in zip(groups, shifts):
+                known = [lag for lag in lags if lag != None]
+                for ((samp, info), lag) in zip(group, lags):
+                    if lag == None:
+                        if warn:
+                            print("Warning: attack of %s doesn't match its note's, not aligned"
+                                % samp.fname, file=sys.stderr)
+                    elif self.align == "offset":
+                        samp.shift = int(round(lag - min(known)))
+                    else:
+                        samp.delay = round((max(known) - lag) / float(rate), 6)
+
+    # With "dedup" in the config, leave out samples that are duplicates
+    # of another of the same layer and note (see jdedup), so they don't
+    # count as round-robins.  Of each group, the one with the shortest
+    # name is kept (the note's name, for notes in a container).
+
+    def drop_duplicates(self, samps, warnings):
+        jobs = []
+        for samp in samps:
+            if samp.offset == None:
+                jobs.append((samp.fname, "fingerprint", ()))
+            else:
+                jobs.append((samp.fname, "fingerprint@%d" % samp.offset, (samp.offset, samp.end)))
+
+        errors = []
+        found = self.meta.analyze(jobs, jdedup.fingerprint_info, errors, processes=True)
+        warnings.extend(errors)
+
+        byNote = {}
+        for (ix, (path, section, args)) in enumerate(jobs):
+            if (path, section) in found:
+                byNote.setdefault((samps[ix].layer, samps[ix].mnote), []).append(ix)
+        dropped = set()
+        for ixs in byNote.values():
+            if len(ixs) < 2:
+                continue
+            prints = [jdedup.decode_print(found[jobs[ix][0:2]]) for ix in ixs]
+            for group in jdedup.duplicates(prints, self.dedup):
+                group = [ixs[gix] for gix in group]
+                keep = min(group, key=lambda ix: (len(os.path.basename(samps[ix].name)), samps[ix].name))
+                for ix in group:
+                    if ix != keep:
+                        warnings.append("Duplicate sample left out: %s (same as %s)"
+                            % (samps[ix].name, samps[keep].name))
+                        dropped.add(ix)
+
+        return [samp for (ix, samp) in enumerate(samps) if ix not in dropped]
+
+    # With "trim-tails" in the config, find where each sample falls
+    # below the threshold for good (or get it from the metadata index),
+    # and end it there.  Looped samples are left alone.
+
+    def trim_tails(self, warn=True):
+        if self.tail_db == None:
+            return
+
+        jobs = []
+        samps = []
+        for samp in self.table.samps:
+            if samp.loops:
+                continue
+            section = "tail %g" % self.tail_db
+            if samp.offset == None:
+                jobs.append((samp.fname, section, (self.tail_db,)))
+            else:
+                jobs.append((samp.fname, "%s@%d" % (section, samp.offset),
+                    (self.tail_db, samp.offset, samp.end)))
+            samps.append(samp)
+
+        errors = []
+        found = self.meta.analyze(jobs, jtail.tail_info, errors, processes=True)
+        if warn:
+            for msg in errors:
+                print("Warning:", msg, file=sys.stderr)
+
+        for (samp, (path, section, args)) in zip(samps, jobs):
+            if (path, section) in found:
+                samp.end = found[(path, section)]["end"]
+
+    # With "level=auto" layers in the config, measure the loudness of
+    # every sample (or get it from the metadata index).  A layer's level
+    # is how much quieter its samples are than the loudest layer's (the
+    # median of each), in cB.  The layer is played back that much louder
+    # (volume=), so its top velocity sounds as recorded, and the
+    # velocity curve brings its bottom down to the layer below.
+
+    def level_layers(self, warn=True):
+        if not self.auto_levels:
+            return
+
+        jobs = []
+        for samp in self.table.samps:
+            if samp.offset == None:
+                jobs.append((samp.fname, "loudness", ()))
+            else:
+                jobs.append((samp.fname, "loudness@%d" % samp.offset, (samp.offset, samp.end)))
+
+        errors = []
+        found = self.meta.analyze(jobs, jloud.loudness_info, errors, processes=True)
+        if warn:
+            for msg in errors:
+                print("Warning:", msg, file=sys.stderr)
+
+        loudness = {}
+        for (samp, (path, section, args)) in zip(self.table.samps, jobs):
+            lufs = found.get((path, section), {}).get("lufs")
+            if lufs != None:
+                loudness.setdefault(samp.layername, []).append(lufs)
+        medians = dict((lname, float(np.median(vals))) for (lname, vals) in loudness.items())
+        if not medians:
+            if warn:
+                print("Warning: can't measure the loudness of any samples, levels not set",
                     file=sys.stderr)
-            ix += 1
+            return
+        loudest = max(medians.values())
+
+        for layer in self.layers:
+            lname = layer[LNAME]
+            if lname not in self.auto_levels:
+                continue
+            if lname not in medians:
+                if warn:
+                    print("Warning: can't measure the loudness of layer %s, level not set" % lname,
+                        file=sys.stderr)
+                continue
+            level = int(round(10 * (loudest - medians[lname])))
+            layer[LLEVEL] = level
+            layer[LATTEN] = self.auto_levels[lname] - level
+            if warn:
+                print("Layer %*s: %6.1f LUFS, level %3d cB"
+                    % (self.lnamelen, lname, medians[lname], level), file=sys.stderr)
+
+    # Measurements of the samples the config asks for
+
+    def needs_analysis(self):
+        return (self.tune or self.tail_db != None or self.loop_min != None
+            or self.align != None or self.dedup != None or bool(self.auto_levels))
+
+    def analyze(self, warn=True):
+        self.tune_samples(warn)
+        self.find_loops(warn)
+        self.trim_tails(warn)
+        self.align_samples(warn)
+        self.level_layers(warn)
+
+    # Read the config (unless read_cfg is False and it's already been
+    # read), map the samples and write the .sfk and .sfz files.  Each file
+    # is rendered in memory and then written atomically, so a sampler
+    # reloading it never sees half of one.  Returns the files written.
+
+    def build(self, read_cfg=True):
+        if read_cfg:
+            self.process_cfg()
+
+        self.ofile = io.StringIO()
+        self.grid = self.build_grid()
+        self.table = SampleTable()
+        self.load_filenames(self.args)
+        self.analyze()
+        self.meta.save()
+        self.assign_keys()
+        keymap = Keymap(self.grid, self.table, self.layers)
+        self.keymap = keymap
+
+        # showmap is no longer needed now that we don't support .sf2,
+        # but the keymap might be nice to look at (in .sfk file.)
+        self.showmap(keymap)
+
+        # write sfz file, with crossfade if configured.
+        # Other variants are rendered from the same keymap.
+        # With crossfade, also write an sfz file without it.
+        variants = [(None, {"crossfade": self.crossfade})]
+        if self.crossfade:
+            variants.append(("no-xfade", {"crossfade": False}))
+        variants.extend(self.sfz_variants)
+
+        outputs = [self.sfname + ".sfk"]
+        for (name, opts) in variants:
+            if name == None:
+                zfname = self.sfname + ".sfz"
+            else:
+                zfname = self.sfname + "-" + name + ".sfz"
+                print("Output (sfz) file %s:" % name, zfname, file=sys.stderr)
+            jmeta.write_atomic(zfname, self.emit_map(keymap, **opts))
+            outputs.append(zfname)
+
+        jmeta.write_atomic(outputs[0], self.ofile.getvalue())
+        return outputs
+
+# The build manifest (<sfname>.sfb) records the inputs of the last
+# build -- the .sfc file's hash, the command line, and the size and
+# mtime of every file the sample arguments matched, and of the sample
+# files that libraries and manifests among them point to -- and the
+# outputs it wrote.  If none of them have changed there's nothing to do.
+
+_manifest_version = 2
+
+# The sample files a library (.sfl, only instrument's notes if given)
+# or manifest (.sfm) points to.  Any that can't be read are left for
+# the build to report.
+
+def referenced_files(fname, instrument=None):
+    paths = set()
+    try:
+        if fname.endswith(".sfl"):
+            lib = jlib.Library(fname)
+            for row in lib.samples(instrument):
+                paths.add(lib.path(row["file"]).replace("\\", "/"))
+            lib.close()
+        elif fname.endswith(".sfm"):
+            folder = os.path.dirname(fname)
+            with open(fname, "r", newline="") as mfile:
+                for row in csv.DictReader(mfile):
+                    paths.add(os.path.join(folder, row["container"]).replace("\\", "/"))
+    except (sqlite3.Error, IOError, KeyError):
+        pass
+    return sorted(paths)
+
+def build_inputs(cfname, args):
+    inputs = {"version": _manifest_version, "args": args, "files": {}}
+    with open(cfname, "rb") as cfgf:
+        inputs["sfc"] = hashlib.sha1(cfgf.read()).hexdigest()
+    for arg in args:
+        (arg, instrument) = jlib.split_arg(arg)
+        for fname in glob.glob(arg):
+            inputs["files"][fname] = jmeta.stamp(fname)
+            for path in referenced_files(fname, instrument):
+                try:
+                    inputs["files"][path] = jmeta.stamp(path)
+                except OSError:
+                    inputs["files"][path] = None
+    return inputs
+
+def up_to_date(mfname, inputs):
+    try:
+        with open(mfname, "r") as mfile:
+            manifest = json.load(mfile)
+        if manifest["inputs"] != inputs:
+            return False
+        for (fname, st) in manifest["outputs"].items():
+            if jmeta.stamp(fname) != st:
+                return False
+    except (IOError, OSError, ValueError, KeyError):
+        return False
+    return True
+
+def write_manifest(mfname, inputs, outputs):
+    manifest = {
+        "inputs":  inputs,
+        "outputs": dict((fname, jmeta.stamp(fname)) for fname in outputs),
+        }
+    try:
+        jmeta.write_atomic(mfname, json.dumps(manifest, sort_keys=True))
+    except (IOError, OSError) as msg:
+        print("Warning: can't write build manifest %s: %s" % (mfname, msg), file=sys.stderr)
+
+
+# Build one instrument, unless it's up to date.  Returns the exit
+# status (any errors have been reported).
+
+def build_instrument(sfname, args, meta, force=False):
+    ofname = sfname + ".sfk"
+    cfname = sfname + ".sfc"
+    zfname = sfname + ".sfz"
+    mfname = sfname + ".sfb"
+
+    try:
+        inputs = build_inputs(cfname, args)
+    except (IOError, OSError) as msg:
+        print(msg, file=sys.stderr)
+        return 1
+    if not force and up_to_date(mfname, inputs):
+        print("%s is up to date." % zfname, file=sys.stderr)
+        return 0
+
+    print("Input (control) file:", cfname, file=sys.stderr)
+    print("Output (keymap) file:", ofname, file=sys.stderr)
+    print("Output (sfz)    file:", zfname, file=sys.stderr)
 
-    #}
+    try:
+        outputs = MapBuilder(sfname, args, meta).build()
+    except IOError as msg:
+        print(msg, file=sys.stderr)
+        return 1
+    except SystemExit as status:
+        return status.code
+    write_manifest(mfname, inputs, outputs)
+    return 0
+
+# One job of a batch, in a worker process.  The index has already
+# been brought up to date, so the workers only read it.
+
+def batch_job(job):
+    (sfname, args, index_fname, force) = job
+    return build_instrument(sfname, args, jmeta.MetaIndex(index_fname), force)
+
+# Build each instrument listed in a batch file, one per line as
+# "<sfname> {sampfile}", in a pool of processes.  Returns the number
+# of instruments that failed.
+
+def build_batch(batch_fname, index_fname, force=False, workers=None):
+    jobs = []
+    with open(batch_fname, "r") as batchf:
+        for line in batchf:
+            words = shlex.split(line, comments=True)
+            if words:
+                jobs.append((words[0], words[1:]))
+
+    # scan the headers of all the instruments' samples first (and any
+    # analysis their configs ask for), so the workers share one
+    # up-to-date index.  Any problems are reported by the workers.
+    meta = jmeta.MetaIndex(index_fname)
+    errors = []
+    for (sfname, args) in jobs:
+        builder = MapBuilder(sfname, args, meta)
+        with contextlib.redirect_stderr(io.StringIO()):
+            try:
+                builder.process_cfg(print_map=False)
+                if builder.needs_analysis():
+                    builder.ofile = io.StringIO()
+                    builder.grid = builder.build_grid()
+                    builder.table = SampleTable()
+                    builder.load_filenames(args, print_map=False)
+                    builder.analyze(warn=False)
+                else:
+                    for arg in args:
+                        builder.sample_files(arg, errors)
+            except SystemExit:
+                pass
+    meta.save()
 
-    # build LAYER array
-    for (lname, lvel, lrange, latten, llevel) in layers:
-        LAYER.append([lname, lvel, latten, llevel, 0, 0, 0, 0])
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = [(sfname, args, index_fname, force) for (sfname, args) in jobs]
+        for (job, status) in zip(jobs, pool.map(batch_job, jobs)):
+            if status:
+                print("%s: failed" % job[0], file=sys.stderr)
+                failed += 1
 
+    print("%d instruments, %d failed" % (len(jobs), failed), file=sys.stderr)
+    return failed
 
-# Module initialization
 
 def usage(prog):
     print(file=sys.stderr)
     print("%s: create keyboard map for building a soundfont" % prog, file=sys.stderr)
     print(file=sys.stderr)
-    print("usage: %s <sfname> {sampfile}" % prog, file=sys.stderr)
+    print("usage: %s [-f] [-w] [-i <indexfile>] <sfname> {sampfile}" % prog, file=sys.stderr)
+    print("       %s -b [-f] [-j <jobs>] [-i <indexfile>] <batchfile>" % prog, file=sys.stderr)
     print(file=sys.stderr)
     print("  where:", file=sys.stderr)
     print("     <sfname>   specifies input and output:", file=sys.stderr)
     print("                   <sfname>.sfc is the input (config),", file=sys.stderr)
     print("                   <sfname>.sfk is the output (keymap).", file=sys.stderr)
     print("     {sampfile} is any number of sample filenames, with UNIX wildcards", file=sys.stderr)
+    print("                   or a sample library from jCutSamps -d, as <libfile>.sfl", file=sys.stderr)
+    print("                   or <libfile>.sfl:<instrument>", file=sys.stderr)
+    print("     -i <indexfile> caches sample file metadata in <indexfile>", file=sys.stderr)
+    print("                   (default <sfname>.sfi, or <batchfile>.sfi)", file=sys.stderr)
+    print("     -f         rebuilds even if nothing has changed since the last", file=sys.stderr)
+    print("                   build (as recorded in <sfname>.sfb)", file=sys.stderr)
+    print("     -w         keeps running, rebuilding whenever <sfname>.sfc or", file=sys.stderr)
+    print("                   the sample files change (^C to stop)", file=sys.stderr)
+    print("     -b         builds every instrument in <batchfile>, which has a", file=sys.stderr)
+    print("                   line \"<sfname> {sampfile}\" for each, in parallel", file=sys.stderr)
+    print("     -j <jobs>  sets the number of processes for -b (default: one per CPU)", file=sys.stderr)
     print(file=sys.stderr)
     print("  Output is ASCII text, and includes a char-graphic keyboard map layout", file=sys.stderr)
     print(file=sys.stderr)
@@ -1012,14 +1805,47 @@ def usage(prog):
 # Main
 
 if __name__ == "__main__":
-    global CROSSFADE
-    global TRANSPOSE
-    TRANSPOSE = 0
 
     args = sys.argv
     prog = args[0].split("\\")[-1]
     del args[0]
 
+    index_fname = None
+    force = False
+    watch = False
+    batch = False
+    workers = None
+    while args and args[0].startswith("-"):
+        if args[0] == "-f":
+            force = True
+            del args[0]
+        elif args[0] == "-w":
+            watch = True
+            del args[0]
+        elif args[0] == "-b":
+            batch = True
+            del args[0]
+        elif args[0] == "-i" and len(args) > 1:
+            index_fname = args[1]
+            del args[0:2]
+        elif args[0] == "-j" and len(args) > 1:
+            workers = int(args[1])
+            del args[0:2]
+        else:
+            usage(prog)
+
+    if batch:
+        if len(args) != 1 or watch:
+            usage(prog)
+        if index_fname == None:
+            index_fname = os.path.splitext(args[0])[0] + ".sfi"
+        try:
+            failed = build_batch(args[0], index_fname, force, workers)
+        except IOError as msg:
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+        sys.exit(1 if failed else 0)
+
     if len(args) < 2:
         usage(prog)
         sys.exit(1)
@@ -1027,69 +1853,34 @@ if __name__ == "__main__":
     sfname = args[0]
     del args[0]
 
-    ofname = sfname + ".sfk"
-    cfname = sfname + ".sfc"
-    zfname = sfname + ".sfz"
+    if index_fname == None:
+        index_fname = sfname + ".sfi"
+    meta = jmeta.MetaIndex(index_fname)
 
-    try:
-        gl.ofile = open(ofname, "w")
-        gl.sfzf  = open(zfname, "w")
-    except Exception as msg:
-        print(msg, file=sys.stderr)
-        if gl.ofile:
-            gl.ofile.close()
-        sys.exit(1)
-
-    print("Input (control) file:", cfname, file=sys.stderr)
-    print("Output (keymap) file:", ofname, file=sys.stderr)
-    print("Output (sfz)    file:", zfname, file=sys.stderr)
+    if not watch:
+        sys.exit(build_instrument(sfname, args, meta, force))
 
+    # Watch mode: build, then rebuild whenever the config or samples
+    # change, rereading the config only if it's the config that changed.
+    cfname = sfname + ".sfc"
+    mfname = sfname + ".sfb"
+    builder = MapBuilder(sfname, args, meta)
+    watcher = jwatch.Watcher([cfname] + [jlib.split_arg(arg)[0] for arg in args])
+    read_cfg = True
+    changed = set()
     try:
-        process_cfg(cfname, sfname)
-    except Exception as msg:
-        print(str(msg), file=sys.stderr)
-        gl.ofile.close()
-        gl.sfzf.close()
-        sys.exit(1)
-        
-    build_grid(gl.grid)
-    load_filenames(args)
-    assign_keys()
-
-    # showmap is no longer needed now that we don't support .sf2,
-    # but the keymap might be nice to look at (in .sfk file.)
-    showmap(gl.grid, LAYER)
-
-    if CROSSFADE:
-        # write sfz file with crossfade
-        emit_map(gl.grid, LAYER)
-        gl.sfzf.close()
-
-        # write another sfz file without crossfade
-        zfname = sfname + "-no-xfade.sfz"
-        print("Output (sfz) file without xfade:", zfname, file=sys.stderr)
-        try:
-            gl.sfzf  = open(zfname, "w")
-        except Exception as msg:
-            print(msg, file=sys.stderr)
-            gl.ofile.close()
-            sys.exit(1)
-
-        gl.grid = []
-        gl.samps = {}
-        LAYER = []
-        try:
-            process_cfg(cfname, sfname, print_map=False)
-            CROSSFADE = False
-            build_grid(gl.grid)
-            load_filenames(args, print_map=False)
-            assign_keys()
-        except Exception as msg:
-            print(msg, file=sys.stderr)
-            gl.ofile.close()
-            gl.sfzf.close()
-            sys.exit(1)
-
-    # build sfz file and (now unused) .sfk file layer sections
-    emit_map(gl.grid, LAYER)
-
+        while True:
+            try:
+                outputs = builder.build(read_cfg=read_cfg or cfname in changed)
+                write_manifest(mfname, build_inputs(cfname, args), outputs)
+                read_cfg = False
+            except (IOError, OSError) as msg:
+                print(msg, file=sys.stderr)
+                read_cfg = True
+            except SystemExit:
+                # the error has been reported; try again after the next change
+                read_cfg = True
+            print("Watching for changes...", file=sys.stderr)
+            changed = watcher.wait()
+    except KeyboardInterrupt:
+        watcher.close()
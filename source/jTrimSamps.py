@@ -11,10 +11,13 @@ import warnings
 import glob
 import os.path
 
+import numpy as np
+
 import jwave
 import jtime
 import jmidi
 import jtrans
+import jdither
 
 # Algorithm
 #   scan for peak (max of both channels)
@@ -39,6 +42,8 @@ _lead_crossings = 2             # Number of zero crossings to find start of note
 # Operating controls
 
 _dry_run        = False         # if True, don't actually create any files.
+_bits           = None          # -16: bits per sample to write, None = as recorded
+_dither         = "tpdf"        # dither for _bits: "none", "tpdf" or "shaped" (-16s)
 _debug          = False
 _verbose        = False
 
@@ -51,7 +56,7 @@ def find_peak(wave):
     while True:
         try:
             samp = wave.readSample()
-        except IndexError:
+        except (IndexError, EOFError):
             return wave.v2dB(peak)
         cur = abs(samp[0])
         if cur > peak:
@@ -72,7 +77,7 @@ def find_trigger(wave, trig_dB):
     while True:
         try:
             samp = wave.readSample()
-        except IndexError:
+        except (IndexError, EOFError):
             return 0
         if abs(samp[0]) > trigger:
             break;
@@ -157,7 +162,12 @@ def fade_in_and_copy_wave(iwave, outf, filter_start_sn, start_sn, peakdb):
     # set up output file
     owave = jwave.WaveChunk(outf = outf)
     owave.copyHeader(iwave)
-    owave.writeHeader(samp_count - start_sn)
+    if _bits and _bits < iwave.fmt.bitsPerSample:
+        owave.setBits(_bits)
+        owave.writeHeader(samp_count - filter_start_sn)
+        fade_in_and_convert(iwave, owave, filter_start_sn, start_sn, samp_count)
+        return
+    owave.writeHeader(samp_count - filter_start_sn)
 
     # fade-in
     samps = []
@@ -191,6 +201,23 @@ def fade_in_and_copy_wave(iwave, outf, filter_start_sn, start_sn, peakdb):
     owave.copySamples(iwave, start_sn, samp_count-1)
 
 
+# fade_in_and_copy_wave() for a smaller sample size: the same fade-in,
+# then everything requantized with dither, in numpy blocks.
+
+def fade_in_and_convert(iwave, owave, filter_start_sn, start_sn, samp_count):
+    requant = jdither.Requantizer(iwave.fmt.bitsPerSample, owave.fmt.bitsPerSample,
+        _dither, jdither.seed_for(owave.outf.name))
+
+    frames = iwave.readFrames(filter_start_sn, start_sn)
+    scale = np.arange(1, len(frames) + 1) / float(max(1, len(frames)))
+    frames = np.trunc(frames * scale[:, np.newaxis]).astype(np.int32)
+    owave.writeFrames(requant.process(frames))
+
+    block = 1 << 16
+    for sn in range(start_sn, samp_count, block):
+        owave.writeFrames(requant.process(iwave.readFrames(sn, min(sn + block, samp_count))))
+
+
 # find first zero crossing before trig_sn, where
 # the difference bewteen two successive samples is less than
 # twice the default noise level.
@@ -312,7 +339,7 @@ def process_sample(inf, outf):
     # 2) Starting from the trigger point, search backwards to find the
     #    first positive sloped zero crossing.  Search at most a fraction of a second.
 
-    window_sn = max(0, trig_sn - rate/10)
+    window_sn = max(0, trig_sn - rate//10)
     # start_sn = find_nth_zero(wave, trig_sn, window_sn, slope=1)
     start_sn = find_start(wave, trig_sn, window_sn, peakdb)
 
@@ -321,7 +348,7 @@ def process_sample(inf, outf):
 
     # Back up at most 1 msec to allow room for fade in
     rate = wave.fmt.sampleRate
-    filt_start_sn = max(0, start_sn - rate / 1000)
+    filt_start_sn = max(0, start_sn - rate // 1000)
 
     msec_trimmed = ((filt_start_sn * 1000) / rate)
     print("    trimming %3d msec" % msec_trimmed)
@@ -339,12 +366,14 @@ def usage(prog):
     print(file=sys.stderr)
     print("%s: Trim start of wave file" % prog, file=sys.stderr)
     print(file=sys.stderr)
-    print("  Usage: %s {[-f <outfolder>] {<wavefile>}}" % prog, file=sys.stderr)
+    print("  Usage: %s {[-f <outfolder>] [-16|-16s] {<wavefile>}}" % prog, file=sys.stderr)
     print(file=sys.stderr)
     print("where:", file=sys.stderr)
     print("  { x } means 'any number of x'", file=sys.stderr)
     print("  -f <outfolder> specifies the output folder for", file=sys.stderr)
     print("     sample files for following input wave files.", file=sys.stderr)
+    print("  -16 writes the following wave files with 16 bits per", file=sys.stderr)
+    print("     sample, with TPDF dither.  -16s uses noise-shaped dither.", file=sys.stderr)
     print("  <wavefile> is a wave file containing a single sample.", file=sys.stderr)
     print("     Unix-style globbing is permitted,", file=sys.stderr)
     print("     that is, you can use '*.wav' or 'samp*/my*foo.wav'.", file=sys.stderr)
@@ -356,6 +385,8 @@ def main(prog, args):
     global _fn_prefix
     global _fn_suffix
     global _folder
+    global _bits
+    global _dither
     global _pitchlog
 
     prof = False                # don't profile
@@ -381,6 +412,13 @@ def main(prog, args):
             del args[0]
             del args[0]
 
+        if len(args) > 1 and args[0] in ("-16", "-16s"):
+            _bits = 16
+            if args[0] == "-16s":
+                _dither = "shaped"
+            print("Writing 16 bits per sample, %s dither" % _dither)
+            del args[0]
+
         if len(args) < 1:
             return rCode
 
@@ -413,9 +451,9 @@ def main(prog, args):
                 else:
                     msecs_trimmed = process_sample(inf, outf)
             except IOError as msg:
-                print msg
+                print(msg)
                 if len(args) > 0:
-                    print "Skipping ..."
+                    print("Skipping ...")
                     continue
 
             max_msecs_trimmed = max(msecs_trimmed, max_msecs_trimmed)
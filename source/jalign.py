@@ -0,0 +1,291 @@
+#!/usr/bin/python3
+# Align the attacks of the samples of each note.
+#
+# Samples of the same note from different layers and round-robin takes
+# start a little earlier or later after their cut points, so when a
+# crossfade plays two of them at once they can partly cancel.  Here the
+# first moments of each sample (its attack window) are cross-correlated
+# with those of the loudest sample of the same note, with an FFT, and
+# the peak is interpolated to a fraction of a sample.  That gives how
+# much later each attack is than the reference.
+#
+# The attack windows are kept in the metadata index (see jmeta), so
+# only new or changed samples are read.  The correlations for all the
+# notes are done at once, as one array of FFTs.
+#
+# jMap uses this for "align" (see the .sfc), which shifts each sample
+# with offset= or delay=.  Run as a program, this trims the starts of
+# sample files so their attacks line up.
+
+import sys
+import os
+import os.path
+import re
+import glob
+import math
+import base64
+import concurrent.futures
+
+import numpy as np
+
+import jwave
+import jmeta
+
+# user configurable parameters
+
+_window_time    = 0.05          # seconds of attack compared
+_max_shift      = 5.0           # ms, furthest a sample is moved
+_min_score      = 0.5           # worst correlation to trust
+
+
+# The "attack" section of a sample's metadata (see jmeta): the first
+# _window_time seconds of the note (all channels summed), scaled to
+# 16 bits and base64 encoded so it fits in the index, and its peak
+# (a fraction of full scale)
+
+def attack_info(path, offset=0, end=None):
+    with open(path, "rb") as inf:
+        wave = jwave.WaveChunk(inf=inf)
+        wave.readHeader()
+        if end is None:
+            end = wave.numSamples - 1
+        stop = min(end + 1, offset + int(_window_time * wave.fmt.sampleRate))
+        samps = wave.readMono(offset, stop, None).astype(np.float64)
+        full = float(wave.fullScale + 1) * wave.fmt.numChan
+    peak = np.abs(samps).max(initial=0)
+    if peak:
+        samps = samps * (32767.0 / peak)
+    raw = np.rint(samps).astype("<i2").tobytes()
+    return {"window": base64.b64encode(raw).decode("ascii"), "peak": float(peak) / full}
+
+
+def decode_window(info):
+    return np.frombuffer(base64.b64decode(info["window"]), dtype="<i2").astype(np.float64)
+
+
+# Lags of windows against their references, in samples (later is
+# positive): pairs is a list of (window, reference) arrays.  Returns a
+# list with the lag (a float) for each pair, or None where the peak is
+# weaker than _min_score or further off than max_lag.
+#
+# The peak of the correlation is found to the nearest sample, and then
+# refined by bisecting on the slope of the correlation, evaluated as
+# the Fourier series it is, within the sample either side (rather than
+# fitting a parabola through three points, which pulls the answer
+# toward a whole sample).
+
+def lags(pairs, max_lag, block=256, steps=10):
+    if not pairs:
+        return []
+    n = max(max(len(win), len(ref)) for (win, ref) in pairs)
+    size = 1 << int(math.ceil(math.log(2 * n, 2)))
+    theta = 2 * np.pi * np.arange(size // 2 + 1) / size
+    weight = np.full(len(theta), 2.0)
+    weight[0] = weight[-1] = 1.0
+
+    result = []
+    for first in range(0, len(pairs), block):
+        chunk = pairs[first:first + block]
+        wins = np.zeros((len(chunk), size))
+        refs = np.zeros((len(chunk), size))
+        for (ix, (win, ref)) in enumerate(chunk):
+            wins[ix, :len(win)] = win
+            refs[ix, :len(ref)] = ref
+        cross = np.fft.rfft(wins, axis=1) * np.conj(np.fft.rfft(refs, axis=1))
+        corr = np.fft.irfft(cross, size, axis=1)
+
+        # lags -max_lag .. max_lag, normalized
+        corr = np.concatenate((corr[:, size - max_lag:], corr[:, :max_lag + 1]), axis=1)
+        norm = np.sqrt((wins * wins).sum(axis=1) * (refs * refs).sum(axis=1))
+        corr /= np.maximum(norm, 1e-12)[:, np.newaxis]
+        peaks = np.argmax(corr, axis=1)
+        best = corr[np.arange(len(chunk)), peaks]
+
+        # slope at each lag: the derivative of sum(Re(cross e^(i theta lag)))
+        cross = cross * weight * theta
+        def slope(lag):
+            return -(np.exp(1j * np.outer(lag, theta)) * cross).imag.sum(axis=1)
+
+        mid = (peaks - max_lag).astype(np.float64)
+        rising = slope(mid) > 0
+        lo = np.where(rising, mid, mid - 1)
+        hi = lo + 1
+        for step in range(steps):
+            mid = (lo + hi) / 2
+            rising = slope(mid) > 0
+            lo = np.where(rising, mid, lo)
+            hi = np.where(rising, hi, mid)
+        lag = (lo + hi) / 2
+
+        for (ix, peak) in enumerate(peaks):
+            if best[ix] < _min_score or peak == 0 or peak == 2 * max_lag:
+                result.append(None)
+            else:
+                result.append(float(lag[ix]))
+    return result
+
+
+# Lag of each sample's attack relative to the loudest of its note:
+# groups is a list of lists of "attack" sections, one list per note,
+# all at rate.  Returns a matching list of lists of lags (0 for the
+# reference, None where unknown).
+
+def align_groups(groups, rate, max_shift=None):
+    if max_shift is None:
+        max_shift = _max_shift
+    max_lag = max(2, int(max_shift * rate / 1000.0))
+    pairs = []
+    where = []
+    refs = []
+    for (gix, group) in enumerate(groups):
+        ref = max(range(len(group)), key=lambda ix: group[ix]["peak"])
+        refs.append(ref)
+        refwin = decode_window(group[ref])
+        for (ix, info) in enumerate(group):
+            if ix != ref:
+                pairs.append((decode_window(info), refwin))
+                where.append((gix, ix))
+    found = lags(pairs, max_lag)
+
+    result = [[None] * len(group) for group in groups]
+    for (gix, ref) in enumerate(refs):
+        result[gix][ref] = 0.0
+    for ((gix, ix), lag) in zip(where, found):
+        result[gix][ix] = lag
+    return result
+
+
+# Trim the first count samples off a sample file, into outfname (which
+# may be the same file).
+
+def trim_start(fname, outfname, count):
+    with open(fname, "rb") as inf:
+        wave = jwave.WaveChunk(inf=inf)
+        wave.readChunkDir()
+        smpl = wave.readSmpl()
+        if smpl and smpl[1]:
+            raise ValueError("has loops")
+        inf.seek(0)
+        wave.readHeader()
+        if count >= wave.numSamples:
+            raise ValueError("too short")
+        tmpname = "%s.tmp%d" % (outfname, os.getpid())
+        with open(tmpname, "wb") as outf:
+            owave = jwave.WaveChunk(outf=outf)
+            owave.copyHeader(wave)
+            owave.writeHeader(wave.numSamples - count)
+            owave.copySamples(wave, count, wave.numSamples - 1)
+    os.replace(tmpname, outfname)
+
+
+def trim_job(job):
+    (fname, outfname, count) = job
+    try:
+        trim_start(fname, outfname, count)
+        return None
+    except (IOError, OSError, ValueError, EOFError) as msg:
+        return str(msg)
+
+
+def usage(prog):
+    print(file=sys.stderr)
+    print("%s: trim the starts of samples so each note's attacks line up" % prog, file=sys.stderr)
+    print(file=sys.stderr)
+    print("  Usage: %s [-n] [-i <indexfile>] [-o <outfolder>] [-j <jobs>] {<wavefile>}" % prog, file=sys.stderr)
+    print(file=sys.stderr)
+    print("where:", file=sys.stderr)
+    print("  -n only shows how far each sample is off.", file=sys.stderr)
+    print("  -i <indexfile> caches the attack windows in <indexfile>.", file=sys.stderr)
+    print("  -o <outfolder> writes the trimmed files there, rather than", file=sys.stderr)
+    print("     replacing the originals.", file=sys.stderr)
+    print("  -j <jobs> sets the number of processes (default: one per CPU).", file=sys.stderr)
+    print("  Samples are grouped by the note number in their names, as", file=sys.stderr)
+    print("  jCutSamps.py writes them (<prefix>_<notenum>_...).  Each is", file=sys.stderr)
+    print("  trimmed to line up with the earliest attack of its note.", file=sys.stderr)
+    print(file=sys.stderr)
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    args = sys.argv
+    prog = args[0].split("\\")[-1]
+    del args[0]
+
+    dry_run = False
+    index = jmeta.MetaIndex()
+    folder = None
+    workers = None
+    while len(args) > 0 and args[0].startswith("-"):
+        if args[0] == "-n":
+            dry_run = True
+            del args[0]
+        elif len(args) > 1 and args[0] == "-i":
+            index = jmeta.MetaIndex(args[1])
+            del args[0:2]
+        elif len(args) > 1 and args[0] == "-o":
+            folder = args[1]
+            del args[0:2]
+        elif len(args) > 1 and args[0] == "-j":
+            workers = int(args[1])
+            del args[0:2]
+        else:
+            usage(prog)
+
+    fnames = []
+    for fspec in args:
+        fnames.extend(glob.glob(fspec))
+    if not fnames:
+        usage(prog)
+
+    errors = []
+    headers = index.scan(fnames, "wave", jmeta.wave_info, errors)
+    byNote = {}
+    for fname in fnames:
+        match = re.match(r"[^_]*_(\d{3})_", os.path.basename(fname))
+        if not match:
+            print("%s: no note number in the name, skipped" % fname, file=sys.stderr)
+        elif fname in headers:
+            key = (int(match.group(1)), headers[fname]["rate"])
+            byNote.setdefault(key, []).append(fname)
+
+    found = index.analyze([(fname, "attack", ()) for fname in fnames if fname in headers],
+        attack_info, errors, workers, processes=True)
+    for msg in errors:
+        print(msg, file=sys.stderr)
+    index.save()
+
+    # all the notes at each rate at once
+    byRate = {}
+    for ((mnote, rate), group) in sorted(byNote.items()):
+        group = [fname for fname in group if (fname, "attack") in found]
+        if len(group) > 1:
+            byRate.setdefault(rate, []).append(group)
+    aligned = []
+    for (rate, groups) in sorted(byRate.items()):
+        shifts = align_groups([[found[(fname, "attack")] for fname in group] for group in groups], rate)
+        aligned.extend(zip(groups, shifts))
+
+    jobs = []
+    for (group, shifts) in aligned:
+        first = min(lag for lag in shifts if lag is not None)
+        for (fname, lag) in zip(group, shifts):
+            if lag is None:
+                print("%s: attack doesn't match, left alone" % fname)
+                continue
+            count = int(round(lag - first))
+            print("%s: %+7.2f samples, trim %d" % (fname, lag, count))
+            if count and not dry_run:
+                outfname = fname
+                if folder:
+                    outfname = os.path.join(folder, os.path.basename(fname))
+                jobs.append((fname, outfname, count))
+
+    failed = 0
+    if jobs:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            for (job, msg) in zip(jobs, pool.map(trim_job, jobs)):
+                if msg is not None:
+                    print("%s: %s, skipped" % (job[0], msg), file=sys.stderr)
+                    failed += 1
+    print("%d files, %d trimmed, %d skipped" % (len(fnames), len(jobs) - failed, failed), file=sys.stderr)
@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+# Find duplicate samples.
+#
+# Cutting the same recording twice, or copying samples between
+# folders, leaves the same note in more than one file (jCutSamps names
+# the second one with a -1 suffix, which jMap takes for a round-robin).
+# Here each sample gets a fingerprint: the first _print_time seconds
+# are cut into frames, the energy of each frame is summed in
+# third-octave bands, and each bit says whether the difference between
+# two neighbouring bands grew or shrank since the frame before.  That
+# doesn't change with the level, so a sample that's been normalized
+# still matches, and a sample cut a little differently differs in only
+# a few bits.  Bands more than _floor_db below the frame's loudest
+# count as silent, so noise there doesn't change the bits.  Two
+# samples are duplicates if their fingerprints differ in no more than
+# max_distance of the bits.
+#
+# The fingerprints are kept in the metadata index (see jmeta), so only
+# new or changed samples are read.  To find the duplicates without
+# comparing every pair, each fingerprint is cut into one more piece
+# than the number of bits allowed to differ: any two duplicates must
+# then agree on a whole piece, so only fingerprints that share a piece
+# are compared.
+#
+# jMap uses this for "dedup" (see the .sfc), which leaves the
+# duplicates out before it builds the round-robins.  Run as a program,
+# this replaces duplicate sample files with hard links to one of them.
+
+import sys
+import os
+import os.path
+import glob
+
+import numpy as np
+
+import jwave
+import jmeta
+
+# user configurable parameters
+
+_print_time     = 2.0           # seconds of each sample fingerprinted
+_hop_time       = 0.05          # seconds per frame
+_bands          = [100 * pow(2, k / 3.0) for k in range(20)]    # Hz, third-octave band edges
+_floor_db       = -60.0         # dB relative to the frame's loudest band, quieter is silence
+_max_distance   = 0.05          # fraction of the bits that may differ
+
+
+# The "fingerprint" section of a sample's metadata (see jmeta): the
+# bits, in hex
+
+def fingerprint_info(path, offset=0, end=None):
+    with open(path, "rb") as inf:
+        wave = jwave.WaveChunk(inf=inf)
+        wave.readHeader()
+        if end is None:
+            end = wave.numSamples - 1
+        rate = wave.fmt.sampleRate
+        hop = max(1, int(_hop_time * rate))
+        nframes = int(round(_print_time / _hop_time)) + 1
+        size = 1 << (2 * hop - 1).bit_length()
+        stop = min(end + 1, offset + (nframes - 1) * hop + size)
+        samps = np.zeros((nframes - 1) * hop + size)
+        mono = wave.readMono(offset, stop, None).astype(np.float64)
+        samps[:len(mono)] = mono
+
+    frames = np.lib.stride_tricks.as_strided(samps, (nframes, size),
+        (samps.strides[0] * hop, samps.strides[0]))
+    spec = np.fft.rfft(frames * np.hanning(size), axis=1)
+    power = spec.real ** 2 + spec.imag ** 2
+    edges = np.minimum(np.rint(np.array(_bands) * size / float(rate)).astype(int), power.shape[1] - 1)
+    energy = np.add.reduceat(power, edges, axis=1)[:, :-1]
+    energy = np.maximum(energy, energy.max(axis=1, keepdims=True) * pow(10.0, _floor_db / 10.0))
+
+    slope = energy[:, :-1] - energy[:, 1:]
+    bits = (slope[1:] - slope[:-1]) > 0
+    return {"print": np.packbits(bits.ravel()).tobytes().hex()}
+
+
+def decode_print(info):
+    return np.frombuffer(bytes.fromhex(info["print"]), dtype=np.uint8)
+
+
+_popcount = np.array([bin(val).count("1") for val in range(256)], dtype=np.int32)
+
+
+# Groups of duplicates among fingerprints (each an array of bytes, all
+# the same length): a list of lists of indexes, each in order, leaving
+# out those with no duplicate.
+
+def duplicates(prints, max_distance=None):
+    if max_distance is None:
+        max_distance = _max_distance
+    if not prints:
+        return []
+
+    # identical fingerprints first, so they're compared only once
+    unique = {}
+    same = []
+    for (ix, fp) in enumerate(prints):
+        key = fp.tobytes()
+        if key not in unique:
+            unique[key] = len(same)
+            same.append([])
+        same[unique[key]].append(ix)
+    packed = np.array([prints[ixs[0]] for ixs in same])
+    bits = np.unpackbits(packed, axis=1)
+    max_bits = int(max_distance * bits.shape[1])
+
+    # union-find over the unique fingerprints
+    parent = list(range(len(same)))
+
+    def root(ix):
+        while parent[ix] != ix:
+            parent[ix] = parent[parent[ix]]
+            ix = parent[ix]
+        return ix
+
+    # duplicates agree on at least one of max_bits + 1 pieces
+    for piece in np.array_split(np.arange(bits.shape[1]), max_bits + 1):
+        buckets = {}
+        for (ix, key) in enumerate(np.packbits(bits[:, piece], axis=1)):
+            buckets.setdefault(key.tobytes(), []).append(ix)
+        for members in buckets.values():
+            for (pos, ix) in enumerate(members[:-1]):
+                rest = np.array(members[pos + 1:])
+                dist = _popcount[packed[rest] ^ packed[ix]].sum(axis=1)
+                for other in rest[dist <= max_bits]:
+                    (a, b) = (root(ix), root(int(other)))
+                    if a != b:
+                        parent[max(a, b)] = min(a, b)
+
+    found = {}
+    for (uix, ixs) in enumerate(same):
+        found.setdefault(root(uix), []).extend(ixs)
+    return [sorted(group) for group in found.values() if len(group) > 1]
+
+
+# The one of a group of duplicate files to keep: the shortest name, so
+# "x.wav" rather than "x-1.wav"
+
+def keeper(fnames):
+    return min(fnames, key=lambda fname: (len(os.path.basename(fname)), fname))
+
+
+# Replace fname with a hard link to keep
+
+def link_file(keep, fname):
+    tmpname = "%s.tmp%d" % (fname, os.getpid())
+    os.link(keep, tmpname)
+    os.replace(tmpname, fname)
+
+
+def usage(prog):
+    print(file=sys.stderr)
+    print("%s: replace duplicate samples with hard links" % prog, file=sys.stderr)
+    print(file=sys.stderr)
+    print("  Usage: %s [-n] [-d <distance>] [-i <indexfile>] [-j <jobs>] {<wavefile>}" % prog, file=sys.stderr)
+    print(file=sys.stderr)
+    print("where:", file=sys.stderr)
+    print("  -n only shows the duplicates.", file=sys.stderr)
+    print("  -d <distance> is the fraction of the fingerprint that may differ", file=sys.stderr)
+    print("     (default %g; 0 for exact duplicates only)." % _max_distance, file=sys.stderr)
+    print("  -i <indexfile> caches the fingerprints in <indexfile>.", file=sys.stderr)
+    print("  -j <jobs> sets the number of processes (default: one per CPU).", file=sys.stderr)
+    print("  Of each group of duplicates, the file with the shortest name is", file=sys.stderr)
+    print("  kept and the others are made links to it.", file=sys.stderr)
+    print(file=sys.stderr)
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    args = sys.argv
+    prog = args[0].split("\\")[-1]
+    del args[0]
+
+    dry_run = False
+    max_distance = _max_distance
+    index = jmeta.MetaIndex()
+    workers = None
+    while len(args) > 0 and args[0].startswith("-"):
+        if args[0] == "-n":
+            dry_run = True
+            del args[0]
+        elif len(args) > 1 and args[0] == "-d":
+            max_distance = float(args[1])
+            del args[0:2]
+        elif len(args) > 1 and args[0] == "-i":
+            index = jmeta.MetaIndex(args[1])
+            del args[0:2]
+        elif len(args) > 1 and args[0] == "-j":
+            workers = int(args[1])
+            del args[0:2]
+        else:
+            usage(prog)
+
+    fnames = []
+    for fspec in args:
+        fnames.extend(glob.glob(fspec))
+    if not fnames:
+        usage(prog)
+
+    errors = []
+    found = index.analyze([(fname, "fingerprint", ()) for fname in fnames], fingerprint_info,
+        errors, workers, processes=True)
+    for msg in errors:
+        print(msg, file=sys.stderr)
+    index.save()
+
+    fnames = [fname for fname in fnames if (fname, "fingerprint") in found]
+    prints = [decode_print(found[(fname, "fingerprint")]) for fname in fnames]
+    linked = 0
+    failed = 0
+    for group in duplicates(prints, max_distance):
+        group = [fnames[ix] for ix in group]
+        keep = keeper(group)
+        print("%s:" % keep)
+        for fname in sorted(group):
+            if fname == keep:
+                continue
+            if os.path.samefile(fname, keep):
+                print("  %s (already linked)" % fname)
+                continue
+            print("  %s" % fname)
+            if not dry_run:
+                try:
+                    link_file(keep, fname)
+                    linked += 1
+                except OSError as msg:
+                    print("%s: %s, skipped" % (fname, msg), file=sys.stderr)
+                    failed += 1
+    print("%d files, %d linked, %d skipped" % (len(fnames), linked, failed), file=sys.stderr)
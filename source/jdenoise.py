@@ -0,0 +1,295 @@
+#!/usr/bin/python3
+# Reduce the background noise of a layer file (spectral gating).
+#
+# The noise is learned from the silence between notes: the frames that
+# jnoise finds at the noise floor.  Their average spectrum is the noise
+# profile.  Then the whole file is run through a short-time FFT; in
+# each frame, the frequency bins that aren't well above the profile
+# are turned down, and the frames are put back together by overlap-add.
+# Notes are left alone where they're louder than the noise, and the
+# hiss between and after them drops by the reduction.
+#
+# The file is read in blocks, with the input and output that span
+# blocks carried over, so a file of any length is processed in bounded
+# memory.  Each output sample depends only on the frames that cover it,
+# so the file can also be split into segments, processed in a pool of
+# processes, and joined with the same result.
+#
+# jCutSamps uses this (-n) to denoise each layer file before cutting
+# it.  Run as a program, this denoises wave files.
+
+import sys
+import os
+import os.path
+import glob
+import collections
+import concurrent.futures
+
+import numpy as np
+
+import jwave
+import jnoise
+
+# user configurable parameters
+
+_fft_size       = 2048          # samples per FFT frame
+_overlap        = 4             # frames covering each sample
+_threshold_db   = 6.0           # dB above the noise profile where bins pass
+_reduction_db   = -20.0         # dB, gain of the bins that don't
+_smooth_bins    = 5             # bins to smooth the gains over, against "musical noise"
+_margin_db      = 3.0           # dB above the noise floor that still counts as silence
+_profile_time   = 10.0          # seconds of silence to learn the noise from, at most
+_segment_time   = 30.0          # seconds per segment, with processes
+
+_block_len      = 1 << 16       # samples read at a time
+
+
+def _window():
+    # square root of a periodic Hann window, for analysis and synthesis
+    return np.sqrt(0.5 - 0.5 * np.cos(2 * np.pi * np.arange(_fft_size) / _fft_size))
+
+
+# Noise profile of an open wave: the RMS magnitude of each FFT bin in
+# each channel (shape (bins, channels)), from the silence between notes
+# as found by noise (a jnoise.NoiseFloor).  Returns None if no silence
+# is found.
+
+def learn_profile(wave, noise, margin_db=None, profile_time=None):
+    if margin_db is None:
+        margin_db = _margin_db
+    if profile_time is None:
+        profile_time = _profile_time
+
+    floor = noise.at(0)
+    if floor is None:
+        return None
+    quiet = noise.env.levels() <= floor + margin_db
+    frameLen = noise.frameLen
+
+    # runs of quiet envelope frames, as sample ranges
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], quiet.astype(np.int8), [0]))))
+    runs = edges.reshape(-1, 2) * frameLen
+
+    win = _window()
+    power = 0.0
+    count = 0
+    wanted = int(profile_time * wave.fmt.sampleRate) // _fft_size
+    for (start, end) in runs:
+        nframes = min((end - start) // _fft_size, wanted - count)
+        if nframes <= 0:
+            continue
+        frames = wave.readFrames(start, start + nframes * _fft_size).astype(np.float64)
+        frames = frames.reshape(nframes, _fft_size, -1) * win[:, np.newaxis]
+        spec = np.fft.rfft(frames, axis=1)
+        power = power + (spec.real ** 2 + spec.imag ** 2).sum(axis=0)
+        count += nframes
+        if count >= wanted:
+            break
+    if not count:
+        return None
+    return np.sqrt(power / count)
+
+
+class Denoiser:
+    # history: the input just before the first frames given, if any
+    # (shape (lag, channels)), so that a segment of a file comes out
+    # the same as it would in the whole file.
+    def __init__(self, profile, threshold_db=None, reduction_db=None, history=None):
+        if threshold_db is None:
+            threshold_db = _threshold_db
+        if reduction_db is None:
+            reduction_db = _reduction_db
+
+        self.hop = _fft_size // _overlap
+        self.lag = _fft_size - self.hop
+        self.win = _window()[:, np.newaxis]
+        self.thresh = profile * pow(10.0, threshold_db / 20.0)
+        self.reduction = pow(10.0, reduction_db / 20.0)
+        channels = profile.shape[1]
+        if history is None:
+            history = np.zeros((self.lag, channels))
+        self.buf = np.asarray(history, dtype=np.float64)   # input not yet framed
+        self.acc = np.zeros((self.lag, channels))           # overlap-add carried over
+        self.skip = self.lag        # output to drop, from before the first input
+
+    # Bin gains for magnitudes mag (shape (frames, bins, channels))
+    def gains(self, mag):
+        gain = np.where(mag > self.thresh, 1.0, self.reduction)
+        if _smooth_bins > 1:
+            half = _smooth_bins // 2
+            padded = np.pad(gain, ((0, 0), (half, _smooth_bins - 1 - half), (0, 0)), mode="edge")
+            csum = np.cumsum(padded, axis=1)
+            csum = np.concatenate((np.zeros_like(csum[:, :1]), csum), axis=1)
+            gain = (csum[:, _smooth_bins:] - csum[:, :-_smooth_bins]) / _smooth_bins
+        return gain
+
+    # Denoise a block of frames (shape (n, channels)), returning the
+    # output frames that are complete (floats).
+    def process(self, frames):
+        self.buf = np.concatenate((self.buf, frames))
+        nframes = (len(self.buf) - _fft_size) // self.hop + 1
+        if nframes <= 0:
+            return np.zeros((0, self.buf.shape[1]))
+
+        ix = (np.arange(nframes) * self.hop)[:, np.newaxis] + np.arange(_fft_size)
+        spec = np.fft.rfft(self.buf[ix] * self.win, axis=1)
+        spec *= self.gains(np.abs(spec))
+        # sqrt-Hann squared (Hann) sums to _overlap / 2
+        out = np.fft.irfft(spec, _fft_size, axis=1) * (self.win * 2.0 / _overlap)
+
+        # overlap-add: each frame's hops land hop apart
+        y = np.zeros((nframes * self.hop + self.lag, self.buf.shape[1]))
+        y[:self.lag] = self.acc
+        for part in range(_overlap):
+            seg = out[:, part * self.hop:(part + 1) * self.hop].reshape(-1, self.buf.shape[1])
+            y[part * self.hop:part * self.hop + len(seg)] += seg
+
+        done = nframes * self.hop
+        self.acc = y[done:]
+        self.buf = self.buf[done:]
+        y = y[:done]
+        if self.skip:
+            drop = min(self.skip, len(y))
+            self.skip -= drop
+            y = y[drop:]
+        return y
+
+    # The rest of the output, once all the input has been given (the
+    # caller trims it to the length of the input).
+    def flush(self):
+        return self.process(np.zeros((_fft_size, self.buf.shape[1])))
+
+
+# Denoise frames [start, end) of an open wave, yielding blocks of
+# output frames (floats) in order.
+
+def denoise_range(wave, profile, start, end, threshold_db=None, reduction_db=None):
+    hop = _fft_size // _overlap
+    lag = _fft_size - hop
+    history = wave.readFrames(start - lag, start).astype(np.float64)
+    history = np.concatenate((np.zeros((lag - len(history), wave.fmt.numChan)), history))
+    den = Denoiser(profile, threshold_db, reduction_db, history)
+
+    # read on past the end, for the frames that cover it
+    stop = min(wave.numSamples, end + _fft_size)
+    left = end - start
+    for sn in range(start, stop, _block_len):
+        out = den.process(wave.readFrames(sn, min(sn + _block_len, stop)))[:left]
+        left -= len(out)
+        yield out
+    if left > 0:
+        yield den.flush()[:left]
+
+
+def denoise_segment(job):
+    (fname, profile, start, end, threshold_db, reduction_db) = job
+    with open(fname, "rb") as inf:
+        wave = jwave.WaveChunk(inf=inf)
+        wave.readHeader()
+        blocks = list(denoise_range(wave, profile, start, end, threshold_db, reduction_db))
+    return np.rint(np.concatenate(blocks)).astype(np.int32)
+
+
+# Denoise a wave file into outfname (not the same file), in segments
+# in a pool of workers processes, or in this process if workers is 1.
+# Only the wave data is written.  Returns the noise floor in dB, or
+# None if no silence was found, in which case nothing is written.
+
+def denoise_file(fname, outfname, workers=None, threshold_db=None, reduction_db=None):
+    with open(fname, "rb") as inf:
+        wave = jwave.WaveChunk(inf=inf)
+        wave.readHeader()
+        if wave.fmt.compCode != 1:
+            raise ValueError("compressed formats unsupported")
+        noise = jnoise.NoiseFloor(wave)
+        profile = learn_profile(wave, noise)
+        if profile is None:
+            return None
+        total = wave.numSamples
+
+        with open(outfname, "wb") as outf:
+            owave = jwave.WaveChunk(outf=outf)
+            owave.copyHeader(wave)
+            owave.writeHeader(total)
+            if workers == 1:
+                for out in denoise_range(wave, profile, 0, total, threshold_db, reduction_db):
+                    owave.writeFrames(np.rint(out))
+            else:
+                seg = int(_segment_time * wave.fmt.sampleRate) // _fft_size * _fft_size
+                jobs = [(fname, profile, start, min(start + seg, total), threshold_db, reduction_db)
+                    for start in range(0, total, seg)]
+                with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                    # keep only a few segments in flight, to bound memory
+                    ahead = 2 * (workers or os.cpu_count() or 1)
+                    pending = collections.deque()
+                    for job in jobs:
+                        pending.append(pool.submit(denoise_segment, job))
+                        if len(pending) >= ahead:
+                            owave.writeFrames(pending.popleft().result())
+                    while pending:
+                        owave.writeFrames(pending.popleft().result())
+            owave.finishHeader(total)
+    return noise.at(0)
+
+
+def usage(prog):
+    print(file=sys.stderr)
+    print("%s: reduce the background noise of wave files" % prog, file=sys.stderr)
+    print(file=sys.stderr)
+    print("  Usage: %s [-r <dB>] [-o <outfolder>] [-j <jobs>] {<wavefile>}" % prog, file=sys.stderr)
+    print(file=sys.stderr)
+    print("where:", file=sys.stderr)
+    print("  -r <dB> is the reduction of the noise (default %g)." % _reduction_db, file=sys.stderr)
+    print("  -o <outfolder> writes the new files there, rather than", file=sys.stderr)
+    print("     replacing the originals.", file=sys.stderr)
+    print("  -j <jobs> sets the number of processes (default: one per CPU).", file=sys.stderr)
+    print("  The noise is learned from the silence between notes.", file=sys.stderr)
+    print(file=sys.stderr)
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    args = sys.argv
+    prog = args[0].split("\\")[-1]
+    del args[0]
+
+    reduction_db = _reduction_db
+    folder = None
+    workers = None
+    while len(args) > 1 and args[0].startswith("-"):
+        if args[0] == "-r":
+            reduction_db = -abs(float(args[1]))
+        elif args[0] == "-o":
+            folder = args[1]
+        elif args[0] == "-j":
+            workers = int(args[1])
+        else:
+            usage(prog)
+        del args[0:2]
+
+    fnames = []
+    for fspec in args:
+        fnames.extend(glob.glob(fspec))
+    if not fnames:
+        usage(prog)
+
+    for fname in fnames:
+        outfname = fname
+        if folder:
+            outfname = os.path.join(folder, os.path.basename(fname))
+        tmpname = "%s.tmp%d" % (outfname, os.getpid())
+        try:
+            floor = denoise_file(fname, tmpname, workers, reduction_db=reduction_db)
+        except (IOError, OSError, ValueError, EOFError) as msg:
+            print("%s: %s, skipped" % (fname, msg), file=sys.stderr)
+            floor = None
+        else:
+            if floor is None:
+                print("%s: no silence to learn the noise from, skipped" % fname, file=sys.stderr)
+        if floor is None:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            continue
+        os.replace(tmpname, outfname)
+        print("%s: noise floor %6.2f dB, reduced %g dB" % (outfname, floor, reduction_db))
@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+# Reduce the bits per sample (24 to 16), with dither.
+#
+# Without dither, rounding to fewer bits turns the quiet end of a
+# decaying note into distortion.  TPDF dither (the sum of two uniform
+# random values, +/-1 LSB) turns it into a constant, benign hiss.
+# "shaped" adds first-order error feedback: each sample's rounding
+# error (dither included) is taken from the next sample, so the noise
+# falls away toward low frequencies, where it's most audible, and rises
+# toward the top of the band.  The running sum of the output is then
+# the running sum of the input, rounded, so a whole block can be done
+# at once.
+#
+# The random values are seeded from the output file's name, so
+# building the same samples again gives the same files.
+
+import sys
+import os.path
+import zlib
+
+import numpy as np
+
+# user configurable parameters
+
+_dither         = "tpdf"        # "none", "tpdf" or "shaped"
+
+_methods        = ("none", "tpdf", "shaped")
+
+
+# Seed for a file's dither, from its name (not its folder, so the
+# same samples written somewhere else come out the same)
+
+def seed_for(fname):
+    return zlib.crc32(os.path.basename(fname).encode("utf-8"))
+
+
+class Requantizer:
+    def __init__(self, in_bits, out_bits, dither=None, seed=0):
+        if dither is None:
+            dither = _dither
+        if dither not in _methods:
+            print("Unknown dither '%s'" % dither, file=sys.stderr)
+            sys.exit(1)
+        self.scale = float(1 << (in_bits - out_bits))
+        self.dither = dither
+        self.rng = np.random.default_rng(seed)
+        self.limit = (1 << (out_bits - 1)) - 1
+        self.err = 0.0              # error carried into the next block, for "shaped"
+
+    # Convert a block of frames (ints, shape (n, channels)); blocks
+    # must be given in order.
+    def process(self, frames):
+        vals = frames / self.scale
+        if self.dither == "tpdf":
+            vals += self.rng.random(frames.shape) - self.rng.random(frames.shape)
+        elif self.dither == "shaped":
+            if len(frames) == 0:
+                return np.zeros(frames.shape, dtype=np.int32)
+            sums = np.cumsum(frames, axis=0, dtype=np.int64) / self.scale - self.err
+            rand = self.rng.random(frames.shape) - self.rng.random(frames.shape)
+            rounded = np.floor(sums + rand + 0.5)
+            self.err = rounded[-1] - sums[-1]
+            vals = np.diff(rounded, axis=0, prepend=0)
+            return np.clip(vals, -self.limit - 1, self.limit).astype(np.int32)
+        vals = np.floor(vals + 0.5)
+        return np.clip(vals, -self.limit - 1, self.limit).astype(np.int32)
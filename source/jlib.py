@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+# Sample library index.
+#
+# jCutSamps records each note it writes in an SQLite database (.sfl):
+# where the note is, which instrument, layer and note it is, and what
+# was measured while cutting it (pitch, peak, S/N, duration, and where
+# it came from in the layer file).  jMap can map the notes from the
+# library instead of parsing file names, and other tools can look up
+# what's known about a sample without reading its audio.
+#
+# File names in the library are relative to the library's folder, so
+# the folder can be moved as a whole.
+
+import sys
+import os
+import os.path
+import sqlite3
+
+_schema = """
+CREATE TABLE IF NOT EXISTS samples (
+    name        TEXT PRIMARY KEY,   -- the note's file name
+    file        TEXT NOT NULL,      -- file holding the note (name, or a container)
+    offset      INTEGER,            -- first sample in a container, else NULL
+    end         INTEGER,            -- last sample in a container, else NULL
+    instrument  TEXT NOT NULL,
+    layer       TEXT NOT NULL,
+    note        INTEGER NOT NULL,   -- MIDI note number
+    rr          TEXT NOT NULL,      -- round-robin suffix, "" for the first
+    guess       INTEGER NOT NULL,   -- 1 if not sure of the pitch
+    cents       INTEGER,
+    freq        REAL,
+    peak        REAL,               -- dB
+    snr         REAL,               -- dB
+    duration    REAL,               -- seconds
+    rate        INTEGER,
+    start_sn    INTEGER,            -- where the note was in the layer file
+    limit_sn    INTEGER,
+    source      TEXT                -- the layer file
+);
+CREATE INDEX IF NOT EXISTS samples_inst ON samples (instrument, layer, note);
+CREATE INDEX IF NOT EXISTS samples_source ON samples (source);
+"""
+
+
+# Split a jMap sample argument into the library file and the
+# instrument, as in "lib.sfl:piano".  Returns (arg, None) for
+# anything else.
+
+def split_arg(arg):
+    (path, sep, instrument) = arg.partition(".sfl:")
+    if not sep:
+        return (arg, None)
+    return (path + ".sfl", instrument)
+
+
+class Library:
+    def __init__(self, fname):
+        self.fname = fname
+        self.folder = os.path.dirname(os.path.abspath(fname))
+        self.db = sqlite3.connect(fname)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(_schema)
+
+    # Name of a file as stored in the library, and back again
+
+    def relname(self, fname):
+        return os.path.relpath(os.path.abspath(fname), self.folder).replace("\\", "/")
+
+    def path(self, relname):
+        return os.path.join(os.path.dirname(self.fname), relname)
+
+    # Forget the notes cut from a layer file, before cutting it again
+
+    def forget_source(self, source):
+        with self.db:
+            self.db.execute("DELETE FROM samples WHERE source = ?", (self.relname(source),))
+
+    # Record a note.  File names are given as usual; they're stored
+    # relative to the library.  Each note is committed on its own, so
+    # readers see notes as soon as they're cut.
+
+    def add(self, name, file, source, **fields):
+        fields["name"] = self.relname(name)
+        fields["file"] = self.relname(file)
+        fields["source"] = self.relname(source)
+        cols = sorted(fields)
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO samples (%s) VALUES (%s)"
+                % (", ".join(cols), ", ".join("?" * len(cols))),
+                [fields[col] for col in cols])
+
+    # The notes of an instrument (or all of them), in instrument, layer,
+    # note and round-robin order.  Returns a list of sqlite3.Row.
+
+    def samples(self, instrument=None):
+        query = "SELECT * FROM samples"
+        params = ()
+        if instrument:
+            query += " WHERE instrument = ?"
+            params = (instrument,)
+        query += " ORDER BY instrument, layer, note, rr"
+        return self.db.execute(query, params).fetchall()
+
+    def close(self):
+        self.db.close()
+
+
+if __name__ == "__main__":
+
+    import csv
+
+    args = sys.argv
+    prog = args[0].split("\\")[-1]
+    del args[0]
+
+    if len(args) < 1 or not os.path.exists(args[0]):
+        print("usage: %s <libfile> [<instrument>] -- list the notes in a sample library"
+            % prog, file=sys.stderr)
+        sys.exit(1)
+
+    lib = Library(args[0])
+    rows = lib.samples(args[1] if len(args) > 1 else None)
+    if rows:
+        out = csv.writer(sys.stdout)
+        out.writerow(rows[0].keys())
+        for row in rows:
+            out.writerow(tuple(row))
+    lib.close()
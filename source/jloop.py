@@ -0,0 +1,260 @@
+#!/usr/bin/python3
+# Find sustain loops in samples.
+#
+# A loop plays from its start to its end and jumps back to the start,
+# so it's seamless if the audio leading up to the end looks like the
+# audio leading up to the start.  The end is put late in the note,
+# where it's still within _end_db of its peak, at a rising zero
+# crossing.  Then a window of audio ending there is compared with every
+# window ending in the search range before it, by normalized
+# cross-correlation computed with an FFT (so the whole range costs
+# about as much as a few direct comparisons).  The correlation doesn't
+# see level, so windows whose RMS level differs from the end's by more
+# than _max_level_db are ruled out (on a decaying note, they'd jump in
+# level at every pass).  The best few candidates are moved to the
+# nearest rising zero crossing, scored again, and the best one is the
+# loop.
+#
+# jMap uses find_loop() for "find-loops" (see the .sfc).  Run as a
+# program, this writes the loops found into the sample files, as a
+# smpl chunk, in a pool of processes.
+
+import sys
+import os
+import os.path
+import glob
+import math
+import concurrent.futures
+
+import numpy as np
+
+import jwave
+import jriff
+
+# user configurable parameters
+
+_skip_time      = 0.3           # seconds of attack before the loop may start
+_min_time       = 0.5           # seconds, shortest loop
+_max_time       = 4.0           # seconds, longest loop
+_end_db         = -12.0         # dB relative to the peak, latest the loop may end
+_window_time    = 0.05          # seconds of audio compared at the seam
+_candidates     = 8             # best matches to move to zero crossings and score again
+_min_score      = 0.95          # worst correlation for a usable loop
+_max_level_db   = 1.0           # dB, most the level may differ across the seam
+
+_frame_time     = 0.01          # seconds per envelope frame
+
+
+# Normalized cross-correlation of template t with each window of
+# len(t) samples in x, by where the window ends (from len(t) - 1 on).
+
+def ncc(t, x):
+    n = len(t)
+    size = 1 << int(math.ceil(math.log(len(x) + n, 2)))
+    corr = np.fft.irfft(np.fft.rfft(x, size) * np.conj(np.fft.rfft(t, size)), size)
+    corr = corr[:len(x) - n + 1]
+    csum = np.concatenate(([0.0], np.cumsum(x * x)))
+    energy = (csum[n:] - csum[:-n]) * np.dot(t, t)
+    return corr / np.sqrt(np.maximum(energy, 1e-12))
+
+
+# Whether windows of energy (sum of squares) are within _max_level_db
+# of one of ref
+
+def level_matches(energy, ref):
+    limit = pow(10.0, _max_level_db / 10.0)
+    return (energy * limit >= ref) & (energy <= ref * limit)
+
+
+# Loop (start, end, score) for the note from offset to end (inclusive)
+# in an open wave, or the whole file: end is the last sample played
+# before jumping back to start.  Returns None if there's no loop good
+# enough.
+
+def find_loop(wave, offset=0, end=None, min_time=None):
+    if end is None:
+        end = wave.numSamples - 1
+    if min_time is None:
+        min_time = _min_time
+    rate = wave.fmt.sampleRate
+    win = max(16, int(_window_time * rate))
+    first = offset + int(_skip_time * rate) + win
+
+    # latest end: where the note is still within _end_db of its peak
+    frameLen = max(1, int(_frame_time * rate))
+    env = wave.envelope(frameLen)
+    env.extend(end + 1)
+    levels = env.levels()[env.frameAt(offset):env.frameAt(end + 1)]
+    if len(levels) == 0:
+        return None
+    loud = np.flatnonzero(levels >= levels.max() + _end_db)
+    latest = min(end - 1, offset + (int(loud[-1]) + 1) * frameLen)
+
+    xing = wave.crossings()
+    sn = xing.prev(latest, slope=1)
+    if sn is None:
+        return None
+    loop_end = sn - 1
+    lo = max(first, loop_end - int(_max_time * rate))
+    hi = loop_end - int(min_time * rate)
+    if hi <= lo:
+        return None
+
+    # windows ending just before each candidate start, against the
+    # window ending at the loop end
+    samps = wave.readMono(lo - win, hi, None).astype(np.float64)
+    tmpl = wave.readMono(loop_end - win + 1, loop_end + 1, None).astype(np.float64)
+    scores = ncc(tmpl, samps)       # scores[i]: window ending at lo - 1 + i
+
+    # rule out windows too much louder or quieter than the end's
+    tmplEnergy = np.dot(tmpl, tmpl)
+    csum = np.concatenate(([0.0], np.cumsum(samps * samps)))
+    energy = csum[win:] - csum[:-win]
+    scores[~level_matches(energy, tmplEnergy)] = -1.0
+
+    best = None
+    order = np.argsort(scores)[::-1]
+    tried = set()
+    for ix in order[:_candidates * 4]:
+        if len(tried) >= _candidates:
+            break
+        start = lo + int(ix)
+        near = xing.between(start - win // 2, start + win // 2, 1)
+        if len(near) == 0:
+            continue
+        start = int(near[np.argmin(np.abs(near - start))])
+        if start in tried or start < lo or start > hi:
+            continue
+        tried.add(start)
+        prev = wave.readMono(start - win, start, None).astype(np.float64)
+        if not level_matches(np.dot(prev, prev), tmplEnergy):
+            continue
+        denom = math.sqrt(np.dot(prev, prev) * tmplEnergy)
+        score = float(np.dot(prev, tmpl) / denom) if denom else 0.0
+        if best is None or score > best[2]:
+            best = (start, loop_end, score)
+
+    if best is None or best[2] < _min_score:
+        return None
+    return best
+
+
+# The "loop" section of a sample's metadata (see jmeta): the loop as
+# [start, end], or None
+
+def loop_info(path, min_time=None, offset=0, end=None):
+    with open(path, "rb") as inf:
+        wave = jwave.WaveChunk(inf=inf)
+        wave.readHeader()
+        found = find_loop(wave, offset, end, min_time)
+    if found is None:
+        return {"loop": None}
+    return {"loop": [found[0], found[1]], "score": found[2]}
+
+
+# Find a loop in a sample file and write it into outfname (which may
+# be the same file) as a smpl chunk, keeping the unity note of any
+# smpl chunk it has.  Returns (start, end, score), or None if there's
+# no loop (and nothing is written).
+
+def loop_file(fname, outfname, min_time=None, unity=60, dry_run=False):
+    with open(fname, "rb") as inf:
+        wave = jwave.WaveChunk(inf=inf)
+        wave.readChunkDir()
+        smpl = wave.readSmpl()
+        if smpl and smpl[1]:
+            raise ValueError("has loops")
+        if smpl:
+            unity = smpl[0]
+        inf.seek(0)
+        wave.readHeader()
+        found = find_loop(wave, min_time=min_time)
+        if found is None or dry_run:
+            return found
+
+        tmpname = "%s.tmp%d" % (outfname, os.getpid())
+        with open(tmpname, "wb") as outf:
+            jriff.replace_chunk(inf, outf, "smpl",
+                jriff.smpl_data(wave.fmt.sampleRate, unity, [(0, found[0], found[1])]))
+    os.replace(tmpname, outfname)
+    return found
+
+
+def loop_job(job):
+    (fname, outfname, min_time, dry_run) = job
+    try:
+        return (loop_file(fname, outfname, min_time, dry_run=dry_run), None)
+    except (IOError, OSError, ValueError, EOFError) as msg:
+        return (None, str(msg))
+
+
+def usage(prog):
+    print(file=sys.stderr)
+    print("%s: find sustain loops in sample files" % prog, file=sys.stderr)
+    print(file=sys.stderr)
+    print("  Usage: %s [-n] [-m <seconds>] [-o <outfolder>] [-j <jobs>] {<wavefile>}" % prog, file=sys.stderr)
+    print(file=sys.stderr)
+    print("where:", file=sys.stderr)
+    print("  -n only shows the loops found.", file=sys.stderr)
+    print("  -m <seconds> is the shortest loop (default %g)." % _min_time, file=sys.stderr)
+    print("  -o <outfolder> writes the looped files there, rather than", file=sys.stderr)
+    print("     replacing the originals.", file=sys.stderr)
+    print("  -j <jobs> sets the number of processes (default: one per CPU).", file=sys.stderr)
+    print("  Files that already have loops are left alone.", file=sys.stderr)
+    print(file=sys.stderr)
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    args = sys.argv
+    prog = args[0].split("\\")[-1]
+    del args[0]
+
+    dry_run = False
+    min_time = _min_time
+    folder = None
+    workers = None
+    while len(args) > 0 and args[0].startswith("-"):
+        if args[0] == "-n":
+            dry_run = True
+            del args[0]
+        elif len(args) > 1 and args[0] == "-m":
+            min_time = float(args[1])
+            del args[0:2]
+        elif len(args) > 1 and args[0] == "-o":
+            folder = args[1]
+            del args[0:2]
+        elif len(args) > 1 and args[0] == "-j":
+            workers = int(args[1])
+            del args[0:2]
+        else:
+            usage(prog)
+
+    fnames = []
+    for fspec in args:
+        fnames.extend(glob.glob(fspec))
+    if not fnames:
+        usage(prog)
+
+    jobs = []
+    for fname in fnames:
+        outfname = fname
+        if folder:
+            outfname = os.path.join(folder, os.path.basename(fname))
+        jobs.append((fname, outfname, min_time, dry_run))
+
+    looped = 0
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        for (job, (found, msg)) in zip(jobs, pool.map(loop_job, jobs, chunksize=4)):
+            if msg is not None:
+                print("%s: %s, skipped" % (job[0], msg), file=sys.stderr)
+                failed += 1
+            elif found is None:
+                print("%s: no loop found" % job[0])
+            else:
+                print("%s: loop %d-%d, score %.4f" % (job[0], found[0], found[1], found[2]))
+                looped += 1
+
+    print("%d files, %d looped, %d skipped" % (len(jobs), looped, failed), file=sys.stderr)
@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+# Cached metadata for sample files.
+#
+# Reading a wave file's header is cheap, but an instrument can have
+# thousands of samples, and on most runs none of them have changed.
+# The index keeps what we've learned about each file in a JSON file,
+# keyed by path, along with the file's size and modification time.
+# An entry is thrown away when either of those changes.
+#
+# Each kind of information has its own section in the entry ("wave"
+# for the header scan), so other analyses can share the index.
+
+import sys
+import os
+import os.path
+import json
+import struct
+import concurrent.futures
+
+import jwave
+
+# user configurable parameters
+
+_workers        = 8             # threads for scanning files
+
+
+# Write a text file so that readers never see it half-written:
+# write a temporary file next to it, then rename it into place.
+
+def write_atomic(fname, text):
+    tmpname = "%s.tmp%d" % (fname, os.getpid())
+    with open(tmpname, "w", newline="") as tmpf:
+        tmpf.write(text)
+    os.replace(tmpname, fname)
+
+
+# (mtime, size) for a file, the key for its cached entry
+
+def stamp(path):
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+class MetaIndex:
+    def __init__(self, fname=None):
+        self.fname = fname
+        self.entries = {}
+        self.dirty = False
+        if fname and os.path.exists(fname):
+            try:
+                with open(fname, "r") as inf:
+                    self.entries = json.load(inf)
+            except (IOError, ValueError) as msg:
+                print("Warning: ignoring metadata index %s: %s" % (fname, msg), file=sys.stderr)
+
+    # Cached section of a file's entry, or None if it's missing or stale
+
+    def get(self, path, section, st=None):
+        entry = self.entries.get(os.path.abspath(path))
+        if entry is None:
+            return None
+        if st is None:
+            st = stamp(path)
+        if entry["stamp"] != st:
+            return None
+        return entry.get(section)
+
+    def put(self, path, section, value, st=None):
+        key = os.path.abspath(path)
+        if st is None:
+            st = stamp(path)
+        entry = self.entries.get(key)
+        if entry is None or entry["stamp"] != st:
+            entry = {"stamp": st}
+            self.entries[key] = entry
+        entry[section] = value
+        self.dirty = True
+
+    # Return {path: value} for a section of each path, calling func(path)
+    # in a thread pool for the files that aren't cached.  Files that
+    # can't be read are left out, with a message in errors.
+
+    def scan(self, paths, section, func, errors, workers=None):
+        found = self.analyze([(path, section, ()) for path in paths], func, errors, workers)
+        return dict((path, value) for ((path, section), value) in found.items())
+
+    # The general case of scan(): jobs is a list of (path, section, args),
+    # and func(path, *args) computes the section for a path.  Returns
+    # {(path, section): value}.  With processes, the uncached jobs are
+    # run in a pool of processes rather than threads, for analyses that
+    # are mostly Python or numpy work rather than I/O.
+
+    def analyze(self, jobs, func, errors, workers=None, processes=False):
+        if workers is None and not processes:
+            workers = _workers
+
+        found = {}
+        todo = []
+        for (path, section, args) in jobs:
+            try:
+                st = stamp(path)
+            except OSError as msg:
+                errors.append("Can't open sample file: " + str(msg))
+                continue
+            value = self.get(path, section, st)
+            if value is None:
+                todo.append((path, section, args, st))
+            else:
+                found[(path, section)] = value
+
+        if todo:
+            if processes:
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+            else:
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+            with executor as pool:
+                results = pool.map(_call, [func] * len(todo),
+                    [(path,) + tuple(args) for (path, section, args, st) in todo])
+                for ((path, section, args, st), (value, msg)) in zip(todo, results):
+                    if msg is not None:
+                        errors.append("Can't read %s: %s" % (path, msg))
+                        continue
+                    self.put(path, section, value, st)
+                    found[(path, section)] = value
+
+        return found
+
+    def save(self):
+        if not self.fname or not self.dirty:
+            return
+        try:
+            write_atomic(self.fname, json.dumps(self.entries, sort_keys=True))
+        except (IOError, OSError) as msg:
+            print("Warning: can't write metadata index %s: %s" % (self.fname, msg), file=sys.stderr)
+        self.dirty = False
+
+
+def _call(func, args):
+    try:
+        return (func(*args), None)
+    except (IOError, OSError, ValueError, EOFError, struct.error) as msg:
+        return (None, str(msg))
+
+
+# Header scan for the "wave" section: format, length and smpl loops.
+# Uses only the chunk directory, so no sample data is read.
+
+def wave_info(path):
+    with open(path, "rb") as inf:
+        wave = jwave.WaveChunk(inf=inf)
+        chunks = wave.readChunkDir()
+        fmt = wave.readChunk("fmt ")
+        if fmt is None or len(fmt) < 16:
+            raise ValueError("no fmt chunk")
+        if "data" not in chunks:
+            raise ValueError("no data chunk")
+        (comp, nchan, rate, bps, align, bits) = struct.unpack_from("<HHIIHH", fmt)
+        info = {
+            "rate":     rate,
+            "channels": nchan,
+            "bits":     bits,
+            "frames":   chunks["data"][1] // align if align else 0,
+            "loops":    [],
+            }
+        smpl = wave.readSmpl()
+        if smpl:
+            (unity, loops) = smpl
+            info["unity"] = unity
+            info["loops"] = [[start, end] for (ltype, start, end) in loops]
+    return info
+
+
+def usage(prog):
+    print(file=sys.stderr)
+    print("%s: show (and cache) sample file metadata" % prog, file=sys.stderr)
+    print(file=sys.stderr)
+    print("  Usage: %s [-i <indexfile>] {<wavefile>}" % prog, file=sys.stderr)
+    print(file=sys.stderr)
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    import glob
+
+    args = sys.argv
+    prog = args[0].split("\\")[-1]
+    del args[0]
+
+    index = MetaIndex()
+    if len(args) > 1 and args[0] == "-i":
+        index = MetaIndex(args[1])
+        del args[0:2]
+
+    if len(args) < 1:
+        usage(prog)
+
+    paths = []
+    for fspec in args:
+        paths.extend(glob.glob(fspec))
+
+    errors = []
+    found = index.scan(paths, "wave", wave_info, errors)
+    for path in paths:
+        if path in found:
+            info = found[path]
+            print("%s: %d Hz, %d ch, %d bits, %d frames, loops %s"
+                % (path, info["rate"], info["channels"], info["bits"],
+                   info["frames"], info["loops"]))
+    for msg in errors:
+        print(msg, file=sys.stderr)
+    index.save()
@@ -30,6 +30,8 @@ mnote_names_sharp = [
 
 mnote_names = mnote_names_flat
 
+max_mnote = 127         # G9, the highest MIDI note (the names go on to B9)
+
 def mnote_name(mnote, pad="_"):
     if mnote > len(mnote_names) - 1:
         return "xx"
@@ -70,20 +72,153 @@ def notename(note):
 
     return mnote_name(num, pad=None)
 
+# MIDI note for each note name, flat or sharp
+_note_numbers = dict((name, mnote)
+    for names in (mnote_names_sharp, mnote_names_flat)
+    for (mnote, name) in enumerate(names[:max_mnote + 1]) if name != "xx")
+
 # return MIDI note given either number or name
 
 def notenum(note):
-    # get it as a name
-    name = notename(note)
-    if not name:
-        return None
+    mnote = _note_numbers.get(note)
+    if mnote != None:
+        return mnote
 
-    if name in mnote_names_flat:
-        return mnote_names_flat.index(name)
-    if name in mnote_names_sharp:
-        return mnote_names_sharp.index(name)
+    # Not a name, might be a number
+    try:
+        mnote = int(note)
+    except ValueError:
+        return None
+    if 0 <= mnote <= max_mnote:
+        return mnote
     return None
 
+# frequency of a MIDI note (A4 = 440 Hz)
+
+def freq_for_note(mnote):
+    return 440.0 * pow(2.0, (mnote - 69) / 12.0)
+
+
+# MIDI file variable-length quantity: returns (value, next position)
+
+def _varlen(data, pos):
+    val = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        val = (val << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            return (val, pos)
+
+# Read the note-ons from a standard MIDI file, all tracks merged.
+# Returns a list of (mnote, seconds), in time order.
+
+def read_midi_notes(fname):
+    with open(fname, "rb") as f:
+        data = f.read()
+
+    if data[0:4] != b"MThd":
+        raise Exception("%s: not a MIDI file" % fname)
+    hlen = int.from_bytes(data[4:8], "big")
+    ntracks = int.from_bytes(data[10:12], "big")
+    division = int.from_bytes(data[12:14], "big")
+    if division & 0x8000:
+        # SMPTE: frames per second and ticks per frame
+        fps = 256 - (division >> 8)
+        ticks_per_sec = fps * (division & 0xff)
+        division = 0
+    pos = 8 + hlen
+
+    tempos = []         # (tick, usec per quarter)
+    ons = []            # (tick, mnote)
+
+    for track in range(ntracks):
+        if data[pos:pos+4] != b"MTrk":
+            raise Exception("%s: bad track header" % fname)
+        tlen = int.from_bytes(data[pos+4:pos+8], "big")
+        pos += 8
+        tend = pos + tlen
+        tick = 0
+        status = 0
+        while pos < tend:
+            (delta, pos) = _varlen(data, pos)
+            tick += delta
+
+            if data[pos] & 0x80:
+                status = data[pos]
+                pos += 1
+
+            if status == 0xff:
+                mtype = data[pos]
+                pos += 1
+                (mlen, pos) = _varlen(data, pos)
+                if mtype == 0x51:
+                    tempos.append((tick, int.from_bytes(data[pos:pos+3], "big")))
+                pos += mlen
+            elif status in (0xf0, 0xf7):
+                (slen, pos) = _varlen(data, pos)
+                pos += slen
+            elif status & 0xf0 in (0xc0, 0xd0):
+                pos += 1
+            else:
+                if status & 0xf0 == 0x90 and data[pos+1] > 0:
+                    ons.append((tick, data[pos]))
+                pos += 2
+        pos = tend
+
+    # convert ticks to seconds using the tempo map
+
+    tempos.sort()
+    ons.sort()
+    notes = []
+    tempo = 500000
+    tempo_tick = 0
+    tempo_sec = 0.0
+    tix = 0
+    for (tick, mnote) in ons:
+        if not division:
+            notes.append((mnote, tick / float(ticks_per_sec)))
+            continue
+        while tix < len(tempos) and tempos[tix][0] <= tick:
+            tempo_sec += (tempos[tix][0] - tempo_tick) * tempo / (division * 1e6)
+            tempo_tick = tempos[tix][0]
+            tempo = tempos[tix][1]
+            tix += 1
+        notes.append((mnote, tempo_sec + (tick - tempo_tick) * tempo / (division * 1e6)))
+
+    return notes
+
+
+# Read a note list: one note per line, as a MIDI note number or name,
+# optionally followed by the time (in seconds) the note starts.
+# "#" starts a comment.  Returns a list of (mnote, seconds or None).
+
+def read_note_list(fname):
+    notes = []
+    with open(fname, "r") as f:
+        lineno = 0
+        for line in f:
+            lineno += 1
+            line = line.split("#")[0].replace(",", " ").split()
+            if not line:
+                continue
+            mnote = notenum(line[0])
+            if mnote == None:
+                raise Exception("%s line %d: invalid note '%s'" % (fname, lineno, line[0]))
+            onset = None
+            if len(line) > 1:
+                onset = float(line[1])
+            notes.append((mnote, onset))
+    return notes
+
+
+# Read notes from either a MIDI file or a note list
+
+def read_notes(fname):
+    if fname.lower().endswith((".mid", ".midi")):
+        return read_midi_notes(fname)
+    return read_note_list(fname)
+
 
 if __name__ == "__main__":
 
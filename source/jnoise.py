@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+# Estimate the noise floor of a layer file.
+#
+# The whole file is measured once, in short RMS frames taken from the
+# wave's envelope.  The frame levels are binned into a histogram, and
+# the floor is the most common level (the mode) or a low percentile.
+# In a layer file most of the frames are the silence between notes,
+# so either is a robust estimate of the room noise.
+#
+# If the noise drifts during a long session, the floor can also be
+# estimated separately for each segment of the file.
+
+import sys
+
+import numpy as np
+
+import jwave
+
+# user configurable parameters
+
+_frame_time     = 0.05          # seconds per RMS frame
+_bin_db         = 0.5           # dB, histogram bin width
+_method         = "mode"        # "mode" or "percentile"
+_percentile     = 10.0          # percentile of frame levels, for "percentile"
+_segment_time   = 0             # seconds per segment for time-varying floor (0 = whole file)
+
+
+# Estimate a floor from an array of frame levels, in dB
+
+def floor_of(levels, method=None, percentile=None):
+    if method is None:
+        method = _method
+    if percentile is None:
+        percentile = _percentile
+
+    if len(levels) == 0:
+        return None
+
+    if method == "percentile":
+        return float(np.percentile(levels, percentile))
+
+    if method != "mode":
+        print("Unknown noise floor method '%s'" % method, file=sys.stderr)
+        sys.exit(1)
+
+    lo = np.floor(levels.min() / _bin_db) * _bin_db
+    nbins = int((levels.max() - lo) / _bin_db) + 1
+    counts = np.bincount(((levels - lo) / _bin_db).astype(np.int64), minlength=nbins)
+
+    # smooth over three bins so a ragged histogram doesn't pick a stray bin
+    if nbins >= 3:
+        counts = np.convolve(counts, np.ones(3, dtype=np.int64), mode="same")
+
+    return float(lo + (np.argmax(counts) + 0.5) * _bin_db)
+
+
+class NoiseFloor:
+    def __init__(self, wave, segment_time=None, method=None, percentile=None):
+        if segment_time is None:
+            segment_time = _segment_time
+
+        self.wave = wave
+        self.method = method
+        self.percentile = percentile
+        self.frameLen = max(1, int(_frame_time * wave.fmt.sampleRate))
+        self.env = wave.envelope(self.frameLen)
+        if segment_time:
+            self.segFrames = max(1, int(segment_time * wave.fmt.sampleRate) // self.frameLen)
+        else:
+            self.segFrames = 0
+        self.measured = -1          # frames measured when floors were computed
+        self.floor = None
+        self.floors = []
+
+    # (Re)compute the floors if the envelope has grown
+
+    def update(self):
+        levels = self.env.levels()
+        if len(levels) == self.measured:
+            return
+        self.measured = len(levels)
+        self.floor = floor_of(levels, self.method, self.percentile)
+        self.floors = []
+        if self.segFrames:
+            for start in range(0, len(levels), self.segFrames):
+                self.floors.append(floor_of(levels[start:start + self.segFrames],
+                    self.method, self.percentile))
+
+    # Noise floor in dB at the given sample number, or None if the
+    # file is too short to measure
+
+    def at(self, sn):
+        self.update()
+        if self.segFrames and self.floors:
+            seg = min(self.env.frameAt(sn) // self.segFrames, len(self.floors) - 1)
+            return self.floors[seg]
+        return self.floor
+
+
+def usage(prog):
+    print(file=sys.stderr)
+    print("%s: estimate the noise floor of wave files" % prog, file=sys.stderr)
+    print(file=sys.stderr)
+    print("  Usage: %s [-s <seconds>] {<wavefile>}" % prog, file=sys.stderr)
+    print(file=sys.stderr)
+    print("where:", file=sys.stderr)
+    print("  -s <seconds> also shows the floor for each segment of", file=sys.stderr)
+    print("     the given length.", file=sys.stderr)
+    print(file=sys.stderr)
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    import glob
+    import jtime
+
+    args = sys.argv
+    prog = args[0].split("\\")[-1]
+    del args[0]
+
+    segment_time = 0
+    if len(args) > 1 and args[0] == "-s":
+        segment_time = float(args[1])
+        del args[0:2]
+
+    if len(args) < 1:
+        usage(prog)
+
+    for fspec in args:
+        for fname in glob.glob(fspec):
+            with open(fname, "rb") as inf:
+                wave = jwave.WaveChunk(inf=inf)
+                wave.readHeader()
+                floor = NoiseFloor(wave, segment_time)
+                if floor.at(0) is None:
+                    print("%s: too short to measure" % fname)
+                    continue
+                print("%s: %6.2f dB" % (fname, floor.floor))
+                for seg in range(len(floor.floors)):
+                    sn = seg * floor.segFrames * floor.frameLen
+                    print("  %s %6.2f dB" % (jtime.hms(sn, wave.fmt.sampleRate), floor.floors[seg]))
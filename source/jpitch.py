@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+# Measure the pitch of a sample precisely, for tuning.
+#
+# The note is already known (from the file name or the sample
+# library), so we only need to find how far off it is.  A window from
+# the steady part of the note, after the attack, is autocorrelated
+# with an FFT, and the peak is searched for within half a semitone or
+# so of the note's period.  Parabolic interpolation around the peak
+# gives the period to a fraction of a sample, which is good to within
+# a cent for all but the highest notes (below about C7; "jpitch.py -c"
+# checks this on synthetic decaying notes).
+
+import sys
+import math
+
+import numpy as np
+
+import jwave
+import jmidi
+
+# user configurable parameters
+
+_skip_time      = 0.15          # seconds of attack to skip
+_window_time    = 0.5           # seconds to analyze (at most)
+_min_periods    = 8             # fewest periods of the note in the window
+_search_cents   = 70            # how far from the note to look for the peak
+
+
+# Frequency of a note in samps (floats, one channel), expected to be
+# near freq.  Returns None if there's no clear periodicity near there.
+
+def measure(samps, rate, freq):
+    samps = samps - samps.mean()
+    n = len(samps)
+    lo_lag = max(2, int(rate / (freq * pow(2.0, _search_cents / 1200.0))))
+    hi_lag = int(math.ceil(rate / (freq / pow(2.0, _search_cents / 1200.0)))) + 1
+    if n < 2 * hi_lag:
+        return None
+
+    # autocorrelation via the power spectrum (zero padded, so it's
+    # linear, not circular), normalized at each lag by the energies of
+    # the two parts that overlap there (so a decaying note isn't
+    # biased toward shorter lags)
+    size = 1 << int(math.ceil(math.log(2 * n, 2)))
+    spec = np.fft.rfft(samps, size)
+    corr = np.fft.irfft(spec.real ** 2 + spec.imag ** 2, size)[:hi_lag + 2]
+    if corr[0] <= 0:
+        return None
+    csum = np.concatenate(([0.0], np.cumsum(samps * samps)))
+    lags = np.arange(len(corr))
+    energy = csum[n - lags] * (csum[n] - csum[lags])
+    corr = corr / np.sqrt(np.maximum(energy, 1e-12))
+
+    lag = lo_lag + int(np.argmax(corr[lo_lag:hi_lag + 1]))
+    if lag <= lo_lag or lag >= hi_lag or corr[lag] < 0.5:
+        return None
+
+    # fit a parabola through the peak and its neighbors
+    (a, b, c) = corr[lag - 1:lag + 2]
+    denom = a - 2 * b + c
+    shift = 0.5 * (a - c) / denom if denom else 0.0
+    return rate / (lag + shift)
+
+
+# Measure a sample file (or the note from offset to end in a container),
+# expected to be MIDI note mnote.  Returns the frequency in Hz, or None.
+
+def pitch_of(path, mnote, offset=0, end=None):
+    freq = jmidi.freq_for_note(mnote)
+    with open(path, "rb") as inf:
+        wave = jwave.WaveChunk(inf=inf)
+        wave.readHeader()
+        rate = wave.fmt.sampleRate
+        if end is None:
+            end = wave.numSamples - 1
+        start = offset + int(_skip_time * rate)
+        length = max(int(_window_time * rate), int(_min_periods * rate / freq))
+        stop = min(end + 1, start + length)
+        # short notes: back up into the attack if need be
+        if stop - start < length:
+            start = max(offset, stop - length)
+        samps = wave.readMono(start, stop, None).astype(np.float64)
+    return measure(samps, rate, freq)
+
+
+# The "freq" section of a sample's metadata (see jmeta; it was
+# "pitch" before the measurement was normalized as it is now, so
+# indexes holding the old, biased measurements don't keep them)
+
+def pitch_info(path, mnote, offset=0, end=None):
+    return {"freq": pitch_of(path, mnote, offset, end)}
+
+
+# cents from the note to freq
+
+def cents_off(freq, mnote):
+    return 1200.0 * math.log(freq / jmidi.freq_for_note(mnote), 2)
+
+
+# Measure synthetic notes, perfectly in tune and decaying (quickly, as
+# low piano notes do after the attack), from mnote lo to hi (A0 to
+# Bb6), as
+# pitch_of() would window them.  Returns the worst error, in cents.
+
+def check(lo=21, hi=94, rate=44100, decays=(3.0, 8.0)):
+    worst = 0.0
+    for mnote in range(lo, hi + 1):
+        freq = jmidi.freq_for_note(mnote)
+        start = int(_skip_time * rate)
+        length = max(int(_window_time * rate), int(_min_periods * rate / freq))
+        t = np.arange(start, start + length) / float(rate)
+        for decay in decays:
+            samps = np.exp(-decay * t) * sum(np.sin(2 * np.pi * freq * h * t + h) / h
+                for h in range(1, 6) if freq * h < rate / 2.0)
+            found = measure(samps, rate, freq)
+            if found is None:
+                print("note %d, decay %g: no pitch found" % (mnote, decay), file=sys.stderr)
+                return None
+            off = cents_off(found, mnote)
+            if abs(off) > abs(worst):
+                worst = off
+    return worst
+
+
+if __name__ == "__main__":
+
+    args = sys.argv
+    prog = args[0].split("\\")[-1]
+    del args[0]
+
+    if args == ["-c"]:
+        worst = check()
+        if worst is None:
+            sys.exit(1)
+        print("synthetic decaying notes: worst error %+.2f cents" % worst)
+        sys.exit(0 if abs(worst) <= 1.0 else 1)
+
+    if len(args) < 2:
+        print("usage: %s <note> {<wavefile>} -- measure the tuning of samples of a note"
+            % prog, file=sys.stderr)
+        print("       %s -c -- check the measurement on synthetic notes" % prog, file=sys.stderr)
+        sys.exit(1)
+
+    mnote = jmidi.notenum(args[0])
+    if mnote is None:
+        print("%s: not a note: %s" % (prog, args[0]), file=sys.stderr)
+        sys.exit(1)
+
+    for path in args[1:]:
+        freq = pitch_of(path, mnote)
+        if freq is None:
+            print("%s: no pitch found" % path)
+        else:
+            print("%s: %8.3f Hz, %+6.1f cents" % (path, freq, cents_off(freq, mnote)))
@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+# Change the sample rate of samples (e.g. 44.1 to 48 kHz).
+#
+# A polyphase resampler: for a ratio of up/down (160/147 for 44.1 to
+# 48 kHz), the output is the input upsampled by up, low-pass filtered,
+# and downsampled by down -- but only the filter taps that land on
+# input samples are computed, and only for the outputs that are kept.
+# The filter is a Kaiser-windowed sinc.  Input is taken in blocks of
+# any size, with the input the filter still needs carried over to the
+# next block, so a file of any length is converted in bounded memory.
+#
+# jCutSamps uses this to write notes at another rate (-r).  Run as a
+# program, this converts sample files in a pool of processes, moving
+# their loop points to match.
+
+import sys
+import os
+import os.path
+import glob
+import math
+import concurrent.futures
+
+import numpy as np
+
+import jwave
+import jriff
+
+# user configurable parameters
+
+_taps           = 96            # filter taps per output sample
+_cutoff         = 0.94          # pass band, as a fraction of the lower Nyquist frequency
+_beta           = 8.6           # Kaiser window shape (8.6: about -90 dB stop band)
+
+_chunk          = 4096          # outputs computed at a time
+
+
+# Number of samples at out_rate for n samples at in_rate
+
+def out_length(n, in_rate, out_rate):
+    return (n * out_rate + in_rate - 1) // in_rate
+
+# Sample number at out_rate for sample number sn at in_rate
+
+def rescale(sn, in_rate, out_rate):
+    return int(round(sn * out_rate / float(in_rate)))
+
+
+class Resampler:
+    def __init__(self, in_rate, out_rate, channels):
+        g = math.gcd(in_rate, out_rate)
+        self.up = out_rate // g
+        self.down = in_rate // g
+
+        # odd length, so the filter's delay is a whole number of
+        # upsampled samples; then padded to a multiple of up
+        up = self.up
+        n = up * _taps + 1
+        fc = 0.5 * _cutoff / max(up, self.down)
+        ix = np.arange(n) - (n - 1) / 2.0
+        h = 2 * fc * np.sinc(2 * fc * ix) * np.kaiser(n, _beta) * up
+        self.taps = _taps + 1
+        h = np.concatenate((h, np.zeros(up * self.taps - n)))
+        self.phases = h.reshape(self.taps, up).T.copy()   # [phase, tap]
+        self.delay = (n - 1) // 2
+
+        self.nin = 0                # input samples so far
+        self.k = 0                  # next output sample
+        self.base = -self.taps      # input sample number of buf[0]
+        self.buf = np.zeros((self.taps, channels))
+
+    # Resample a block of frames (shape (n, channels)), returning the
+    # output frames that are complete (floats).
+    def process(self, frames):
+        self.nin += len(frames)
+        self.buf = np.concatenate((self.buf, frames))
+        last = self.base + len(self.buf) - 1
+        return self.run(((last + 1) * self.up - 1 - self.delay) // self.down)
+
+    # The rest of the output, once all the input has been given
+    def flush(self):
+        kmax = out_length(self.nin, self.down, self.up) - 1
+        need = (kmax * self.down + self.delay) // self.up + 1 - (self.base + len(self.buf))
+        if need > 0:
+            self.buf = np.concatenate((self.buf, np.zeros((need, self.buf.shape[1]))))
+        return self.run(kmax)
+
+    # Output samples self.k to kmax
+    def run(self, kmax):
+        ks = np.arange(self.k, kmax + 1)
+        out = np.empty((len(ks), self.buf.shape[1]))
+        t = ks * self.down + self.delay
+        first = t // self.up - self.base
+        phase = t % self.up
+        back = np.arange(self.taps)
+        for ix in range(0, len(ks), _chunk):
+            sl = slice(ix, ix + _chunk)
+            win = self.buf[first[sl, np.newaxis] - back]
+            out[sl] = np.einsum("kt,ktc->kc", self.phases[phase[sl]], win)
+
+        self.k = max(self.k, kmax + 1)
+        keep = (self.k * self.down + self.delay) // self.up - self.taps + 1 - self.base
+        if keep > 0:
+            self.buf = self.buf[keep:]
+            self.base += keep
+        return out
+
+
+# Convert a sample file to rate, into outfname (which may be the same
+# file).  Loop points (in a smpl chunk) are moved to match.  Returns
+# the number of frames written.
+
+def resample_file(fname, outfname, rate, block=1 << 16):
+    with open(fname, "rb") as inf:
+        wave = jwave.WaveChunk(inf=inf)
+        wave.readChunkDir()
+        smpl = wave.readSmpl()
+        inf.seek(0)
+        wave.readHeader()
+        if wave.fmt.compCode != 1:
+            raise ValueError("compressed formats unsupported")
+        in_rate = wave.fmt.sampleRate
+
+        tmpname = "%s.tmp%d" % (outfname, os.getpid())
+        with open(tmpname, "wb") as outf:
+            owave = jwave.WaveChunk(outf=outf)
+            owave.copyHeader(wave)
+            owave.setRate(rate)
+            owave.writeHeader(out_length(wave.numSamples, in_rate, rate))
+            resampler = Resampler(in_rate, rate, wave.fmt.numChan)
+            count = 0
+            for sn in range(0, wave.numSamples, block):
+                frames = resampler.process(wave.readFrames(sn, sn + block))
+                owave.writeFrames(np.rint(frames))
+                count += len(frames)
+            frames = resampler.flush()
+            owave.writeFrames(np.rint(frames))
+            count += len(frames)
+            owave.finishHeader(count)
+            if smpl:
+                (unity, loops) = smpl
+                loops = [(ltype, rescale(start, in_rate, rate), rescale(end, in_rate, rate))
+                    for (ltype, start, end) in loops]
+                owave.appendChunk("smpl", jriff.smpl_data(rate, unity, loops))
+    os.replace(tmpname, outfname)
+    return count
+
+
+def resample_job(job):
+    (fname, outfname, rate) = job
+    try:
+        return (resample_file(fname, outfname, rate), None)
+    except (IOError, OSError, ValueError, EOFError) as msg:
+        return (None, str(msg))
+
+
+def usage(prog):
+    print(file=sys.stderr)
+    print("%s: change the sample rate of sample files" % prog, file=sys.stderr)
+    print(file=sys.stderr)
+    print("  Usage: %s -r <rate> [-o <outfolder>] [-j <jobs>] {<wavefile>}" % prog, file=sys.stderr)
+    print(file=sys.stderr)
+    print("where:", file=sys.stderr)
+    print("  -r <rate> is the new sample rate, in Hz.", file=sys.stderr)
+    print("  -o <outfolder> writes the new files there, rather than", file=sys.stderr)
+    print("     replacing the originals.", file=sys.stderr)
+    print("  -j <jobs> sets the number of processes (default: one per CPU).", file=sys.stderr)
+    print(file=sys.stderr)
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    args = sys.argv
+    prog = args[0].split("\\")[-1]
+    del args[0]
+
+    rate = None
+    folder = None
+    workers = None
+    while len(args) > 1 and args[0].startswith("-"):
+        if args[0] == "-r":
+            rate = int(args[1])
+        elif args[0] == "-o":
+            folder = args[1]
+        elif args[0] == "-j":
+            workers = int(args[1])
+        else:
+            usage(prog)
+        del args[0:2]
+
+    fnames = []
+    for fspec in args:
+        fnames.extend(glob.glob(fspec))
+    if not rate or not fnames:
+        usage(prog)
+
+    jobs = []
+    for fname in fnames:
+        outfname = fname
+        if folder:
+            outfname = os.path.join(folder, os.path.basename(fname))
+        jobs.append((fname, outfname, rate))
+
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        for (job, (count, msg)) in zip(jobs, pool.map(resample_job, jobs)):
+            if msg is not None:
+                print("%s: %s, skipped" % (job[0], msg), file=sys.stderr)
+                failed += 1
+            else:
+                print("%s: %d frames" % (job[1], count))
+
+    print("%d files, %d skipped" % (len(jobs), failed), file=sys.stderr)
@@ -10,6 +10,7 @@
 # option to extract a chunk
 
 import sys
+import struct
 import jio
 
 majors = (
@@ -26,6 +27,61 @@ def roundup(ln):
         return ln + 1
     return ln
 
+# Write a chunk: header, data, and a pad byte if the length is odd.
+
+def put_chunk(outf, ctype, data):
+    outf.write(ctype.encode("latin-1"))
+    jio.put_uint32(outf, len(data))
+    outf.write(data)
+    if len(data) & 1:
+        outf.write(b"\0")
+    return 8 + roundup(len(data))
+
+# Data for a smpl chunk, with loops as (type, start, end) in samples
+# (type 0 loops forward).
+
+def smpl_data(rate, unity, loops):
+    data = struct.pack("<9I", 0, 0, 1000000000 // rate, unity, 0, 0, 0, len(loops), 0)
+    for (ix, (ltype, start, end)) in enumerate(loops):
+        data += struct.pack("<6I", ix, ltype, start, end, 0, 0)
+    return data
+
+# Copy a RIFF file from inf to outf with one kind of chunk replaced:
+# any top-level ctype chunks are left out, and data is written as a
+# new one at the end.  Returns the size of the new file.
+
+def replace_chunk(inf, outf, ctype, data):
+    inf.seek(0, 2)
+    fsize = inf.tell()
+    inf.seek(0)
+    head = inf.read(12)
+    if len(head) < 12 or head[0:4] != b"RIFF":
+        raise ValueError("not a RIFF file")
+    outf.write(head)
+    pos = 12
+    while pos + 8 <= fsize:
+        inf.seek(pos)
+        (ctag, size) = struct.unpack("<4sI", inf.read(8))
+        span = 8 + roundup(size)
+        if pos + 8 + size > fsize:
+            raise ValueError("truncated %s chunk" % ctag.decode("latin-1"))
+        if ctag.decode("latin-1") != ctype:
+            inf.seek(pos)
+            left = min(span, fsize - pos)
+            while left > 0:
+                block = inf.read(min(left, 1 << 20))
+                outf.write(block)
+                left -= len(block)
+        pos += span
+    if outf.tell() & 1:
+        outf.write(b"\0")
+    put_chunk(outf, ctype, data)
+    size = outf.tell()
+    outf.seek(4)
+    jio.put_uint32(outf, size - 8)
+    outf.seek(size)
+    return size
+
 class Chunk:
     def __init__(self, riffFile, parent):
         self.parent = parent
@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+# Trim the near-silent tails of samples.
+#
+# jCutSamps keeps each note until it falls to the noise floor, so most
+# samples end with seconds that are far below anything audible in a
+# mix.  Here, the end of a sample is where its RMS envelope last falls
+# below a threshold relative to its peak (-80 dB by default), plus a
+# short fade.
+#
+# jMap uses find_tail() to emit end= (see "trim-tails" in the .sfc).
+# Run as a program, this rewrites sample files with the tails cut off
+# and faded out, in a pool of processes.
+
+import sys
+import os
+import os.path
+import glob
+import concurrent.futures
+
+import numpy as np
+
+import jwave
+
+# user configurable parameters
+
+_threshold_db   = -80.0         # dB relative to the peak, where the tail starts
+_frame_time     = 0.01          # seconds per envelope frame
+_fade_time      = 0.01          # seconds of fade after the tail starts
+
+
+# Last sample to keep of the note from offset to end (inclusive) in
+# an open wave, or of the whole file.  The fade, if any, is included.
+
+def find_tail(wave, threshold_db=None, offset=0, end=None, fade_time=None):
+    if threshold_db is None:
+        threshold_db = _threshold_db
+    if fade_time is None:
+        fade_time = _fade_time
+    if end is None:
+        end = wave.numSamples - 1
+
+    rate = wave.fmt.sampleRate
+    frameLen = max(1, int(_frame_time * rate))
+    env = wave.envelope(frameLen)
+    env.extend(end + 1)
+    levels = env.levels()
+
+    first = env.frameAt(offset)
+    last = min(len(levels), env.frameAt(end + 1))
+    levels = levels[first:last]
+    if len(levels) == 0:
+        return end
+
+    loud = np.flatnonzero(levels >= levels.max() + threshold_db)
+    tail = (first + int(loud[-1]) + 1) * frameLen - 1
+    return min(end, tail + int(fade_time * rate))
+
+
+# The "tail" section of a sample's metadata (see jmeta)
+
+def tail_info(path, threshold_db, offset=0, end=None):
+    with open(path, "rb") as inf:
+        wave = jwave.WaveChunk(inf=inf)
+        wave.readHeader()
+        return {"end": find_tail(wave, threshold_db, offset, end)}
+
+
+# Rewrite a sample file without its tail, into outfname (which may be
+# the same file).  Returns (frames before, frames after).
+
+def trim_file(fname, outfname, threshold_db=None, fade_time=None, dry_run=False):
+    if fade_time is None:
+        fade_time = _fade_time
+
+    with open(fname, "rb") as inf:
+        wave = jwave.WaveChunk(inf=inf)
+        wave.readChunkDir()
+        smpl = wave.readSmpl()
+        if smpl and smpl[1]:
+            raise ValueError("has loops")
+        inf.seek(0)
+        wave.readHeader()
+        if wave.fmt.compCode != 1:
+            raise ValueError("compressed formats unsupported")
+
+        nframes = wave.numSamples
+        end = find_tail(wave, threshold_db, fade_time=fade_time)
+        trimmed = end < nframes - 1
+        if dry_run or (not trimmed and outfname == fname):
+            return (nframes, end + 1)
+
+        fadeLen = 0
+        if trimmed:
+            fadeLen = min(end + 1, int(fade_time * wave.fmt.sampleRate))
+        tmpname = "%s.tmp%d" % (outfname, os.getpid())
+        with open(tmpname, "wb") as outf:
+            owave = jwave.WaveChunk(outf=outf)
+            owave.copyHeader(wave)
+            owave.writeHeader(end + 1)
+            owave.copySamples(wave, 0, end - fadeLen)
+            if fadeLen:
+                frames = wave.readFrames(end + 1 - fadeLen, end + 1).astype(np.float64)
+                gain = 0.5 + 0.5 * np.cos(np.pi * (np.arange(fadeLen) + 1) / fadeLen)
+                owave.writeFrames(np.round(frames * gain[:, np.newaxis]).astype(np.int32))
+    os.replace(tmpname, outfname)
+    return (nframes, end + 1)
+
+
+def trim_job(job):
+    (fname, outfname, threshold_db, dry_run) = job
+    try:
+        return (trim_file(fname, outfname, threshold_db, dry_run=dry_run), None)
+    except (IOError, OSError, ValueError, EOFError) as msg:
+        return (None, str(msg))
+
+
+def usage(prog):
+    print(file=sys.stderr)
+    print("%s: trim the near-silent tails of sample files" % prog, file=sys.stderr)
+    print(file=sys.stderr)
+    print("  Usage: %s [-n] [-t <dB>] [-o <outfolder>] [-j <jobs>] {<wavefile>}" % prog, file=sys.stderr)
+    print(file=sys.stderr)
+    print("where:", file=sys.stderr)
+    print("  -n only shows what would be trimmed.", file=sys.stderr)
+    print("  -t <dB> is the level relative to the peak where the tail", file=sys.stderr)
+    print("     starts (default %g)." % _threshold_db, file=sys.stderr)
+    print("  -o <outfolder> writes the trimmed files there, rather than", file=sys.stderr)
+    print("     replacing the originals.", file=sys.stderr)
+    print("  -j <jobs> sets the number of processes (default: one per CPU).", file=sys.stderr)
+    print("  Files with loops are left alone.", file=sys.stderr)
+    print(file=sys.stderr)
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    args = sys.argv
+    prog = args[0].split("\\")[-1]
+    del args[0]
+
+    dry_run = False
+    threshold_db = _threshold_db
+    folder = None
+    workers = None
+    while len(args) > 0 and args[0].startswith("-"):
+        if args[0] == "-n":
+            dry_run = True
+            del args[0]
+        elif len(args) > 1 and args[0] == "-t":
+            threshold_db = float(args[1])
+            del args[0:2]
+        elif len(args) > 1 and args[0] == "-o":
+            folder = args[1]
+            del args[0:2]
+        elif len(args) > 1 and args[0] == "-j":
+            workers = int(args[1])
+            del args[0:2]
+        else:
+            usage(prog)
+
+    fnames = []
+    for fspec in args:
+        fnames.extend(glob.glob(fspec))
+    if not fnames:
+        usage(prog)
+
+    jobs = []
+    for fname in fnames:
+        outfname = fname
+        if folder:
+            outfname = os.path.join(folder, os.path.basename(fname))
+        jobs.append((fname, outfname, threshold_db, dry_run))
+
+    before = after = 0
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        for (job, (result, msg)) in zip(jobs, pool.map(trim_job, jobs, chunksize=8)):
+            if msg is not None:
+                print("%s: %s, skipped" % (job[0], msg), file=sys.stderr)
+                failed += 1
+                continue
+            (nframes, kept) = result
+            before += nframes
+            after += kept
+            print("%s: %d -> %d frames" % (job[0], nframes, kept))
+
+    if before:
+        print("%d files, %d%% of the frames kept, %d skipped"
+            % (len(jobs), round(100.0 * after / before), failed), file=sys.stderr)
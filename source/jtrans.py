@@ -1,13 +1,22 @@
 # equivalent of unix "tr"
 
 import string
+import functools
 
-def tr(inp, fromstr, tostr, deletechars=""):
+# The translation tables are built once for each set of arguments.
 
+@functools.lru_cache(maxsize=64)
+def _tables(fromstr, tostr, deletechars):
     if len(tostr) < len(fromstr):
         pad = tostr[-1]
         while len(tostr) < len(fromstr):
             tostr += pad
-    ret = inp.translate(inp.maketrans(fromstr, tostr))
-    ret = ret.translate(ret.maketrans("", "", deletechars))
+    return (str.maketrans(fromstr, tostr), str.maketrans("", "", deletechars))
+
+def tr(inp, fromstr, tostr, deletechars=""):
+
+    (table, deltable) = _tables(fromstr, tostr, deletechars)
+    ret = inp.translate(table)
+    if deletechars:
+        ret = ret.translate(deltable)
     return ret
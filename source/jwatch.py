@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+# Wait for files to change.
+#
+# The files are given as names or glob patterns.  On Linux, inotify
+# wakes us as soon as anything in their directories is written,
+# created, deleted or renamed into place (which is how most editors
+# save); elsewhere, or if inotify isn't available, we poll.  Either
+# way, the files' sizes and mtimes decide what actually changed.
+
+import sys
+import os
+import os.path
+import glob
+import time
+import select
+import ctypes
+import ctypes.util
+
+# user configurable parameters
+
+_poll_time      = 0.05          # seconds between polls, without inotify
+_settle_time    = 0.02          # seconds to let a burst of events finish
+
+# inotify events of interest
+IN_MODIFY       = 0x002
+IN_CLOSE_WRITE  = 0x008
+IN_MOVED_FROM   = 0x040
+IN_MOVED_TO     = 0x080
+IN_CREATE       = 0x100
+IN_DELETE       = 0x200
+
+_events = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+class Watcher:
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.stamps = self.snapshot()
+        self.fd = None
+        self.dirs = set()
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            self.add_watch = libc.inotify_add_watch
+            fd = libc.inotify_init1(os.O_NONBLOCK)
+            if fd >= 0:
+                self.fd = fd
+                self.watch_dirs()
+        except (OSError, AttributeError):
+            self.fd = None
+
+    # {fname: (mtime, size)} for every file the patterns match
+
+    def snapshot(self):
+        stamps = {}
+        for pattern in self.patterns:
+            for fname in glob.glob(pattern):
+                try:
+                    st = os.stat(fname)
+                except OSError:
+                    continue
+                stamps[fname] = (st.st_mtime_ns, st.st_size)
+        return stamps
+
+    # Watch the directories the patterns look in (directories that
+    # match a wildcard can come and go, so this is redone each time).
+
+    def watch_dirs(self):
+        for pattern in self.patterns:
+            for dname in glob.glob(os.path.dirname(pattern) or "."):
+                if dname not in self.dirs:
+                    if self.add_watch(self.fd, dname.encode(), _events) >= 0:
+                        self.dirs.add(dname)
+
+    def drain(self):
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    # Block until any of the files change, and return the set of names
+    # that were added, removed or modified.
+
+    def wait(self):
+        while True:
+            if self.fd is not None:
+                select.select([self.fd], [], [])
+                time.sleep(_settle_time)
+                self.drain()
+                self.watch_dirs()
+            else:
+                time.sleep(_poll_time)
+            stamps = self.snapshot()
+            changed = set(fname for fname in set(stamps) | set(self.stamps)
+                if stamps.get(fname) != self.stamps.get(fname))
+            self.stamps = stamps
+            if changed:
+                return changed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+if __name__ == "__main__":
+
+    args = sys.argv
+    prog = args[0].split("\\")[-1]
+    del args[0]
+
+    if len(args) < 1:
+        print("usage: %s {<file or pattern>} -- show changes as they happen" % prog, file=sys.stderr)
+        sys.exit(1)
+
+    watcher = Watcher(args)
+    print("Watching (%s)" % ("inotify" if watcher.fd is not None else "polling"), file=sys.stderr)
+    try:
+        while True:
+            for fname in sorted(watcher.wait()):
+                print(time.strftime("%H:%M:%S"), fname)
+    except KeyboardInterrupt:
+        watcher.close()
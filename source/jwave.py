@@ -3,15 +3,19 @@
 
 import math
 import time
+import bisect
 import profile
 import warnings
 import sys
 
 import struct
 
+import numpy as np
+
 import jtime
 
 import jio
+import jriff
 
 def v2dB(v):
     if (v == 0):
@@ -30,6 +34,9 @@ def dB2v24(db):
 def dB2v16(db):
     return int(math.exp(db * math.log(10) / 20) * 0x7fff)
 
+# frames per block when building per-file analysis caches (crossing index)
+_block_len = 1 << 16
+
 class Chunk:
 
     def __init__(self, inf=None, outf=None):
@@ -74,6 +81,9 @@ class WaveChunk(Chunk):
     def __init__(self, riff=None, inf=None, outf=None):
         Chunk.__init__(self, inf, outf)
         self.riff = riff
+        self.crossChan = 0      # channel for crossing index; None = sum of channels
+        self.xing = None
+        self.envs = {}          # Envelope for each frame length
 
     def readHeader(self):
         if self.riff == None:
@@ -162,6 +172,17 @@ class WaveChunk(Chunk):
         data.writeHeader()
         self.start = 28 + fmt.size
 
+    # Rewrite the RIFF and data chunk sizes in a header that has already
+    # been written, once the number of samples is known.
+    def finishHeader(self, nsamples):
+        here = self.outf.tell()
+        self.riff.size = 28 + self.fmt.size + nsamples * self.fmt.blockAlign
+        self.outf.seek(4)
+        jio.put_uint32(self.outf, self.riff.size)
+        self.outf.seek(self.start - 4)
+        jio.put_uint32(self.outf, nsamples * self.fmt.blockAlign)
+        self.outf.seek(here)
+
     # copy samples from given input wave file to self's output wave file
     # Assume seek has already happened on self
     def copySamples(self, iwave, start_sn, end_sn):
@@ -212,6 +233,8 @@ class WaveChunk(Chunk):
             fmt.extraFmtBytes = src.fmt.extraFmtBytes
 
         self.fmt    = fmt
+        self.bytesPerVal = src.bytesPerVal
+        self.fullScale = src.fullScale
         self.getval = src.getval
         self.putval = src.putval
         self.dB2v   = src.dB2v
@@ -222,12 +245,14 @@ class WaveChunk(Chunk):
         self.start = 28 + fmt.size
 
     def setup16(self):
+        self.fullScale = 0x7fff
         self.getval = jio.get_sint16
         self.putval = jio.put_sint16
         self.dB2v   = dB2v16
         self.v2dB   = v2dB16
 
     def setup24(self):
+        self.fullScale = 0x7fffff
         self.getval = jio.get_sint24
         self.putval = jio.put_sint24
         self.dB2v   = dB2v24
@@ -309,6 +334,185 @@ class WaveChunk(Chunk):
     def get_sample_count(self):
         return self.numSamples
 
+    # Re-read the data chunk size, for a file that's still being recorded.
+    # Recorders often leave the size at 0 (or 0xffffffff) until they close
+    # the file, so the data is also limited to what's actually on disk.
+    def refresh(self):
+        self.inf.seek(self.start - 4)
+        size = jio.get_uint32(self.inf)
+        self.inf.seek(0, 2)
+        avail = (self.inf.tell() - self.start) // self.fmt.blockAlign
+        if size == 0:
+            self.numSamples = avail
+        else:
+            self.numSamples = min(size // self.fmt.blockAlign, avail)
+        return self.numSamples
+
+    # Read frames [start, end) of all channels into an int32 array
+    # of shape (frames, numChan).
+    def readFrames(self, start, end):
+        start = max(0, start)
+        end = min(end, self.numSamples)
+        nchan = self.fmt.numChan
+        if end <= start:
+            return np.zeros((0, nchan), dtype=np.int32)
+        self.seekSample(start)
+        raw = self.inf.read((end - start) * self.fmt.blockAlign)
+        nframes = len(raw) // self.fmt.blockAlign
+        raw = raw[:nframes * self.fmt.blockAlign]
+        if self.bytesPerVal == 2:
+            vals = np.frombuffer(raw, dtype="<i2").astype(np.int32)
+        elif self.bytesPerVal == 3:
+            b = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+            vals = b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)
+            vals = (vals ^ 0x800000) - 0x800000
+        else:
+            print("readFrames: unsupported sample size")
+            sys.exit(1)
+        return vals.reshape(nframes, nchan)
+
+    # Read one channel (or the sum of all channels if chan is None)
+    # for frames [start, end).
+    def readMono(self, start, end, chan=0):
+        frames = self.readFrames(start, end)
+        if chan is None:
+            return frames.sum(axis=1)
+        return frames[:, chan]
+
+    # Write frames (ints, shape (n, numChan)) at the current output
+    # position, clipped to the sample size.
+    def writeFrames(self, frames):
+        vals = np.clip(np.asarray(frames).reshape(-1), -self.fullScale - 1, self.fullScale)
+        if self.bytesPerVal == 2:
+            raw = vals.astype("<i2").tobytes()
+        elif self.bytesPerVal == 3:
+            raw = vals.astype("<i4").view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+        else:
+            print("writeFrames: unsupported sample size")
+            sys.exit(1)
+        self.outf.write(raw)
+
+    # Change the channel count of a header set up by copyHeader(),
+    # before writeHeader().
+    def setChannels(self, numChan):
+        self.fmt.numChan = numChan
+        self.fmt.blockAlign = numChan * self.bytesPerVal
+        self.fmt.aveBytesPerSec = self.fmt.sampleRate * self.fmt.blockAlign
+
+    # Change the sample size (16 or 24 bits) of a header set up by
+    # copyHeader(), before writeHeader().
+    def setBits(self, bits):
+        self.fmt.bitsPerSample = bits
+        self.bytesPerVal = bits // 8
+        if bits == 16:
+            self.setup16()
+        elif bits == 24:
+            self.setup24()
+        else:
+            print("setBits: unsupported sample size")
+            sys.exit(1)
+        self.setChannels(self.fmt.numChan)
+
+    # Change the sample rate of a header set up by copyHeader(), before
+    # writeHeader().
+    def setRate(self, rate):
+        self.fmt.sampleRate = rate
+        self.fmt.aveBytesPerSec = rate * self.fmt.blockAlign
+
+    # Add a chunk after the data of a finished file, and fix up the
+    # RIFF size to include it.
+    def appendChunk(self, ctype, data):
+        self.outf.seek(0, 2)
+        if self.outf.tell() & 1:
+            self.outf.write(b"\0")     # pad an odd-length data chunk
+        jriff.put_chunk(self.outf, ctype, data)
+        self.riff.size = self.outf.tell() - 8
+        self.outf.seek(4)
+        jio.put_uint32(self.outf, self.riff.size)
+        self.outf.seek(0, 2)
+
+    # Whether every channel is within tolerance (in sample values) of
+    # the first, for frames [start, end) -- that is, whether the file
+    # is really mono.
+    def channelsMatch(self, tolerance, start=0, end=None):
+        if end is None:
+            end = self.numSamples
+        if self.fmt.numChan < 2:
+            return True
+        for sn in range(start, end, _block_len):
+            frames = self.readFrames(sn, min(sn + _block_len, end))
+            if np.abs(frames[:, 1:] - frames[:, :1]).max(initial=0) > tolerance:
+                return False
+        return True
+
+    def crossings(self):
+        if self.xing is None:
+            self.xing = CrossingIndex(self, self.crossChan)
+        return self.xing
+
+    # RMS envelope of channel 0 in frames of frameLen samples
+    def envelope(self, frameLen):
+        if frameLen not in self.envs:
+            self.envs[frameLen] = Envelope(self, frameLen)
+        return self.envs[frameLen]
+
+    # Sample number of the last sample before the most recent zero
+    # crossing at or before sample n, or n if there is none.
+    def prevCrossing(self, n, slope=0):
+        sn = self.crossings().prev(n, slope)
+        if sn is None:
+            return n
+        return sn - 1
+
+    # Read the chunk directory: self.chunks maps each top-level chunk
+    # type to (file offset of its data, size).  Only the chunk headers
+    # are read, so this is cheap however long the file is.  A chunk
+    # that runs past the end of the file (still being recorded, or
+    # truncated) is cut to what's on disk.
+    def readChunkDir(self):
+        self.inf.seek(0, 2)
+        fsize = self.inf.tell()
+        self.inf.seek(0)
+        head = self.inf.read(12)
+        if len(head) < 12 or head[0:4] != b"RIFF" or head[8:12] != b"WAVE":
+            raise ValueError("not a RIFF WAVE file")
+        self.type = "WAVE"
+        self.chunks = {}
+        pos = 12
+        while pos + 8 <= fsize:
+            self.inf.seek(pos)
+            (ctype, size) = struct.unpack("<4sI", self.inf.read(8))
+            ctype = ctype.decode("latin-1")
+            if ctype not in self.chunks:
+                self.chunks[ctype] = (pos + 8, min(size, fsize - pos - 8))
+            pos += 8 + size + (size & 1)
+        return self.chunks
+
+    # Read a chunk's data from the chunk directory, or None if there's
+    # no such chunk.
+    def readChunk(self, ctype):
+        if ctype not in self.chunks:
+            return None
+        (offset, size) = self.chunks[ctype]
+        self.inf.seek(offset)
+        return self.inf.read(size)
+
+    # Decode the smpl chunk: returns (unity note, [(type, start, end), ...])
+    # with one tuple per loop, or None if there's no smpl chunk.  Loop
+    # start and end are sample numbers, and end is inclusive.
+    def readSmpl(self):
+        smpl = self.readChunk("smpl")
+        if smpl is None or len(smpl) < 36:
+            return None
+        (unity, nloops) = struct.unpack_from("<I12xI", smpl, 12)
+        loops = []
+        for ix in range(nloops):
+            if 36 + (ix + 1) * 24 > len(smpl):
+                break
+            (ltype, start, end) = struct.unpack_from("<4xIII", smpl, 36 + ix * 24)
+            loops.append((ltype, start, end))
+        return (unity, loops)
+
 class Rmsbuf:
     def __init__(self, wave, maxlen=0):
         if maxlen == 0:
@@ -381,36 +585,162 @@ class Rmsbuf:
     def getPeak(self):
         return self.v2dB(self.maxval)
 
-    def findPrevCrossing(self):
-
-        t_offset = self.t - 1 - self.index
-        ix = self.index
-
-        samp = self.data[ix]
-        last_pos = samp >= 0
-        if samp == 0:
-            return self.t
-        while ix >= 0:
-            samp = self.data[ix]
-            pos = samp >= 0
-            if last_pos != pos:
-                return ix + t_offset
-            ix -= 1
 
-        if not self.full:
-            return self.t
-
-        t_offset -= self.len
-        ix = self.len - 1
-
-        while ix > self.index:
-            samp = self.data[ix]
-            pos = samp >= 0
-            if last_pos != pos:
-                return ix + t_offset
-            ix -= 1
+# Zero-crossing index for one channel (or the sum of channels) of a wave
+# file.  Built a block at a time, only as far as it has been asked for.
+#
+# A crossing is stored as the sample number of the first sample with the
+# new sign, where zero counts as positive:
+#   rising  (slope  1): samp[n-1] <  0 and samp[n] >= 0
+#   falling (slope -1): samp[n-1] >= 0 and samp[n] <  0
+
+class CrossingIndex:
+    def __init__(self, wave, chan=0):
+        self.wave = wave
+        self.chan = chan
+        self.rising = []            # one int64 array per block
+        self.falling = []
+        self.ends = []              # sample number ending each block
+        self.indexed = 0            # samples indexed so far
+        self.lastneg = None         # sign of last sample indexed
+
+    def extend(self, upto):
+        upto = min(upto, self.wave.numSamples)
+        while self.indexed < upto:
+            start = self.indexed
+            end = min(start + _block_len, self.wave.numSamples)
+            neg = np.signbit(self.wave.readMono(start, end, self.chan))
+            if len(neg) == 0:
+                break
+            if self.lastneg is None:
+                prev = neg[:1]
+            else:
+                prev = np.array([self.lastneg])
+            step = np.diff(np.concatenate((prev, neg)).astype(np.int8))
+            self.rising.append(np.flatnonzero(step < 0) + start)
+            self.falling.append(np.flatnonzero(step > 0) + start)
+            self.indexed = start + len(neg)
+            self.ends.append(self.indexed)
+            self.lastneg = neg[-1]
+
+    def _slopes(self, bix, slope):
+        if slope > 0:
+            return (self.rising[bix],)
+        if slope < 0:
+            return (self.falling[bix],)
+        return (self.rising[bix], self.falling[bix])
+
+    # Return the last crossing with the given slope (0 for either) at or
+    # before sample n, or None.
+    def prev(self, n, slope=0):
+        self.extend(n + 1)
+        bix = bisect.bisect_left(self.ends, n + 1)
+        if bix >= len(self.ends):
+            bix = len(self.ends) - 1
+        while bix >= 0:
+            found = self._last(bix, n, slope)
+            if found is not None:
+                return found
+            bix -= 1
+        return None
 
-        return self.t
+    # Return the nth crossing with the given slope looking back from
+    # sample hi (inclusive) to sample lo (exclusive).  If there are
+    # fewer than count, return the earliest one found, or None.
+    def nth_prev(self, hi, lo, slope, count):
+        found = self.between(lo + 1, hi + 1, slope)
+        if len(found) == 0:
+            return None
+        if len(found) < count:
+            return int(found[0])
+        return int(found[-count])
+
+    # Return the nth crossing with the given slope looking forward from
+    # sample lo (exclusive) to sample hi (inclusive).
+    def nth_next(self, lo, hi, slope, count):
+        found = self.between(lo + 1, hi + 1, slope)
+        if len(found) == 0:
+            return None
+        if len(found) < count:
+            return int(found[-1])
+        return int(found[count - 1])
+
+    # All crossings with the given slope in [lo, hi)
+    def between(self, lo, hi, slope):
+        self.extend(hi)
+        first = bisect.bisect_right(self.ends, lo)
+        found = []
+        for bix in range(first, len(self.ends)):
+            for blk in self._slopes(bix, slope):
+                a = np.searchsorted(blk, lo)
+                b = np.searchsorted(blk, hi)
+                found.append(blk[a:b])
+            if self.ends[bix] >= hi:
+                break
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        found = np.concatenate(found)
+        if slope == 0:
+            found.sort()
+        return found
+
+    def _last(self, bix, n, slope):
+        best = None
+        for blk in self._slopes(bix, slope):
+            ix = np.searchsorted(blk, n, side="right")
+            if ix > 0 and (best is None or blk[ix - 1] > best):
+                best = int(blk[ix - 1])
+        return best
+
+
+# Short-term RMS envelope for one channel of a wave file: the mean square
+# of each frame of frameLen samples.  Like the crossing index, it's built
+# a block at a time, and only whole frames are included.
+
+class Envelope:
+    def __init__(self, wave, frameLen, chan=0):
+        self.wave = wave
+        self.frameLen = frameLen
+        self.chan = chan
+        self.blockLen = max(1, _block_len // frameLen) * frameLen
+        self.blocks = []
+        self.framed = 0             # samples covered by whole frames
+        self.ms = None              # all blocks, once concatenated
+
+    def extend(self, upto):
+        upto = min(upto, self.wave.numSamples)
+        while self.framed + self.frameLen <= upto:
+            start = self.framed
+            end = min(start + self.blockLen, upto)
+            end -= (end - start) % self.frameLen
+            samps = self.wave.readMono(start, end, self.chan).astype(np.float64)
+            nframes = len(samps) // self.frameLen
+            if nframes == 0:
+                break
+            samps = samps[:nframes * self.frameLen].reshape(nframes, self.frameLen)
+            self.blocks.append(np.mean(samps * samps, axis=1))
+            self.framed = start + nframes * self.frameLen
+            self.ms = None
+
+    # mean square of each frame, for the whole file (so far)
+    def meanSquares(self):
+        self.extend(self.wave.numSamples)
+        if self.ms is None:
+            if self.blocks:
+                self.ms = np.concatenate(self.blocks)
+                self.blocks = [self.ms]
+            else:
+                self.ms = np.zeros(0)
+        return self.ms
+
+    # RMS level of each frame in dB, floored at the level of an RMS
+    # value of 2 like Rmsbuf.getRms()
+    def levels(self):
+        ms = np.maximum(self.meanSquares(), 4.0)
+        return 10.0 * np.log10(ms / (float(self.wave.fullScale) ** 2))
+
+    def frameAt(self, sn):
+        return sn // self.frameLen
 
 
 def dbTest(wave):